@@ -1,4 +1,4 @@
-from PySide import QtCore, QtGui, QtWebKit
+from PySide import QtCore, QtGui, QtWebKit, QtNetwork
 
 def toJavascriptString(s):
   "Take a python string and process it so it is handled equivalently in javascript"
@@ -31,6 +31,91 @@ class ClientMsg(object):
   def __str__(self):
     return "%s(%s)" % (self.func_name,self.parameter_dict)
 
+class PendingContent(QtCore.QObject):
+  """Returned by a url scheme handler that does not have the data yet, e.g. it is being downloaded.
+  Call setContent with the data, or None if there is nothing there, once it is known"""
+  
+  contentReadySignal = QtCore.Signal(object, object)
+  
+  def setContent(self, data, content_type):
+    self.contentReadySignal.emit(data, content_type)
+
+class LocalSchemeReply(QtNetwork.QNetworkReply):
+  "Reply to a request for a local url scheme holding data from python"
+  
+  CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+  
+  def __init__(self, parent, request):
+    """Call setContent to send the data"""
+    super(LocalSchemeReply, self).__init__(parent)
+    self.setRequest(request)
+    self.setUrl(request.url())
+    self.setOperation(QtNetwork.QNetworkAccessManager.GetOperation)
+    self.data = ""
+    self.offset = 0
+    self.open(QtCore.QIODevice.ReadOnly | QtCore.QIODevice.Unbuffered)
+    
+  @QtCore.Slot(object, object)
+  def setContent(self, data, content_type):
+    """data is the binary string to send, None if there is nothing at the url"""
+    if data is None:
+      self.setError(QtNetwork.QNetworkReply.ContentNotFoundError, "Nothing at %s" % self.url().toString())
+      self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, 404)
+    else:
+      self.data = data
+      self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, 200)
+      self.setHeader(QtNetwork.QNetworkRequest.ContentTypeHeader, content_type)
+      self.setHeader(QtNetwork.QNetworkRequest.ContentLengthHeader, len(self.data))
+      #the data at a url never changes so the browser can keep it
+      self.setRawHeader("Cache-Control", "max-age=%d" % self.CACHE_MAX_AGE_SECONDS)
+    #the page connects to our signals after we are returned so signal from the event loop
+    QtCore.QTimer.singleShot(0, self._signalReady)
+    
+  def _signalReady(self):
+    self.metaDataChanged.emit()
+    if len(self.data) != 0:
+      self.readyRead.emit()
+    self.finished.emit()
+    
+  def abort(self):
+    self.close()
+    
+  def isSequential(self):
+    return True
+    
+  def bytesAvailable(self):
+    return len(self.data) - self.offset + super(LocalSchemeReply, self).bytesAvailable()
+    
+  def readData(self, max_size):
+    chunk = self.data[self.offset:self.offset + max_size]
+    self.offset += len(chunk)
+    return chunk
+
+class LocalSchemeNetworkAccessManager(QtNetwork.QNetworkAccessManager):
+  "Serves urls of registered schemes from python, everything else goes to the network as normal"
+  
+  def __init__(self, parent=None):
+    super(LocalSchemeNetworkAccessManager, self).__init__(parent)
+    self.scheme_handlers = {} # scheme -> function taking a QUrl, see BrowserWidget.registerUrlScheme
+    
+  def createRequest(self, operation, request, outgoing_data=None):
+    handler = self.scheme_handlers.get(request.url().scheme())
+    if handler is None or operation != QtNetwork.QNetworkAccessManager.GetOperation:
+      return super(LocalSchemeNetworkAccessManager, self).createRequest(operation, request, outgoing_data)
+    try:
+      result = handler(request.url())
+    except Exception, e:
+      print "Error serving %s: %s" % (request.url().toString(), e)
+      result = None
+    reply = LocalSchemeReply(self, request)
+    if isinstance(result, PendingContent):
+      result.contentReadySignal.connect(reply.setContent)
+    elif result is None:
+      reply.setContent(None, None)
+    else:
+      reply.setContent(result[0], result[1])
+    return reply
+
 class WebPage(QtWebKit.QWebPage):
   "WebPage that actually tells us about errors!"
   def javaScriptConsoleMessage(self, msg, line, source):
@@ -74,6 +159,9 @@ class BrowserWidget(QtGui.QWidget):
     self.parent = parent
     self.view = WebViewEx(self)
     self.view.setPage(WebPage()) #ensure we can see javascript errros
+    #serve local data such as thumbnails to the page by url rather than sending it through javascript
+    self.network_access_manager = LocalSchemeNetworkAccessManager(self)
+    self.view.page().setNetworkAccessManager(self.network_access_manager)
     self.connection = ServerConnection(js_server_call_fn)
     self.setMaximumHeight(100000)
     
@@ -108,4 +196,12 @@ class BrowserWidget(QtGui.QWidget):
     "Evaluate javascript from the gui thread"
     self.frame.evaluateJavaScript(jscript)
     
+  def registerUrlScheme(self, scheme, handler_fn):
+    """Have urls of scheme, e.g. thumb://..., served by handler_fn on the gui thread.
+    handler_fn takes the QUrl and returns the tuple of (binary string data, content type), None if there is nothing there
+    or a PendingContent if the data has to be waited for"""
+    self.network_access_manager.scheme_handlers[scheme] = handler_fn
+    #let the page, loaded from a local file, use the scheme
+    QtWebKit.QWebSecurityOrigin.addLocalScheme(scheme)
+    
 
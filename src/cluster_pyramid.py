@@ -0,0 +1,394 @@
+"""Pre computed grid aggregates of the image positions at a range of zoom levels.
+This lets map markers be generated by looking up the cells covering the view port
+rather than clustering the raw image rows on every pan and zoom.
+Only the finest level holds the images, coarser levels hold per day counts, sums and extremes,
+so a zoomed out view costs a few aggregates however many images it covers"""
+import math
+import threading
+import unittest
+
+class PyramidConsts(object):
+  LEVELS = 20  # number of levels in the pyramid
+  LEVEL0_CELL_DEGREES = 180.0  # size of a cell at level 0, each level halves this
+  TIME_BUCKET_SECONDS = 24 * 60 * 60  # images are bucketed by the day they were taken so the time filter still works
+  AGGREGATE_LEVELS = 12  # levels below this keep aggregates, views of finer levels are small enough to sum from the images
+
+
+def cellDegreesForLevel(level):
+  "Return the width/height in degrees of the cells at the given level"
+  return PyramidConsts.LEVEL0_CELL_DEGREES / (2 ** level)
+
+def levelForCellDegrees(cell_degrees):
+  "Return the coarsest level whose cells are no bigger than cell_degrees"
+  if cell_degrees <= 0:
+    return PyramidConsts.LEVELS - 1
+  level = int(math.ceil(math.log(PyramidConsts.LEVEL0_CELL_DEGREES / cell_degrees, 2)))
+  return min(PyramidConsts.LEVELS - 1, max(0, level))
+
+def cellIndex(x, cell_degrees):
+  return int(math.floor(x / cell_degrees))
+
+def isInCell(level, lat_index, lng_index, latitude, longitude):
+  "True if the position is in the cell (lat_index, lng_index) of the level"
+  cell_degrees = cellDegreesForLevel(level)
+  return cellIndex(latitude, cell_degrees) == lat_index and cellIndex(longitude, cell_degrees) == lng_index
+
+def _dayOf(seconds):
+  return int(seconds // PyramidConsts.TIME_BUCKET_SECONDS)
+
+def _shiftKey(fine_key, from_level, to_level):
+  "Return the key of the cell at the coarser to_level containing the cell fine_key of from_level"
+  #cells halve each level so this is the same as cellIndex at to_level
+  shift = from_level - to_level
+  return (fine_key[0] >> shift, fine_key[1] >> shift)
+
+def _keysInRange(cells, lat_lo, lat_hi, lng_lo, lng_hi):
+  "Return the keys of the dict cells within the inclusive index ranges"
+  if (lat_hi - lat_lo + 1) * (lng_hi - lng_lo + 1) > len(cells):
+    #view port covers more of the grid than there are occupied cells
+    return [k for k in cells if lat_lo <= k[0] <= lat_hi and lng_lo <= k[1] <= lng_hi]
+  return [(i, j) for i in xrange(lat_lo, lat_hi + 1) for j in xrange(lng_lo, lng_hi + 1) if (i, j) in cells]
+
+
+class Aggregate(object):
+  """Count, position sums and extremes of a group of images. Removing the image at an extreme leaves
+  the extremes stale, to be recalculated when next needed"""
+
+  __slots__ = ("count", "sum_lat", "sum_lng", "user_placed_count", "min_taken_date", "max_taken_date",
+               "representative_id", "stale")
+
+  def __init__(self):
+    self.count = 0
+    self.sum_lat = 0.0
+    self.sum_lng = 0.0
+    self.user_placed_count = 0
+    self.min_taken_date = None
+    self.max_taken_date = None
+    self.representative_id = None  # lowest image id, its thumbnail represents the group
+    self.stale = False
+
+  def addImage(self, image_id, latitude, longitude, taken_date, user_placed):
+    self.count += 1
+    self.sum_lat += latitude
+    self.sum_lng += longitude
+    if user_placed:
+      self.user_placed_count += 1
+    if self.min_taken_date is None or taken_date < self.min_taken_date:
+      self.min_taken_date = taken_date
+    if self.max_taken_date is None or taken_date > self.max_taken_date:
+      self.max_taken_date = taken_date
+    if self.representative_id is None or image_id < self.representative_id:
+      self.representative_id = image_id
+
+  def addAggregate(self, other):
+    "Add the images of another, fresh, aggregate"
+    self.count += other.count
+    self.sum_lat += other.sum_lat
+    self.sum_lng += other.sum_lng
+    self.user_placed_count += other.user_placed_count
+    if self.min_taken_date is None or other.min_taken_date < self.min_taken_date:
+      self.min_taken_date = other.min_taken_date
+    if self.max_taken_date is None or other.max_taken_date > self.max_taken_date:
+      self.max_taken_date = other.max_taken_date
+    if self.representative_id is None or other.representative_id < self.representative_id:
+      self.representative_id = other.representative_id
+
+  def removeImage(self, image_id, latitude, longitude, taken_date, user_placed):
+    self.count -= 1
+    self.sum_lat -= latitude
+    self.sum_lng -= longitude
+    if user_placed:
+      self.user_placed_count -= 1
+    if taken_date == self.min_taken_date or taken_date == self.max_taken_date or image_id == self.representative_id:
+      self.stale = True
+
+  def isEmpty(self):
+    return self.count == 0
+
+
+class PyramidCell(object):
+  "Aggregate of the images in one grid cell of one level, and of them split by the day they were taken"
+
+  __slots__ = ("totals", "days")
+
+  def __init__(self):
+    self.totals = Aggregate()
+    self.days = {}  # day number -> Aggregate
+
+  def add(self, day, image_id, latitude, longitude, taken_date, user_placed):
+    bucket = self.days.get(day)
+    if bucket is None:
+      bucket = self.days[day] = Aggregate()
+    bucket.addImage(image_id, latitude, longitude, taken_date, user_placed)
+    self.totals.addImage(image_id, latitude, longitude, taken_date, user_placed)
+
+  def remove(self, day, image_id, latitude, longitude, taken_date, user_placed):
+    bucket = self.days[day]
+    bucket.removeImage(image_id, latitude, longitude, taken_date, user_placed)
+    if bucket.isEmpty():
+      del self.days[day]
+    self.totals.removeImage(image_id, latitude, longitude, taken_date, user_placed)
+
+  def isEmpty(self):
+    return self.totals.isEmpty()
+
+
+class CellSummary(object):
+  """The images of one cell taken within a time window. The id's aren't held, model.getImageIdsInCells
+  looks them up from the cell's level and indexes when they are wanted"""
+
+  def __init__(self, level, lat_index, lng_index, aggregate):
+    self.level = level
+    self.lat_index = lat_index
+    self.lng_index = lng_index
+    self.count = aggregate.count
+    self.lat = aggregate.sum_lat / aggregate.count  # centroid
+    self.lng = aggregate.sum_lng / aggregate.count
+    self.min_taken_date = aggregate.min_taken_date  # seconds
+    self.max_taken_date = aggregate.max_taken_date
+    self.representative_id = aggregate.representative_id
+    self.all_user_placed = aggregate.user_placed_count == aggregate.count
+
+
+class ClusterPyramid(object):
+  """Grid aggregates of the located images at PyramidConsts.LEVELS levels.
+  Each image is held once, in the day of its cell at the finest level, found by id in a dict.
+  Levels below PyramidConsts.AGGREGATE_LEVELS keep a PyramidCell for each occupied cell, the rest are summed
+  from the finest cells when looked up. Kept up to date as images are inserted or moved"""
+
+  _sql = "SELECT image_id, latitude, longitude, taken_date, geo_type FROM Image WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND taken_date IS NOT NULL;"
+
+  def __init__(self, user_geo_type):
+    """user_geo_type is the geo_type value of images placed by the user"""
+    self.user_geo_type = user_geo_type
+    self.levels = [{} for _ in range(PyramidConsts.AGGREGATE_LEVELS)]  # per level dict of (lat index, lng index) -> PyramidCell
+    self._fine_cells = {}  # finest level (lat index, lng index) -> day -> image id -> (latitude, longitude, taken date, user placed)
+    self._days = {}  # day -> set of the finest level keys with images taken that day
+    self._fine_keys = {}  # key at the last aggregate level -> set of the finest level keys within it
+    self._lock = threading.RLock()  # updated on the gui thread while map markers are looked up on a worker
+
+  @classmethod
+  def loadFromCursor(cls, cursor, user_geo_type):
+    "Build the pyramid from all the located images in the database"
+    pyramid = cls(user_geo_type)
+    cursor.execute(cls._sql)
+    while True:
+      rows = cursor.fetchmany(10000)
+      if len(rows) == 0:
+        break
+      for row in rows:
+        pyramid.addImage(*row)
+    return pyramid
+
+  def _fineKeyOf(self, latitude, longitude):
+    cell_degrees = cellDegreesForLevel(PyramidConsts.LEVELS - 1)
+    return (cellIndex(latitude, cell_degrees), cellIndex(longitude, cell_degrees))
+
+  def addImage(self, image_id, latitude, longitude, taken_date, geo_type):
+    "Add an image, images without a position or date are ignored as they can never be shown on the map"
+    if latitude is None or longitude is None or taken_date is None:
+      return
+    user_placed = geo_type == self.user_geo_type
+    fine_key = self._fineKeyOf(latitude, longitude)
+    day = _dayOf(taken_date)
+    finest = PyramidConsts.LEVELS - 1
+    with self._lock:
+      images = self._fine_cells.setdefault(fine_key, {}).setdefault(day, {})
+      if image_id in images:
+        return
+      images[image_id] = (latitude, longitude, taken_date, user_placed)
+      self._days.setdefault(day, set()).add(fine_key)
+      self._fine_keys.setdefault(_shiftKey(fine_key, finest, PyramidConsts.AGGREGATE_LEVELS - 1), set()).add(fine_key)
+      for level, cells in enumerate(self.levels):
+        key = _shiftKey(fine_key, finest, level)
+        cell = cells.get(key)
+        if cell is None:
+          cell = cells[key] = PyramidCell()
+        cell.add(day, image_id, latitude, longitude, taken_date, user_placed)
+
+  def removeImage(self, image_id, latitude, longitude, taken_date, geo_type):
+    "Remove an image that was previously added with the same values"
+    if latitude is None or longitude is None or taken_date is None:
+      return
+    user_placed = geo_type == self.user_geo_type
+    fine_key = self._fineKeyOf(latitude, longitude)
+    day = _dayOf(taken_date)
+    finest = PyramidConsts.LEVELS - 1
+    with self._lock:
+      days = self._fine_cells.get(fine_key)
+      if days is None or image_id not in days.get(day, ()):
+        return
+      images = days[day]
+      del images[image_id]
+      if len(images) == 0:
+        del days[day]
+        self._days[day].discard(fine_key)
+        if len(self._days[day]) == 0:
+          del self._days[day]
+        if len(days) == 0:
+          del self._fine_cells[fine_key]
+          parent_key = _shiftKey(fine_key, finest, PyramidConsts.AGGREGATE_LEVELS - 1)
+          self._fine_keys[parent_key].discard(fine_key)
+          if len(self._fine_keys[parent_key]) == 0:
+            del self._fine_keys[parent_key]
+      for level, cells in enumerate(self.levels):
+        key = _shiftKey(fine_key, finest, level)
+        cell = cells[key]
+        cell.remove(day, image_id, latitude, longitude, taken_date, user_placed)
+        if cell.isEmpty():
+          del cells[key]
+
+  def _iterImagesOnDay(self, day):
+    "Yield (finest level key, image id, (latitude, longitude, taken date, user placed)) of the images taken on the day"
+    for fine_key in self._days.get(day, ()):
+      for image_id, image in self._fine_cells[fine_key][day].iteritems():
+        yield fine_key, image_id, image
+
+  def _freshBucket(self, level, key, cell, day):
+    "Return the day's aggregate of the cell, recalculating it from the images if it is stale"
+    bucket = cell.days[day]
+    if bucket.stale:
+      bucket = Aggregate()
+      finest = PyramidConsts.LEVELS - 1
+      for fine_key, image_id, image in self._iterImagesOnDay(day):
+        if _shiftKey(fine_key, finest, level) == key:
+          bucket.addImage(image_id, *image)
+      cell.days[day] = bucket
+    return bucket
+
+  def _freshTotals(self, level, key, cell):
+    "Return the cell's aggregate, recalculating it from its days if it is stale"
+    if cell.totals.stale:
+      totals = Aggregate()
+      for day in cell.days.keys():
+        totals.addAggregate(self._freshBucket(level, key, cell, day))
+      cell.totals = totals
+    return cell.totals
+
+  def getCellsInArea(self, level, start_seconds, end_seconds, min_lat, max_lat, min_lng, max_lng):
+    "Return a list of CellSummary for the cells of the level that overlap the area and have images in the time window"
+    cell_degrees = cellDegreesForLevel(level)
+    index_range = (cellIndex(min_lat, cell_degrees), cellIndex(max_lat, cell_degrees),
+                   cellIndex(min_lng, cell_degrees), cellIndex(max_lng, cell_degrees))
+    with self._lock:
+      if level < PyramidConsts.AGGREGATE_LEVELS:
+        aggregates = self._getAggregatesInArea(level, start_seconds, end_seconds, index_range)
+      else:
+        aggregates = self._sumImagesInArea(level, start_seconds, end_seconds, index_range)
+    return [CellSummary(level, key[0], key[1], aggregate) for key, aggregate in aggregates.iteritems() if aggregate.count > 0]
+
+  def _getAggregatesInArea(self, level, start_seconds, end_seconds, index_range):
+    "Return a dict of key -> Aggregate of the images in the time window for the level's cells in the index range"
+    cells = self.levels[level]
+    first_day = _dayOf(start_seconds)
+    last_day = _dayOf(end_seconds)
+    aggregates = {}
+    partial = {}  # aggregates still to have the images from the days at the ends of the window added
+    for key in _keysInRange(cells, *index_range):
+      cell = cells[key]
+      totals = self._freshTotals(level, key, cell)
+      if totals.min_taken_date >= start_seconds and totals.max_taken_date <= end_seconds:
+        #whole cell is inside the time window so the aggregates can be used directly
+        aggregates[key] = totals
+        continue
+      aggregate = aggregates[key] = partial[key] = Aggregate()
+      if last_day - first_day > 1:
+        for day in cell.days.keys():
+          if first_day < day < last_day:
+            aggregate.addAggregate(self._freshBucket(level, key, cell, day))
+
+    #the days at either end of the window are only partly inside it, so go through their images
+    finest = PyramidConsts.LEVELS - 1
+    for day in set([first_day, last_day]):
+      for fine_key, image_id, image in self._iterImagesOnDay(day):
+        aggregate = partial.get(_shiftKey(fine_key, finest, level))
+        if aggregate is not None and start_seconds <= image[2] <= end_seconds:
+          aggregate.addImage(image_id, *image)
+    return aggregates
+
+  def _sumImagesInArea(self, level, start_seconds, end_seconds, index_range):
+    "As _getAggregatesInArea for levels without aggregates, summed from the finest cells in the area"
+    parent_level = PyramidConsts.AGGREGATE_LEVELS - 1
+    finest = PyramidConsts.LEVELS - 1
+    lat_lo, lat_hi, lng_lo, lng_hi = index_range
+    shift = level - parent_level
+    first_day = _dayOf(start_seconds)
+    last_day = _dayOf(end_seconds)
+    aggregates = {}
+    for parent_key in _keysInRange(self._fine_keys, lat_lo >> shift, lat_hi >> shift, lng_lo >> shift, lng_hi >> shift):
+      for fine_key in self._fine_keys[parent_key]:
+        key = _shiftKey(fine_key, finest, level)
+        if not (lat_lo <= key[0] <= lat_hi and lng_lo <= key[1] <= lng_hi):
+          continue
+        for day, images in self._fine_cells[fine_key].iteritems():
+          if day < first_day or day > last_day:
+            continue
+          #only the days at either end of the window need checking image by image
+          check_dates = day == first_day or day == last_day
+          for image_id, image in images.iteritems():
+            if check_dates and (image[2] < start_seconds or image[2] > end_seconds):
+              continue
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+              aggregate = aggregates[key] = Aggregate()
+            aggregate.addImage(image_id, *image)
+    return aggregates
+
+
+class TestClusterPyramid(unittest.TestCase):
+
+  def setUp(self):
+    self.day = PyramidConsts.TIME_BUCKET_SECONDS
+
+  def testLookup(self):
+    day = self.day
+    pyramid = ClusterPyramid(1)
+    pyramid.addImage(1, 10.0, 20.0, 10 * day, 1)
+    pyramid.addImage(2, 10.001, 20.001, 10 * day + 100, 0)
+    pyramid.addImage(3, 40.0, 20.0, 20 * day, 1)
+    pyramid.addImage(4, None, None, 20 * day, 1)
+
+    cells = pyramid.getCellsInArea(0, 0, 30 * day, -90, 90, -180, 180)
+    self.assertEqual(1, len(cells))
+    self.assertEqual(3, cells[0].count)
+    self.assertEqual(1, cells[0].representative_id)
+    self.assertFalse(cells[0].all_user_placed)
+
+    for cell_degrees in [1.0, 0.01]:
+      level = levelForCellDegrees(cell_degrees)
+      cells = pyramid.getCellsInArea(level, 10 * day + 50, 30 * day, 0, 50, 0, 50)
+      self.assertEqual([(1, 2), (1, 3)], sorted((c.count, c.representative_id) for c in cells))
+      self.assertTrue(all(isInCell(level, c.lat_index, c.lng_index, c.lat, c.lng) for c in cells))
+
+    pyramid.removeImage(2, 10.001, 20.001, 10 * day + 100, 0)
+    cells = pyramid.getCellsInArea(0, 0, 30 * day, -90, 90, -180, 180)
+    self.assertEqual(2, cells[0].count)
+    self.assertTrue(cells[0].all_user_placed)
+    self.assertEqual(10 * day, cells[0].min_taken_date)
+
+  def testStaleExtremes(self):
+    day = self.day
+    pyramid = ClusterPyramid(1)
+    for image_id in range(1, 101):
+      pyramid.addImage(image_id, 10.0, 20.0, 5 * day + image_id, 0)
+    #take out the lowest id's and the earliest times, as re-placing a selection does
+    for image_id in range(1, 51):
+      pyramid.removeImage(image_id, 10.0, 20.0, 5 * day + image_id, 0)
+    for level in [0, levelForCellDegrees(0.0001)]:
+      cells = pyramid.getCellsInArea(level, 0, 10 * day, -90, 90, -180, 180)
+      self.assertEqual([(50, 51, 5 * day + 51, 5 * day + 100)],
+                       [(c.count, c.representative_id, c.min_taken_date, c.max_taken_date) for c in cells])
+    self.assertEqual(1, len(pyramid._fine_cells))
+
+  def testPartialDays(self):
+    day = self.day
+    pyramid = ClusterPyramid(1)
+    for image_id, seconds in enumerate([3 * day + 10, 3 * day + 500, 4 * day, 6 * day + 10, 6 * day + 900]):
+      pyramid.addImage(image_id + 1, 10.0, 20.0, seconds, 0)
+    cells = pyramid.getCellsInArea(2, 3 * day + 100, 6 * day + 100, -90, 90, -180, 180)
+    self.assertEqual([(3, 2, 3 * day + 500, 6 * day + 10)],
+                     [(c.count, c.representative_id, c.min_taken_date, c.max_taken_date) for c in cells])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,5 +1,6 @@
 import sys
 import json
+import copy
 import traceback
 from PySide import QtCore
 import model
@@ -8,6 +9,10 @@ import version
 import exif
 import qt_utils
 import map_marker_logic
+import marker_worker
+import tile_cache
+import exporters
+import file_utils
 from datetime import datetime
 import about
 
@@ -20,6 +25,10 @@ class Controller(QtCore.QObject):
   
   VIEW_REFRESH_MS = 2000  # only update the gui at this rate in milliseconds when gathering data
   SLIDER_REFRESH_MS = 150
+  SLIDER_DENSITY_BINS = 100  # bars drawn behind the time slider showing how busy each part is
+  TIME_SLIDER_TOOLTIP = "Only show images on the map in the specified date range."
+  AUTOSAVE_MS = 5 * 60 * 1000  # save changes in the background to the file last saved or loaded at this rate
+  OFFLINE_MAP_ZOOM_LEVELS = 3  # number of zoom levels in from the current one saved for offline use
   _THREAD_WAIT_MS = 1000
   
   HELP_URL = "http://www.lococitato.com/exif_mapper/help.html"
@@ -34,6 +43,15 @@ class Controller(QtCore.QObject):
     self.db_manager = model.DBManager(version.getVersionString())
     self.view_data = model.ViewData()
     self.scanner_thread = None
+    self.marker_thread = marker_worker.MarkerWorkerThread()
+    self.tile_store = tile_cache.TileStore(file_utils.getTileCacheFilePath())
+    self.tile_provider = tile_cache.TileProvider(self.tile_store, self)
+    self.tile_seed_task = None
+    self.backup_task = None  # db_backup.BackupTask of a save or load in progress
+    self.export_task = None
+    self._backup_complete_fn = None
+    self._backup_progress_msg = ""
+    self.autosave_timer = QtCore.QTimer(self)
     self.main_window = MainWindow( js_to_server_call_fn=self._onCallFromBrowserWidget, slider_time_to_formatted_date_fn=self._format_slider_time)
     self.main_window.showTargetDirectoryScreen()
     
@@ -44,12 +62,14 @@ class Controller(QtCore.QObject):
     self.slider_event_count = 0
     self.accept_new_images = False  # guard against queued images
     self.show_paths = True
-    self._last_idlatlng_list = []
-    self._last_arrow_list = []
+    self._shown_markers = {}  # marker id -> model.MapMarkerData of the markers on the map
+    self._shown_arrow_ids = set()
+    self._map_bounds = None  # (south, north, west, east) of the map as last shown
     
     #calls we can receive from the html part of the gui (BrowserWidget)
     self.server_api = {"mapMoved": self._mapMoved,
                        "getImageData": self._getImageData,
+                       "getMarkerImageIds": self._getMarkerImageIds,
                        "mapPhotoHighlighted": self._mapPhotoHighlighted,
                        "imagesDragged": self._imagesDragged }
     
@@ -73,13 +93,23 @@ class Controller(QtCore.QObject):
     self.main_window.photo_table.requestNewImageSetSignal.connect( self._onRequestNewImageSet )
     self.main_window.photo_table.imageClicked.connect( self._onImageClicked )
     self.main_window.photo_table.selectionChanged.connect( self._onImageSelectionChanged )
+    self.main_window.photo_table.rangeSelectRequested.connect( self._onRangeSelectRequested )
+    self.autosave_timer.timeout.connect( self._onAutosave )
+    self.autosave_timer.start( self.AUTOSAVE_MS )
+    self.main_window.selectAllInTimeFilterSignal.connect( self._onSelectAllInTimeFilter )
+    self.main_window.selectAllWithoutGPSSignal.connect( self._onSelectAllWithoutGPS )
     self.main_window.newFileSignal.connect( self._onNewFile )
     self.main_window.openFileSignal.connect( self._onOpenFile )
     self.main_window.saveFileSignal.connect( self._onSaveFile )
     self.main_window.saveAsFileSignal.connect( self._onSaveAsFile )
     self.main_window.exitSignal.connect( self._onExitRequest )
     self.main_window.exportCSVSignal.connect( self._onExportCSV )
+    self.main_window.exportGeoJSONSignal.connect( self._onExportGeoJSON )
+    self.main_window.exportGPXSignal.connect( self._onExportGPX )
+    self.main_window.cancelExportSignal.connect( self._stopExportTask )
     self.main_window.aboutSignal.connect( self._onAbout )
+    self.main_window.saveMapOfflineSignal.connect( self._onSaveMapOffline )
+    self.marker_thread.markersReadySignal.connect( self._onMarkersReady, QtCore.Qt.QueuedConnection )
     
     self.main_window.right_side.zoom_to_all_btn.clicked.connect( self._onZoomOutToAll )
     self.main_window.right_side.place_selected_btn.clicked.connect( self._onPlaceSelectImages )
@@ -87,10 +117,62 @@ class Controller(QtCore.QObject):
     
     self.time_slider.spanChanged.connect( self._onTimeSpanChanged )
     
+    self.main_window.webView.registerUrlScheme( model.Consts.THUMBNAIL_URL_SCHEME, self._serveThumbnail )
+    self.main_window.webView.registerUrlScheme( tile_cache.TileConsts.URL_SCHEME, self.tile_provider.serveTile )
+    
+  def _serveThumbnail(self, url):
+    "Return the (jpeg data, content type) for a thumbnail url the map has asked for, see model.getThumbnailUrl"
+    parsed = model.parseThumbnailUrl(url.host() + url.path())
+    if parsed is None or not self.db_manager.isConnected():
+      return None
+    generation, image_id, draggable = parsed
+    if generation != self.db_manager.thumbnail_cache.generation:
+      return None  # asked for by a map showing a database that has since been closed
+    if draggable is None:
+      thumbnail = self.db_manager.getThumbnail(image_id)
+    else:
+      #overlay image with correct icon, only popups do this as the map draws the icon over marker thumbnails
+      overlay_key = (image_id, draggable)
+      thumbnail = self.db_manager.thumbnail_cache.get(overlay_key)
+      if thumbnail is None:
+        thumbnail = self.db_manager.getThumbnail(image_id)
+        if thumbnail is None:
+          return None
+        thumbnail = map_marker_logic.overlayImageDataWithIcon(thumbnail, draggable)
+        self.db_manager.thumbnail_cache.put(overlay_key, thumbnail)
+    if thumbnail is None:
+      return None
+    return (thumbnail, "image/jpeg")
+    
   @QtCore.Slot()
   def _onImageSelectionChanged(self):
     "When the image selection changes update state of place button"
-    self.main_window.right_side.place_selected_btn.setEnabled( len(self.photo_table.selected_image_id_list) != 0 )
+    self.main_window.right_side.place_selected_btn.setEnabled( len(self.photo_table.selection) != 0 )
+    
+  @QtCore.Slot(int, int)
+  def _onRangeSelectRequested(self, first_index, last_index):
+    "The user has shift clicked to select the images from first_index to last_index, skip any outside the time filter"
+    first_selectable, last_selectable = self.photo_table.getSelectableIndexRange()
+    first_index = max(first_index, first_selectable)
+    last_index = min(last_index, last_selectable)
+    if first_index <= last_index:
+      self.photo_table.selectImageIds(self.db_manager.getPlaceableImageIdsBetweenIndices(first_index, last_index))
+    
+  @QtCore.Slot()
+  def _onSelectAllInTimeFilter(self):
+    self._selectAllInTimeFilter(without_position_only=False)
+    
+  @QtCore.Slot()
+  def _onSelectAllWithoutGPS(self):
+    self._selectAllInTimeFilter(without_position_only=True)
+    
+  def _selectAllInTimeFilter(self, without_position_only):
+    "Select every image the user can place in the time filter, streamed from the database straight into the selection"
+    if not self.db_manager.isConnected():
+      return
+    start_seconds = model.dateToSeconds(self.view_data.map_settings.map_start_date)
+    end_seconds = model.dateToSeconds(self.view_data.map_settings.map_end_date)
+    self.photo_table.selectImageIds(self.db_manager.getPlaceableImageIdsBetweenTimes(start_seconds, end_seconds, without_position_only))
     
   @QtCore.Slot(int)
   def _onImageClicked(self, image_index):
@@ -109,7 +191,11 @@ class Controller(QtCore.QObject):
   def _onDirectorySelected(self, directory):
     "User has selected directory and is ready to go"
     try:
+      self._waitForBackupTask()
+      self._stopExportTask()
+      self.marker_thread.releaseDatabase()
       self.db_manager.newFile()
+      self.photo_table.clear()
       
       self.view_data = self.db_manager.getViewData()
       self.view_data.current_image_set_info.start_scan_date = datetime.now()
@@ -125,6 +211,9 @@ class Controller(QtCore.QObject):
   @QtCore.Slot()
   def _onNewFile(self):
     self._stopScanTask()
+    self._waitForBackupTask()
+    self._stopExportTask()
+    self.marker_thread.releaseDatabase()
     self.db_manager.newFile()
     self.view_data = self.db_manager.getViewData()
     self.main_window.showTargetDirectoryScreen()
@@ -140,74 +229,239 @@ class Controller(QtCore.QObject):
     
     try:
       self._stopScanTask()
-      self.db_manager.loadFile(target_file)
-      self.view_data = self.db_manager.getViewData()
-      #tell the gui we are starting#tell the gui we are starting
-      self.main_window.showRunningScreen()
-      self.main_window.clearDisplayedData()
-      self._updateGUIView()
-      #need to set the time filters on the range...
-      self.main_window.time_slider.setLowerValue(model.dateToSeconds(self.view_data.map_settings.map_start_date))
-      self.main_window.time_slider.setUpperValue(model.dateToSeconds(self.view_data.map_settings.map_end_date))
-      #TODO Need to reset the map position...
+      self._waitForBackupTask()
+      self._stopExportTask()
+      self.marker_thread.releaseDatabase()
+      if self.db_manager.shouldOpenInPlace(target_file):
+        #big files are ready straight away without being copied
+        self.db_manager.openFile(target_file)
+        self._showLoadedFile()
+        return
+      load_task = self.db_manager.createLoadTask(target_file)
+      #nothing to show until it has loaded
+      self.main_window.setEnabled(False)
+      self._startBackupTask(load_task, self._onLoadTaskComplete, "Loading %s," % file_utils.getFilenameFromPath(target_file))
     except Exception, e:
       self.displayError("Unable to load file %s, not what was expected.<br/>%s" % (target_file, str(e)))
+      
+  def _onLoadTaskComplete(self, load_task):
+    self.main_window.setEnabled(True)
+    try:
+      if not load_task.succeeded:
+        self.db_manager.discardLoadTask(load_task)
+        raise RuntimeError(load_task.error_msg)
+      self.db_manager.onLoadTaskComplete(load_task)
+      self._showLoadedFile()
+    except Exception, e:
+      self.displayError("Unable to load file %s, not what was expected.<br/>%s" % (load_task.src_file, str(e)))
+      
+  def _showLoadedFile(self):
+    self.view_data = self.db_manager.getViewData()
+    #tell the gui we are starting#tell the gui we are starting
+    self.main_window.showRunningScreen()
+    self.main_window.clearDisplayedData()
+    self._updateGUIView()
+    #need to set the time filters on the range...
+    self.main_window.time_slider.setLowerValue(self._seconds_to_slider_time(model.dateToSeconds(self.view_data.map_settings.map_start_date)))
+    self.main_window.time_slider.setUpperValue(self._seconds_to_slider_time(model.dateToSeconds(self.view_data.map_settings.map_end_date)))
+    #TODO Need to reset the map position...
   
-  def _saveToFile(self, target_file):
-    "Perform the actual save"
+  def _saveToFile(self, target_file, background=True):
+    """Perform the actual save, on a worker thread if background and the database allows.
+    Returns True if saved or the save has started"""
     try:
       self.db_manager.saveViewData(self.view_data) #save current view positions
-      self.db_manager.saveFile(target_file)
+      if background and self.db_manager.canSaveInBackground():
+        if self.backup_task is not None:
+          return False
+        self._startBackupTask(self.db_manager.createSaveTask(target_file), self._onSaveTaskComplete,
+                              "Saving to %s," % file_utils.getFilenameFromPath(target_file))
+      else:
+        self._waitForBackupTask()
+        self._stopExportTask()
+        self.marker_thread.releaseDatabase()
+        self.db_manager.saveFile(target_file)
       return True
     except Exception, e:
       self.displayError("Unable to save to file %s. %s" % (target_file, str(e)))
       return False
     
+  def _onSaveTaskComplete(self, save_task):
+    if save_task.succeeded:
+      self.db_manager.onSaveTaskComplete(save_task)
+    else:
+      self.displayError("Unable to save to file %s. %s" % (save_task.dest_file, save_task.error_msg))
+      
+  def _startBackupTask(self, backup_task, complete_fn, progress_msg):
+    "Run a db_backup.BackupTask showing its progress in the status bar then call complete_fn(backup_task), one at a time"
+    self.backup_task = backup_task
+    self._backup_complete_fn = complete_fn
+    self._backup_progress_msg = progress_msg
+    backup_task.progressSignal.connect( self._onBackupProgress, QtCore.Qt.QueuedConnection )
+    backup_task.backupCompleteSignal.connect( self._onBackupComplete, QtCore.Qt.QueuedConnection )
+    backup_task.start()
+    
+  @QtCore.Slot(int, int)
+  def _onBackupProgress(self, done, total):
+    self.main_window.statusBar().showMessage("%s %i%%." % (self._backup_progress_msg, 100 * done / max(total, 1)))
+    
+  @QtCore.Slot(bool, str)
+  def _onBackupComplete(self, succeeded, error_msg):
+    if self.backup_task is None or self.sender() is not self.backup_task:
+      return  # already handled by _waitForBackupTask
+    self._finishBackupTask()
+    
+  def _waitForBackupTask(self):
+    "Block until any save or load in progress is done and handle it, call before changing the database file"
+    if self.backup_task is not None:
+      self._finishBackupTask()
+      
+  def _finishBackupTask(self):
+    backup_task = self.backup_task
+    self.backup_task = None
+    backup_task.wait()
+    self.main_window.statusBar().clearMessage()
+    self._backup_complete_fn(backup_task)
+      
   @QtCore.Slot()
-  def _onSaveFile(self):
+  def _onAutosave(self):
+    "Save changes in the background to the file last saved or loaded, skipped if nothing has changed or it is busy"
+    if (self.db_manager.isConnected() and self.db_manager.dirty and len(self.db_manager.saved_to_file) != 0 and
+        self.backup_task is None and self.scanner_thread is None and self.db_manager.canSaveInBackground()):
+      self._saveToFile(self.db_manager.saved_to_file)
+    
+  @QtCore.Slot()
+  def _onSaveFile(self, background=True):
     qt_utils.show_warning_msg(self.main_window, "Saving scans to file is not available in this beta version.")
     #check if we know where to save the data?
     if self.db_manager.saved_to_file == None or len(self.db_manager.saved_to_file) == 0:
       return self._onSaveAsFile()
     else:
-      return self._saveToFile(self.db_manager.saved_to_file)
+      return self._saveToFile(self.db_manager.saved_to_file, background)
 
   @QtCore.Slot()
-  def _onSaveAsFile(self):
+  def _onSaveAsFile(self, background=True):
     qt_utils.show_warning_msg(self.main_window, "Saving scans to file is not available in this beta version.")
     return
     target_file = qt_utils.choose_save_file(self.main_window, self.db_manager.saved_to_file)
     if target_file != None:
-      return self._saveToFile(target_file)
+      return self._saveToFile(target_file, background)
     else:
       return False
       
   @QtCore.Slot()
   def _onExitRequest(self):
+    self.autosave_timer.stop()
+    self._waitForBackupTask()
+    self._stopExportTask()
     #check if there is unsaved data....
     if self.db_manager.dirty:
       if qt_utils.askYesNoQuestion(self.main_window, "Save current scan data?", "Save?"):
-        while not self._onSaveFile():
+        while not self._onSaveFile(background=False):
           pass  
     self._stopScanTask()
+    self.marker_thread.stop( self._THREAD_WAIT_MS )
+    self.photo_table.decoder.waitForDone( self._THREAD_WAIT_MS )
+    if self.tile_seed_task is not None:
+      self.tile_seed_task.stop()
+      self.tile_seed_task.wait( self._THREAD_WAIT_MS )
     # allow exit to continue
     self.main_window.canExit = True
     self.db_manager.close()
+    self.tile_store.close()
   
   @QtCore.Slot()
   def _onExportCSV(self):
-    "Export the database to csv..."
-    #choose a csv file to export too...
-    target_file = qt_utils.choose_save_file(self.main_window, None, qt_utils.create_csv_file_filter(), "csv")
-    if target_file is not None:
-      self.displayWaitDialog("Exporting in cvs format to %s" % target_file)
-      try:
-        model.exportImageDataToCSV(self.db_manager.cursor, target_file)
-      except Exception, e:
-        self.displayError(str(e))
-      finally:
-        self.closeWaitDialog()
+    self._exportImages(exporters.CSVExporter(), qt_utils.create_csv_file_filter())
+    
+  @QtCore.Slot()
+  def _onExportGeoJSON(self):
+    self._exportImages(exporters.GeoJSONExporter(), qt_utils.create_geojson_file_filter())
+    
+  @QtCore.Slot()
+  def _onExportGPX(self):
+    self._exportImages(exporters.GPXExporter(), qt_utils.create_gpx_file_filter())
+    
+  def _exportImages(self, exporter, file_filter):
+    "Export the images in the time filter and map view on a worker thread"
+    if self.export_task is not None:
+      qt_utils.show_msg(self.main_window, "An export is already in progress.")
+      return
+    target_file = qt_utils.choose_save_file(self.main_window, None, file_filter, exporter.file_ext)
+    if target_file is None:
+      return
+    rect = None
+    if self._map_bounds is not None:
+      south, north, west, east = self._map_bounds
+      rect = model.Rect(south, north, west, east)
+    export_filter = exporters.ExportFilter(model.dateToSeconds(self.view_data.map_settings.map_start_date),
+                                           model.dateToSeconds(self.view_data.map_settings.map_end_date), rect)
+    #the worker has its own connection so only sees what is committed
+    self.db_manager.cursor.connection.commit()
+    self.export_task = exporters.ExportTask(self.db_manager.db_file, target_file, exporter, export_filter)
+    self.export_task.progressSignal.connect( self._onExportProgress, QtCore.Qt.QueuedConnection )
+    self.export_task.exportCompleteSignal.connect( self._onExportComplete, QtCore.Qt.QueuedConnection )
+    self.main_window.actionCancel_Export.setEnabled(True)
+    self.export_task.start()
+    
+  @QtCore.Slot(int, int)
+  def _onExportProgress(self, done, total):
+    self.main_window.statusBar().showMessage("Exporting, %i of %i images." % (done, total))
+    
+  @QtCore.Slot(bool, str)
+  def _onExportComplete(self, succeeded, error_msg):
+    if self.export_task is None or self.sender() is not self.export_task:
+      return  # stopped
+    target_file = self.export_task.target_file
+    self._stopExportTask()
+    if not succeeded:
+      self.displayError("Unable to export to %s. %s" % (target_file, error_msg))
       
+  @QtCore.Slot()
+  def _stopExportTask(self):
+    "Stop any export in progress, it removes its part written file, call before changing the database file"
+    if self.export_task is not None:
+      self.export_task.stop()
+      self.export_task.wait()
+      self.export_task = None
+      self.main_window.actionCancel_Export.setEnabled(False)
+      self.main_window.statusBar().clearMessage()
+      
+  @QtCore.Slot()
+  def _onSaveMapOffline(self):
+    "Download the map tiles of the area being shown, from the current zoom level in, so it can be seen offline"
+    if self.tile_seed_task is not None and self.tile_seed_task.isRunning():
+      qt_utils.show_msg(self.main_window, "The map is already being saved for offline use.")
+      return
+    if self._map_bounds is None:
+      return
+    south, north, west, east = self._map_bounds
+    min_zoom = self.view_data.map_settings.zoom
+    #go as far in as possible without downloading too much
+    for max_zoom in range(min(tile_cache.TileConsts.MAX_ZOOM, min_zoom + self.OFFLINE_MAP_ZOOM_LEVELS), min_zoom - 1, -1):
+      tiles = tile_cache.tilesInArea(south, north, west, east, min_zoom, max_zoom)
+      if len(tiles) <= tile_cache.TileConsts.MAX_SEED_TILES:
+        break
+    else:
+      qt_utils.show_warning_msg(self.main_window, "The map area shown is too large to save, zoom in and try again.")
+      return
+    self.tile_seed_task = tile_cache.TileSeedTask(self.tile_store, tiles)
+    self.tile_seed_task.progressSignal.connect( self._onTileSeedProgress, QtCore.Qt.QueuedConnection )
+    self.tile_seed_task.seedCompleteSignal.connect( self._onTileSeedComplete, QtCore.Qt.QueuedConnection )
+    self.tile_seed_task.start()
+    
+  @QtCore.Slot(int, int)
+  def _onTileSeedProgress(self, done, total):
+    self.main_window.statusBar().showMessage("Saving map for offline use, %i of %i tiles." % (done, total))
+    
+  @QtCore.Slot(int, int)
+  def _onTileSeedComplete(self, downloaded, failed):
+    self.main_window.statusBar().clearMessage()
+    if failed != 0:
+      qt_utils.show_warning_msg(self.main_window, "Saved map for offline use, %i tiles could not be downloaded." % failed)
+    else:
+      qt_utils.show_msg(self.main_window, "Saved map for offline use, %i new tiles downloaded." % downloaded)
+    
   @QtCore.Slot()
   def _onAbout(self):
     about_window = about.AboutWindow(self.main_window)
@@ -236,11 +490,36 @@ class Controller(QtCore.QObject):
   def _format_slider_time(self, value):
     return model.secondsToDateString(self._slider_time_to_seconds(value))
   
+  def _getTimeHistogram(self):
+    "Return the model's time_histogram.TimeHistogram if it has any images to map the slider over, or None"
+    histogram = self.db_manager.getTimeHistogram()
+    if histogram is None or histogram.getTotal() == 0:
+      return None
+    return histogram
+  
   def _slider_time_to_seconds(self, value):
-    "Slider time is in percent"
+    """Slider time is spread over the images by the time histogram, each step passes about as many images.
+    The maximum is after every image"""
+    histogram = self._getTimeHistogram()
+    if histogram is not None:
+      return histogram.sliderValueToSeconds(value, self.time_slider.maximum())
     min_date = model.dateToSeconds(self.view_data.current_image_set_info.min_date)
     max_date = model.dateToSeconds(self.view_data.current_image_set_info.max_date)
-    return min_date + (max_date - min_date) * value / 100
+    if value >= self.time_slider.maximum():
+      #ensure rounding errors don't creep in on maximums
+      return max_date + 1
+    return min_date + (max_date - min_date) * value / self.time_slider.maximum()
+  
+  def _seconds_to_slider_time(self, seconds):
+    "The inverse of _slider_time_to_seconds"
+    histogram = self._getTimeHistogram()
+    if histogram is not None:
+      return histogram.secondsToSliderValue(seconds, self.time_slider.maximum())
+    min_date = model.dateToSeconds(self.view_data.current_image_set_info.min_date)
+    max_date = model.dateToSeconds(self.view_data.current_image_set_info.max_date)
+    if max_date <= min_date:
+      return 0 if seconds <= min_date else self.time_slider.maximum()
+    return min(max(0, (seconds - min_date) * self.time_slider.maximum() // (max_date - min_date)), self.time_slider.maximum())
    
   @QtCore.Slot(int)
   def _onShowPathChanged(self, path_shown):
@@ -256,15 +535,24 @@ class Controller(QtCore.QObject):
   @QtCore.Slot()
   def _onPlaceSelectImages(self):
     "Place selected images in the centre of the current map view..."
-    selected_image_id_list = self.photo_table.selected_image_id_list
     map_centre = self.view_data.map_settings.centre
-    self._place_images(selected_image_id_list, map_centre.lng, map_centre.lat)
+    #placed a range of id's at a time, the selection is never expanded into a list
+    self._place_images(self.photo_table.selection, map_centre.lng, map_centre.lat)
       
-  def _place_images(self, image_id_list, longitude, latitude):
-    "Put given images at positions"
-    if len(image_id_list) != 0:
-      self.db_manager.setPositionOnImages(image_id_list, longitude, latitude)
+  def _onPlaceImagesProgress(self, done, total):
+    "Called between the chunks of a large placement, which runs on the gui thread"
+    if total > self.db_manager.PLACE_CHUNK_SIZE:
+      self.main_window.statusBar().showMessage("Placing images, %i of %i." % (done, total))
+      #let the message paint without handling input part way through
+      QtCore.QCoreApplication.processEvents(QtCore.QEventLoop.ExcludeUserInputEvents)
+      
+  def _place_images(self, image_ids, longitude, latitude):
+    "Put given images at positions, image_ids is an id_range_set.IDRangeSet or a list"
+    if len(image_ids) != 0:
+      self.db_manager.setPositionOnImages(image_ids, longitude, latitude, self._onPlaceImagesProgress)
+      self.main_window.statusBar().clearMessage()
       #update photo table
+      self.photo_table.invalidateImages(image_ids)
       self._updatePhotoTable()
       #update web view
       self._updateMap()
@@ -275,7 +563,11 @@ class Controller(QtCore.QObject):
     #work out where the containing rectangle is...
     start_date = self.view_data.map_settings.map_start_date
     end_date = self.view_data.map_settings.map_end_date
-    min_lat, max_lat, min_lng, max_lng = model.getLatLngRectContainingImagesBetween(self.db_manager.cursor, start_date, end_date)
+    snapshot = self.db_manager.getSnapshot()
+    if snapshot is not None:
+      min_lat, max_lat, min_lng, max_lng = snapshot.getLatLngRectContainingImagesBetween(model.dateToSeconds(start_date), model.dateToSeconds(end_date))
+    else:
+      min_lat, max_lat, min_lng, max_lng = model.getLatLngRectContainingImagesBetween(self.db_manager.cursor, start_date, end_date)
     
     if None in [min_lat, max_lat, min_lng, max_lng]:
       self.displayError("No images have geographical data encoded in them.")
@@ -306,11 +598,12 @@ class Controller(QtCore.QObject):
     self.slider_event_count = 0
     lower_seconds = self._slider_time_to_seconds(self.time_slider.lower)
     upper_seconds = self._slider_time_to_seconds(self.time_slider.upper)
-    #ensure rounding errors don't creep in on maximums
-    if self.time_slider.upper == 100:
-      upper_seconds += 1
-    self.photo_table.first_index_after_date_filter = self.db_manager.getImageIndexAfterTimeTaken(lower_seconds)
-    self.photo_table.last_index_after_date_filter = self.db_manager.getImageIndexAfterTimeTaken(upper_seconds)
+    #answered from the time histogram as the slider times are at the start of days
+    first_index = self.db_manager.getImageIndexAfterTimeTaken(lower_seconds)
+    last_index = self.db_manager.getImageIndexAfterTimeTaken(upper_seconds)
+    self.photo_table.first_index_after_date_filter = first_index
+    self.photo_table.last_index_after_date_filter = last_index
+    self.time_slider.setToolTip("%s<br/>%i images in range." % (self.TIME_SLIDER_TOOLTIP, last_index - first_index))
     self.photo_table.repaintTable()
     #update the map
     self.view_data.map_settings.map_start_date = model.secondsToDate(lower_seconds)
@@ -319,6 +612,7 @@ class Controller(QtCore.QObject):
     
   def run(self):
     "Run the application"
+    self.marker_thread.start()
     self.main_window.show()
     # Enter Qt application main loop
    
@@ -404,6 +698,8 @@ class Controller(QtCore.QObject):
   
   def _updateSliderRange(self):  
     self.main_window.right_side.time_labels.updateLabelPositions()
+    histogram = self._getTimeHistogram()
+    self.time_slider.setDensities(histogram.getSliderDensities(self.SLIDER_DENSITY_BINS) if histogram is not None else [])
     
   @QtCore.Slot()
   def _updateGUIView(self):
@@ -441,6 +737,7 @@ class Controller(QtCore.QObject):
                                                                                          image_set_info.number_of_images)
       
       self.main_window.statusLabel.setText(status_text)
+      self.main_window.statusLabel.setToolTip("Thumbnail cache: %s" % self.photo_table.getImageCacheUsage())
     else:
       self.main_window.statusLabel.setText("")
       
@@ -448,9 +745,15 @@ class Controller(QtCore.QObject):
     "Update the images in the current photo table"
     self.photo_table.setTotalNumberOfImages(self.db_manager.getNumberOfImages())
     if buffered_range == None:
+      #images may have been added anywhere so reload the whole buffer
       buffered_range = self.photo_table.getDesiredBufferedImageRange()
-    image_rows = self.db_manager.getImageSetAt(buffered_range[0], buffered_range[1] - buffered_range[0], True)
-    self.main_window.photo_table.updatePhotos(buffered_range[0], image_rows)
+      image_rows = self.db_manager.getImageSetAt(buffered_range[0], buffered_range[1] - buffered_range[0], True)
+      self.main_window.photo_table.updatePhotos(buffered_range[0], image_rows)
+    else:
+      #scrolling, only fetch the images coming into the buffer
+      fetched_ranges = [(start, self.db_manager.getImageSetAt(start, end - start, True))
+                        for start, end in self.photo_table.getMissingImageRanges(buffered_range[0], buffered_range[1])]
+      self.main_window.photo_table.slidePhotos(buffered_range[0], buffered_range[1], fetched_ranges)
     
   def _web_send(self, jscript):
     "Execute some javascript on the browser widget"
@@ -483,30 +786,54 @@ class Controller(QtCore.QObject):
       self.displayError("Invalid call to getImageData")
       return
     
-    #overlay image with correct icon
+    #the popup loads the thumbnail with the correct icon overlaid from its url
     image_data = self.db_manager.getImageById(image_id)
-    image_data.thumbnail = map_marker_logic.overlayImageDataWithIcon(image_data.thumbnail, 
-                                                                     image_data.geo_type == model.ImageTable.GEO_FROM_USER)
+    thumbnail_url = self.db_manager.getThumbnailUrl(image_id, image_data.geo_type == model.ImageTable.GEO_FROM_USER)
   
-    self._web_send("%s(%s, %s);" % (callback, json.dumps(curried_obj), json.dumps(image_data.serializeToDict())))
+    self._web_send("%s(%s, %s);" % (callback, json.dumps(curried_obj), json.dumps(image_data.serializeToDict(thumbnail_url))))
+
+  def _getShownMarkerImageIds(self, marker_id):
+    "Return the image id's of a marker on the map, looking them up if the marker only has its cells, None if not shown"
+    marker_data = self._shown_markers.get(marker_id)
+    if marker_data is None:
+      return None
+    return model.getMarkerImageIds(self.db_manager.cursor, marker_data)
+    
+  def _getMarkerImageIds(self, params):
+    "Callback with the list of image id's of a marker on the map, the map only knows how many there are"
+    callback_key = "callback"
+    curried_key = "curried"
+    marker_id_key = "marker_id"
+    
+    if params == None or callback_key not in params or not isinstance(params[callback_key], basestring) or len(params[callback_key]) == 0 or\
+       marker_id_key not in params:
+      self.displayError("Invalid call to getMarkerImageIds")
+      return
+    
+    curried_obj = params.get(curried_key, {})
+    image_id_list = self._getShownMarkerImageIds(params[marker_id_key])
+    if image_id_list is None:
+      return  # removed from the map since
+    self._web_send("%s(%s, %s);" % (params[callback_key], json.dumps(curried_obj), json.dumps(list(image_id_list))))
 
   def _imagesDragged(self, params):
     "Called when the user drags a draggable marker on the map"
-    image_id_list_key = "image_id_list"
+    marker_id_key = "marker_id"
     longitude_key = "longitude"
     latitude_key = "latitude"
     
     if params is None or\
-       image_id_list_key not in params or\
+       marker_id_key not in params or\
        longitude_key not in params or\
        latitude_key not in params:
       return
     
-    image_id_list = params[image_id_list_key]
+    image_id_list = self._getShownMarkerImageIds(params[marker_id_key])
     latitude = params[latitude_key]
     longitude = params[longitude_key]
     
-    self._place_images(image_id_list, longitude, latitude)
+    if image_id_list is not None:
+      self._place_images(image_id_list, longitude, latitude)
     
   def _mapPhotoHighlighted(self, params):
     "Called by the browser widget displaying the map when a photo is select on the map, using json encoding"
@@ -555,6 +882,8 @@ class Controller(QtCore.QObject):
     
       self.db_manager.setMapSettings(self.view_data.map_settings)
     
+    self._map_bounds = (params[south_key], params[north_key], params[west_key], params[east_key])
+    
     #update non-table map-markers...
     self.updateMapMarkers([ params[south_key], params[north_key] ],
                           [ params[west_key], params[east_key] ],
@@ -562,33 +891,41 @@ class Controller(QtCore.QObject):
                           params[map_height_key])
   
   def updateMapMarkers(self, min_max_lat, min_max_lng, map_width_pixels, map_height_pixels):
-    "Update the markers showing where images are..."
-    # may want to take this of onto a worker thread for large data sets...
+    "Ask the marker thread to update the markers showing where images are, _onMarkersReady is called with the result"
+    if not self.db_manager.isConnected():
+      return
     map_lat_lng_rect = model.Rect(min_max_lat[0], min_max_lat[1], min_max_lng[0], min_max_lng[1])
-    marker_logic_data = map_marker_logic.MarkerLogicData(self.db_manager.dbcon, 
-                                                         self.view_data.map_settings, 
-                                                         self.MAP_MARKER_IMG_WIDTH, 
-                                                         self.MAP_MARKER_IMG_HEIGHT,
-                                                         self.show_paths)
-    merged_marker_list, arrow_list = map_marker_logic.updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_height_pixels)
-    
-    
-    new_idlatlng_list = []
-    for x in merged_marker_list:
-      new_idlatlng_list.extend(x.image_id_list)
-      new_idlatlng_list.append(x.lat)
-      new_idlatlng_list.append(x.lng)
+    request = marker_worker.MarkerRequest(self.db_manager.db_file,
+                                          copy.deepcopy(self.view_data.map_settings),
+                                          map_lat_lng_rect,
+                                          map_width_pixels,
+                                          map_height_pixels,
+                                          self.MAP_MARKER_IMG_WIDTH, 
+                                          self.MAP_MARKER_IMG_HEIGHT,
+                                          self.show_paths,
+                                          self.db_manager.getSnapshot(),
+                                          self.db_manager.getClusterPyramid(),
+                                          self.db_manager.marker_cache)
+    self.marker_thread.requestMarkers(request)
   
-    #only update map if something has changed
-    if len(new_idlatlng_list) != len(self._last_idlatlng_list) or\
-       len(arrow_list) != len(self._last_arrow_list) or \
-       new_idlatlng_list != self._last_idlatlng_list or \
-       arrow_list != self._last_arrow_list:
+  @QtCore.Slot(int, object, object)
+  def _onMarkersReady(self, sequence, merged_marker_list, arrow_list):
+    "Markers have been worked out on the marker thread, send them to the map unless the map has moved since"
+    if not self.marker_thread.isCurrent(sequence):
+      return
+    
+    #only send the map what has changed
+    self._shown_markers, removed_marker_ids, added_markers, moved_markers = map_marker_logic.getMarkerChanges(self._shown_markers, merged_marker_list)
+    self._shown_arrow_ids, removed_arrow_ids, added_arrows = map_marker_logic.getArrowChanges(self._shown_arrow_ids, arrow_list, self.view_data.map_settings.zoom)
+    
+    if len(removed_marker_ids) != 0 or len(added_markers) != 0 or len(moved_markers) != 0 or \
+       len(removed_arrow_ids) != 0 or len(added_arrows) != 0:
       #serialize and pass to gui
-      s_merged_marker_list = [x.serializeToDict() for x in merged_marker_list]
-      self._web_send("setMapMarkers(%s, %s);" % (json.dumps(s_merged_marker_list), json.dumps(arrow_list)))
-      self._last_idlatlng_list = new_idlatlng_list
-      self._last_arrow_list = arrow_list
+      s_added_markers = [x.serializeToDict(self.db_manager.getThumbnailUrl(x.thumbnail_id) if x.thumbnail_id is not None else None)
+                         for x in added_markers]
+      s_moved_markers = [{"marker_id": x.thumbnail_id, "lat": x.lat, "lng": x.lng} for x in moved_markers]
+      self._web_send("applyMapMarkerChanges(%s, %s, %s, %s, %s);" % (json.dumps(removed_marker_ids), json.dumps(s_added_markers), json.dumps(s_moved_markers),
+                                                                    json.dumps(removed_arrow_ids), json.dumps(added_arrows)))
 
     
 def _map_contains(m, k):
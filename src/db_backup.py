@@ -0,0 +1,212 @@
+"""Copies sqlite databases with sqlite's online backup api a few pages at a time, so saving and loading
+can run on a worker thread while the working database stays connected.
+Python 2's sqlite3 module doesn't wrap the backup api so it is called through ctypes, isOnlineBackupAvailable
+says if the sqlite library could be found"""
+import os
+import ctypes
+import ctypes.util
+import shutil
+import time
+import unittest
+from PySide import QtCore
+
+class BackupConsts(object):
+  PAGES_PER_STEP = 256  # 1Mb a step with the default page size
+  BUSY_WAIT_SECONDS = 0.05  # wait before retrying a step when another connection holds a lock
+  PARTIAL_FILE_SUFFIX = ".part"  # saves are written to here then renamed so a failed save leaves the old file alone
+
+_SQLITE_OK = 0
+_SQLITE_BUSY = 5
+_SQLITE_LOCKED = 6
+_SQLITE_DONE = 101
+_SQLITE_OPEN_READONLY = 0x01
+_SQLITE_OPEN_READWRITE = 0x02
+_SQLITE_OPEN_CREATE = 0x04
+
+def _loadSqliteLibrary():
+  "Return the ctypes library of the sqlite python uses, or None"
+  candidates = []
+  try:
+    import _sqlite3
+    #windows python ships sqlite3.dll next to _sqlite3.pyd
+    candidates.append(os.path.join(os.path.dirname(_sqlite3.__file__), "sqlite3.dll"))
+  except (ImportError, AttributeError):
+    pass
+  candidates.append(ctypes.util.find_library("sqlite3"))
+  for name in candidates:
+    if name is None:
+      continue
+    try:
+      lib = ctypes.CDLL(name)
+      lib.sqlite3_backup_init
+    except (OSError, AttributeError):
+      continue
+    lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_char_p]
+    lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.restype = ctypes.c_char_p
+    lib.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+    lib.sqlite3_backup_init.restype = ctypes.c_void_p
+    lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_backup_pagecount.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+    return lib
+  return None
+
+_sqlite_lib = _loadSqliteLibrary()
+
+def isOnlineBackupAvailable():
+  return _sqlite_lib is not None
+
+def _open(file_name, flags):
+  if isinstance(file_name, unicode):
+    file_name = file_name.encode("utf-8")
+  db = ctypes.c_void_p()
+  result = _sqlite_lib.sqlite3_open_v2(file_name, ctypes.byref(db), flags, None)
+  if result != _SQLITE_OK:
+    message = _sqlite_lib.sqlite3_errmsg(db) if db.value else "out of memory"
+    _sqlite_lib.sqlite3_close(db)
+    raise RuntimeError("Unable to open %s. %s" % (file_name, message))
+  return db
+
+def backupDatabase(src_file, dest_file, progress_fn=None, cancel_fn=None):
+  """Copy the sqlite database src_file over dest_file with the online backup api, PAGES_PER_STEP pages at a time.
+  Other connections can carry on using src_file, the backup starts again if they change it part way through.
+  progress_fn(pages done, total pages) is called after each step, returns False if cancel_fn() returned True.
+  Raises RuntimeError on failure"""
+  if _sqlite_lib is None:
+    raise RuntimeError("The sqlite online backup api is not available.")
+  src_db = _open(src_file, _SQLITE_OPEN_READONLY)
+  try:
+    dest_db = _open(dest_file, _SQLITE_OPEN_READWRITE | _SQLITE_OPEN_CREATE)
+    try:
+      backup = _sqlite_lib.sqlite3_backup_init(dest_db, "main", src_db, "main")
+      if not backup:
+        raise RuntimeError("Unable to start copying to %s. %s" % (dest_file, _sqlite_lib.sqlite3_errmsg(dest_db)))
+      result = _SQLITE_OK
+      try:
+        while result != _SQLITE_DONE:
+          if cancel_fn is not None and cancel_fn():
+            return False
+          result = _sqlite_lib.sqlite3_backup_step(backup, BackupConsts.PAGES_PER_STEP)
+          if result in (_SQLITE_BUSY, _SQLITE_LOCKED):
+            time.sleep(BackupConsts.BUSY_WAIT_SECONDS)
+          elif result not in (_SQLITE_OK, _SQLITE_DONE):
+            break
+          if progress_fn is not None:
+            total = _sqlite_lib.sqlite3_backup_pagecount(backup)
+            progress_fn(total - _sqlite_lib.sqlite3_backup_remaining(backup), total)
+      finally:
+        finish_result = _sqlite_lib.sqlite3_backup_finish(backup)
+      if result != _SQLITE_DONE or finish_result != _SQLITE_OK:
+        raise RuntimeError("Unable to copy to %s. %s" % (dest_file, _sqlite_lib.sqlite3_errmsg(dest_db)))
+      return True
+    finally:
+      _sqlite_lib.sqlite3_close(dest_db)
+  finally:
+    _sqlite_lib.sqlite3_close(src_db)
+
+def _replaceFile(from_file, to_file):
+  "Rename from_file to to_file, replacing it if it exists (os.rename won't on windows)"
+  if os.path.exists(to_file):
+    os.remove(to_file)
+  os.rename(from_file, to_file)
+
+def saveDatabase(src_file, save_file, progress_fn=None, cancel_fn=None):
+  """Back up src_file to save_file through a partial file that replaces save_file once it is complete,
+  so a failed or cancelled save leaves any existing file as it was. Returns False if cancelled"""
+  partial_file = save_file + BackupConsts.PARTIAL_FILE_SUFFIX
+  try:
+    if os.path.exists(partial_file):
+      os.remove(partial_file)
+    if not backupDatabase(src_file, partial_file, progress_fn, cancel_fn):
+      os.remove(partial_file)
+      return False
+    _replaceFile(partial_file, save_file)
+    return True
+  except:
+    if os.path.exists(partial_file):
+      os.remove(partial_file)
+    raise
+
+
+class BackupTask(QtCore.QThread):
+  """Copy a database file to another on a worker thread with backupDatabase, or saveDatabase if to_save_file.
+  Without the online backup api a load falls back to a plain file copy, which is only safe if nothing has the source open"""
+
+  progressSignal = QtCore.Signal(int, int) # pages done, total pages
+  backupCompleteSignal = QtCore.Signal(bool, str) # succeeded, error message
+
+  def __init__(self, src_file, dest_file, to_save_file=False):
+    super(BackupTask, self).__init__()
+    self.src_file = src_file
+    self.dest_file = dest_file
+    self.to_save_file = to_save_file
+    self.change_count = None  # for the owner, e.g. model.DBManager notes how many changes the copy includes
+    self.succeeded = False  # result, as sent by backupCompleteSignal, once finished
+    self.error_msg = ""
+    self._stop_requested = False
+
+  def stop(self):
+    self._stop_requested = True
+
+  def run(self):
+    try:
+      cancel_fn = lambda: self._stop_requested
+      if not isOnlineBackupAvailable() and not self.to_save_file:
+        shutil.copyfile(self.src_file, self.dest_file)
+        completed = True
+      elif self.to_save_file:
+        completed = saveDatabase(self.src_file, self.dest_file, self.progressSignal.emit, cancel_fn)
+      else:
+        completed = backupDatabase(self.src_file, self.dest_file, self.progressSignal.emit, cancel_fn)
+      self.succeeded = completed
+      self.error_msg = "" if completed else "Cancelled."
+    except Exception, e:
+      self.succeeded = False
+      self.error_msg = str(e)
+    self.backupCompleteSignal.emit(self.succeeded, self.error_msg)
+
+
+@unittest.skipIf(not isOnlineBackupAvailable(), "sqlite library not found")
+class TestBackup(unittest.TestCase):
+
+  def setUp(self):
+    import sqlite3
+    import tempfile
+    self.folder = tempfile.mkdtemp()
+    self.src_file = os.path.join(self.folder, "src.db")
+    self.dbcon = sqlite3.connect(self.src_file)
+    self.dbcon.execute("CREATE TABLE Data (value TEXT);")
+    self.dbcon.executemany("INSERT INTO Data (value) VALUES (?);", (("x" * 1000,) for _ in range(2000)))
+    self.dbcon.commit()
+
+  def tearDown(self):
+    self.dbcon.close()
+    shutil.rmtree(self.folder)
+
+  def testSave(self):
+    import sqlite3
+    save_file = os.path.join(self.folder, "saved.db")
+    with open(save_file, "w") as f:
+      f.write("not a database")
+    progress = []
+    self.assertTrue(saveDatabase(self.src_file, save_file, lambda done, total: progress.append((done, total))))
+    self.assertTrue(len(progress) > 1)
+    self.assertEqual(progress[-1][0], progress[-1][1])
+    saved = sqlite3.connect(save_file)
+    self.assertEqual(2000, saved.execute("SELECT COUNT(*) FROM Data;").fetchone()[0])
+    saved.close()
+    #the source connection stays usable
+    self.dbcon.execute("DELETE FROM Data;")
+    self.dbcon.commit()
+
+  def testCancel(self):
+    save_file = os.path.join(self.folder, "saved.db")
+    self.assertFalse(saveDatabase(self.src_file, save_file, cancel_fn=lambda: True))
+    self.assertEqual(["src.db"], os.listdir(self.folder))
+
+
+if __name__ == "__main__":
+  unittest.main()
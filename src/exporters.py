@@ -0,0 +1,278 @@
+"""Exports the image data to csv, GeoJSON or a GPX trail, streamed from the database a batch of rows at a time
+so memory use doesn't grow with the number of images"""
+import os
+import csv
+import json
+import unittest
+from xml.sax.saxutils import escape, quoteattr
+from PySide import QtCore
+import model
+
+class ExportConsts(object):
+  BATCH_ROWS = 1000  # rows fetched from the database at a time, progress is reported after each batch
+
+class ExportFilter(object):
+  "Which images to export, those taken from start_seconds to end_seconds and if rect (model.Rect in lat lng) is given within it"
+
+  def __init__(self, start_seconds, end_seconds, rect=None):
+    self.start_seconds = start_seconds
+    self.end_seconds = end_seconds
+    self.rect = rect
+
+#order of the columns the exporters are given
+_EXPORT_COLUMNS = "Image.image_id, file, camera_make, taken_date, taken_date_type, geo_type, latitude, longitude"
+(_FILE, _CAMERA_MAKE, _TAKEN_DATE, _TAKEN_DATE_TYPE, _GEO_TYPE, _LATITUDE, _LONGITUDE) = range(1, 8)
+
+def _getExportWhereSql(export_filter):
+  "Return the (from and where sql, args) of the images to export in taken date order"
+  args = [export_filter.start_seconds, export_filter.end_seconds]
+  if export_filter.rect is None:
+    return "FROM Image WHERE taken_date >= ? AND taken_date <= ?", args
+  rect = export_filter.rect
+  args.extend([rect.min_lng, rect.max_lng, rect.min_lat, rect.max_lat] * 2)
+  #the r-tree narrows it down, its boxes are slightly bigger than the images' positions
+  return """FROM Image, ImageLocation WHERE Image.image_id == ImageLocation.image_id AND
+  taken_date >= ? AND taken_date <= ? AND
+  max_longitude >= ? AND min_longitude <= ? AND max_latitude >= ? AND min_latitude <= ? AND
+  longitude >= ? AND longitude <= ? AND latitude >= ? AND latitude <= ?""", args
+
+def _utf8(x):
+  if isinstance(x, unicode):
+    return x.encode("utf-8")
+  return x
+
+def _dateTypeToStr(x):
+  if x == model.ImageTable.TAKEN_DATE_FROM_EXIF:
+    return "Date Taken By Camera"
+  else:
+    return "File Creation Date"
+
+def _geoTypeToStr(x):
+  if x == model.ImageTable.GEO_FROM_EXIF:
+    return "GPS from EXIF data in photo"
+  else:
+    return "Position supplied by user"
+
+def _makeDateFormatter(day_format_fn, time_format):
+  """Return a function formatting taken dates in seconds as day_format_fn(datetime of the day) followed by
+  time_format % (hours, minutes, seconds). Each day is only formatted once, which is a lot quicker than a datetime a row"""
+  days = {}
+  def formatSeconds(seconds):
+    if seconds is None:
+      return ""
+    day, day_seconds = divmod(int(seconds), 24 * 60 * 60)
+    day_str = days.get(day)
+    if day_str is None:
+      day_str = days[day] = day_format_fn(model.secondsToDate(day * 24 * 60 * 60))
+    return day_str + time_format % (day_seconds // 3600, day_seconds // 60 % 60, day_seconds % 60)
+  return formatSeconds
+
+def _makeDateTimeStringFormatter():
+  "As model.secondsToDateTimeString"
+  return _makeDateFormatter(lambda d: "%d %s %d " % (d.day, model.month_names[d.month - 1], d.year), "%02d:%02d:%02d")
+
+def _makeIsoTimeFormatter():
+  "ISO 8601 times, camera clocks have no time zone so they are treated as utc"
+  return _makeDateFormatter(lambda d: d.strftime("%Y-%m-%dT"), "%02d:%02d:%02dZ")
+
+
+class CSVExporter(object):
+  "Every image as a row of a csv file"
+  file_ext = "csv"
+  headers = ["File", "Camera Make", "Date", "Date Type", "Latitude", "Longitude", "Position Data Source"]
+
+  def begin(self, f):
+    self.writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+    self.date_to_str = _makeDateTimeStringFormatter()
+    self.writer.writerow(self.headers)
+
+  def writeRows(self, f, rows):
+    self.writer.writerows([_utf8(row[_FILE]), _utf8(row[_CAMERA_MAKE]),
+                           self.date_to_str(row[_TAKEN_DATE]), _dateTypeToStr(row[_TAKEN_DATE_TYPE]),
+                           row[_LATITUDE], row[_LONGITUDE], _geoTypeToStr(row[_GEO_TYPE])] for row in rows)
+
+  def end(self, f):
+    pass
+
+
+class GeoJSONExporter(object):
+  "Images with a position as the point features of a GeoJSON feature collection"
+  file_ext = "geojson"
+
+  def begin(self, f):
+    f.write('{"type": "FeatureCollection", "features": [')
+    self.first = True
+    self.iso_time = _makeIsoTimeFormatter()
+
+  def writeRows(self, f, rows):
+    for row in rows:
+      if row[_LATITUDE] is None or row[_LONGITUDE] is None:
+        continue
+      feature = {"type": "Feature",
+                 "geometry": {"type": "Point", "coordinates": [row[_LONGITUDE], row[_LATITUDE]]},
+                 "properties": {"file": row[_FILE],
+                                "camera_make": row[_CAMERA_MAKE],
+                                "taken": self.iso_time(row[_TAKEN_DATE]),
+                                "date_type": _dateTypeToStr(row[_TAKEN_DATE_TYPE]),
+                                "position_source": _geoTypeToStr(row[_GEO_TYPE])}}
+      f.write("\n" if self.first else ",\n")
+      f.write(json.dumps(feature))
+      self.first = False
+
+  def end(self, f):
+    f.write("\n]}\n")
+
+
+class GPXExporter(object):
+  "Images with a position as the points of a GPX track in the order they were taken, the trail of a trip"
+  file_ext = "gpx"
+
+  def begin(self, f):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="Photo Trail Mapper" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            '<trk><name>Photo Trail</name><trkseg>\n')
+    self.iso_time = _makeIsoTimeFormatter()
+
+  def writeRows(self, f, rows):
+    for row in rows:
+      if row[_LATITUDE] is None or row[_LONGITUDE] is None:
+        continue
+      f.write('<trkpt lat=%s lon=%s><time>%s</time><name>%s</name></trkpt>\n' %
+              (quoteattr(repr(row[_LATITUDE])), quoteattr(repr(row[_LONGITUDE])), self.iso_time(row[_TAKEN_DATE]),
+               escape(_utf8(os.path.basename(row[_FILE] or "")))))
+
+  def end(self, f):
+    f.write('</trkseg></trk>\n</gpx>\n')
+
+
+def exportImages(cursor, target_file, exporter, export_filter, progress_fn=None, cancel_fn=None):
+  """Write the images matching export_filter in taken date order to target_file with the exporter, e.g. CSVExporter.
+  progress_fn(rows done, total rows) is called after each batch, returns False and removes the file if cancel_fn() returned True.
+  May raise an exception on failure, the file is removed"""
+  from_where_sql, args = _getExportWhereSql(export_filter)
+  cursor.execute("SELECT COUNT(*) %s;" % from_where_sql, args)
+  total = cursor.fetchone()[0]
+  done = 0
+  completed = False
+  f = open(target_file, "wb")
+  try:
+    exporter.begin(f)
+    cursor.execute("SELECT %s %s ORDER BY taken_date, Image.image_id;" % (_EXPORT_COLUMNS, from_where_sql), args)
+    while True:
+      if cancel_fn is not None and cancel_fn():
+        return False
+      rows = cursor.fetchmany(ExportConsts.BATCH_ROWS)
+      if len(rows) == 0:
+        break
+      exporter.writeRows(f, rows)
+      done += len(rows)
+      if progress_fn is not None:
+        progress_fn(done, total)
+    exporter.end(f)
+    completed = True
+    return True
+  finally:
+    f.close()
+    if not completed:
+      os.remove(target_file)
+
+
+class ExportTask(QtCore.QThread):
+  """Run exportImages on a worker thread with its own connection to db_file, which the gui must have committed.
+  Stop it before the database is closed or replaced"""
+
+  progressSignal = QtCore.Signal(int, int) # rows done, total rows
+  exportCompleteSignal = QtCore.Signal(bool, str) # succeeded, error message
+
+  def __init__(self, db_file, target_file, exporter, export_filter):
+    super(ExportTask, self).__init__()
+    self.db_file = db_file
+    self.target_file = target_file
+    self.exporter = exporter
+    self.export_filter = export_filter
+    self._stop_requested = False
+
+  def stop(self):
+    self._stop_requested = True
+
+  def run(self):
+    try:
+      dbcon = model.connectToDatabase(self.db_file)
+      #text as the utf-8 it is stored as, saves decoding it only to encode it again to write
+      dbcon.text_factory = str
+      try:
+        completed = exportImages(dbcon.cursor(), self.target_file, self.exporter, self.export_filter,
+                                 self.progressSignal.emit, lambda: self._stop_requested)
+      finally:
+        dbcon.close()
+      self.exportCompleteSignal.emit(completed, "" if completed else "Cancelled.")
+    except Exception, e:
+      self.exportCompleteSignal.emit(False, str(e))
+
+
+class TestExporters(unittest.TestCase):
+
+  def setUp(self):
+    self.dm = model.DBManager(0.1)
+    self.dm.newFile()
+    for seconds, lat_lng in [(300, (10.0, 20.0)), (100, (11.0, 21.0)), (200, None), (400, (50.0, 60.0))]:
+      image_data = model.ImageData()
+      image_data.full_path = u"c:\\photos\\\u00e9t\u00e9 \"%i\".jpg" % seconds
+      image_data.taken_date = model.secondsToDate(seconds)
+      if lat_lng is not None:
+        image_data.latitude, image_data.longitude = lat_lng
+        image_data.geo_type = model.ImageTable.GEO_FROM_EXIF
+      self.dm.insertImage(image_data)
+    tmp_file = model.DBManager._createTempDBFile()
+    tmp_file.close()
+    self.target_file = tmp_file.name
+    self.batch_rows = ExportConsts.BATCH_ROWS
+
+  def tearDown(self):
+    ExportConsts.BATCH_ROWS = self.batch_rows
+    self.dm.close()
+    if os.path.exists(self.target_file):
+      os.remove(self.target_file)
+
+  def _export(self, exporter, export_filter=None, cancel_fn=None):
+    if export_filter is None:
+      export_filter = ExportFilter(0, 1000)
+    progress = []
+    ExportConsts.BATCH_ROWS = 2
+    result = exportImages(self.dm.cursor, self.target_file, exporter, export_filter,
+                          lambda done, total: progress.append((done, total)), cancel_fn)
+    return result, progress
+
+  def testCSV(self):
+    self.assertEqual((True, [(2, 4), (4, 4)]), self._export(CSVExporter()))
+    with open(self.target_file, "rb") as f:
+      rows = list(csv.reader(f))
+    self.assertEqual(CSVExporter.headers, rows[0])
+    self.assertEqual(5, len(rows))
+    self.assertEqual(u"c:\\photos\\\u00e9t\u00e9 \"100\".jpg", rows[1][0].decode("utf-8"))
+    self.assertEqual("11.0", rows[1][4])
+
+  def testGeoJSONInRect(self):
+    self._export(GeoJSONExporter(), ExportFilter(0, 1000, model.Rect(0, 30, 0, 30)))
+    with open(self.target_file, "rb") as f:
+      features = json.load(f)["features"]
+    self.assertEqual([[21.0, 11.0], [20.0, 10.0]], [x["geometry"]["coordinates"] for x in features])
+
+  def testGPX(self):
+    from xml.dom import minidom
+    self._export(GPXExporter(), ExportFilter(150, 1000))
+    points = minidom.parse(self.target_file).getElementsByTagName("trkpt")
+    self.assertEqual(["10.0", "50.0"], [x.getAttribute("lat") for x in points])
+
+  def testDateFormatters(self):
+    for seconds in [0, 59, 3600 * 25 + 61, -1, 1400000000]:
+      self.assertEqual(model.secondsToDateTimeString(seconds), _makeDateTimeStringFormatter()(seconds))
+      self.assertEqual(model.secondsToDate(seconds).strftime("%Y-%m-%dT%H:%M:%SZ"), _makeIsoTimeFormatter()(seconds))
+
+  def testCancel(self):
+    self.assertEqual((False, []), self._export(CSVExporter(), cancel_fn=lambda: True))
+    self.assertFalse(os.path.exists(self.target_file))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -12,6 +12,13 @@ def getIconFilePath():
   icon_file = os.path.join(getApplicationPath(), 'camera_pin_icon.ico')
   return icon_file
 
+def getTileCacheFilePath():
+  "Return path to the map tile cache, kept in the current users local application data directory"
+  app_data_dir = os.path.join(shell.SHGetFolderPath(0, shellcon.CSIDL_LOCAL_APPDATA, None, 0), "PhotoTrailMapper")
+  if not os.path.exists(app_data_dir):
+    os.makedirs(app_data_dir)
+  return os.path.join(app_data_dir, "map_tiles.mbtiles")
+
 def getDefaultSaveFolder():
   "Return default folder to save things into"
   return os.getenv('HOME')
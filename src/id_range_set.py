@@ -0,0 +1,137 @@
+"""Set of image id's held as sorted ranges so selecting tens of thousands of images stays small and fast"""
+import bisect
+import unittest
+
+class IDRangeSet(object):
+  """Set of integer id's stored as sorted, disjoint, non touching ranges [start, end).
+  Membership is a binary search over the ranges, and consecutive id's, as images scanned together have, cost one range"""
+
+  def __init__(self):
+    self._starts = []
+    self._ends = []  # parallel to _starts, exclusive
+    self._count = 0
+
+  @classmethod
+  def fromIds(cls, ids):
+    "Return a set holding the id's of any iterable"
+    id_set = cls()
+    id_set.addSortedIds(sorted(ids))
+    return id_set
+
+  def __len__(self):
+    return self._count
+
+  def __contains__(self, image_id):
+    i = bisect.bisect_right(self._starts, image_id) - 1
+    return i >= 0 and image_id < self._ends[i]
+
+  def __iter__(self):
+    for start, end in zip(self._starts, self._ends):
+      for image_id in xrange(start, end):
+        yield image_id
+
+  def iterRanges(self):
+    "Iterate over the (start, end) ranges in order, end is exclusive"
+    return iter(zip(self._starts, self._ends))
+
+  def getRangeCount(self):
+    return len(self._starts)
+
+  def add(self, image_id):
+    self.addRange(image_id, image_id + 1)
+
+  def remove(self, image_id):
+    self.removeRange(image_id, image_id + 1)
+
+  def toggle(self, image_id):
+    "Add the id if it is not in the set, otherwise remove it"
+    if image_id in self:
+      self.remove(image_id)
+    else:
+      self.add(image_id)
+
+  def clear(self):
+    self._starts = []
+    self._ends = []
+    self._count = 0
+
+  def addRange(self, start, end):
+    "Add every id from start up to but not including end"
+    if start >= end:
+      return
+    #ranges that overlap or touch [start, end) are merged with it
+    lo = bisect.bisect_left(self._ends, start)
+    hi = bisect.bisect_right(self._starts, end)
+    if lo < hi:
+      start = min(start, self._starts[lo])
+      end = max(end, self._ends[hi - 1])
+      self._count -= sum(e - s for s, e in zip(self._starts[lo:hi], self._ends[lo:hi]))
+    self._starts[lo:hi] = [start]
+    self._ends[lo:hi] = [end]
+    self._count += end - start
+
+  def removeRange(self, start, end):
+    "Remove every id from start up to but not including end"
+    if start >= end:
+      return
+    lo = bisect.bisect_right(self._ends, start)
+    hi = bisect.bisect_left(self._starts, end)
+    if lo >= hi:
+      return
+    self._count -= sum(e - s for s, e in zip(self._starts[lo:hi], self._ends[lo:hi]))
+    #keep the parts of the first and last ranges outside [start, end)
+    kept_starts = []
+    kept_ends = []
+    if self._starts[lo] < start:
+      kept_starts.append(self._starts[lo])
+      kept_ends.append(start)
+    if self._ends[hi - 1] > end:
+      kept_starts.append(end)
+      kept_ends.append(self._ends[hi - 1])
+    self._count += sum(e - s for s, e in zip(kept_starts, kept_ends))
+    self._starts[lo:hi] = kept_starts
+    self._ends[lo:hi] = kept_ends
+
+  def addSortedIds(self, ids):
+    "Add id's from an iterable in ascending order, e.g. a database cursor, without holding them all in memory"
+    run_start = run_end = None
+    for image_id in ids:
+      if run_end is not None and image_id == run_end:
+        run_end += 1
+        continue
+      if run_start is not None:
+        self.addRange(run_start, run_end)
+      run_start, run_end = image_id, image_id + 1
+    if run_start is not None:
+      self.addRange(run_start, run_end)
+
+
+class TestIDRangeSet(unittest.TestCase):
+
+  def testAddRemove(self):
+    ids = IDRangeSet()
+    ids.addSortedIds([1, 2, 3, 7, 8, 10])
+    self.assertEqual([(1, 4), (7, 9), (10, 11)], list(ids.iterRanges()))
+    self.assertEqual(6, len(ids))
+    self.assertTrue(8 in ids)
+    self.assertFalse(9 in ids)
+    ids.add(9)
+    self.assertEqual([(1, 4), (7, 11)], list(ids.iterRanges()))
+    ids.removeRange(2, 8)
+    self.assertEqual([(1, 2), (8, 11)], list(ids.iterRanges()))
+    self.assertEqual([1, 8, 9, 10], list(ids))
+    ids.toggle(1)
+    ids.toggle(20)
+    self.assertEqual([8, 9, 10, 20], list(ids))
+    self.assertEqual(4, len(ids))
+
+  def testFromIds(self):
+    ids = IDRangeSet.fromIds([5, 3, 4, 100])
+    self.assertEqual([(3, 6), (100, 101)], list(ids.iterRanges()))
+    ids.addRange(0, 200)
+    self.assertEqual(1, ids.getRangeCount())
+    self.assertEqual(200, len(ids))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,204 @@
+"""Optional in memory columnar copy of the image positions and dates.
+If numpy is not installed the snapshot is simply not available and the
+callers fall back on the database queries in model"""
+import threading
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def isSnapshotAvailable():
+  "Return True if numpy is installed so a snapshot can be built"
+  return numpy is not None
+
+def _locked(method):
+  "Decorator holding the snapshot's lock for the duration of the call"
+  def lockedMethod(self, *args, **kwargs):
+    with self._lock:
+      return method(self, *args, **kwargs)
+  lockedMethod.__name__ = method.__name__
+  lockedMethod.__doc__ = method.__doc__
+  return lockedMethod
+
+class ImageSnapshot(object):
+  """Columnar snapshot of (image_id, latitude, longitude, taken_date, geo_type) for every image.
+  Rows are held in contiguous numpy arrays sorted by taken_date, so a time window is a slice found by
+  binary search and a rect is a vectorised mask over that slice.
+  Dates are in seconds from 1st Jan 1970 as stored in the database, missing values are NaN"""
+
+  _sql = "SELECT image_id, latitude, longitude, taken_date, geo_type FROM Image ORDER BY taken_date;"
+
+  def __init__(self, rows=None):
+    """rows is an optional list of (image_id, latitude, longitude, taken_date, geo_type), need not be sorted"""
+    if numpy is None:
+      raise RuntimeError("numpy is required for an ImageSnapshot")
+    self._pending_rows = []  # rows appended since the arrays were last built
+    self._lock = threading.RLock()  # patched on the gui thread while map markers are worked out on a worker
+    self._setRows(rows if rows is not None else [])
+
+  @classmethod
+  def loadFromCursor(cls, cursor):
+    "Build a snapshot of all the images in the database"
+    cursor.execute(cls._sql)
+    return cls(cursor.fetchall())
+
+  def _setRows(self, rows):
+    table = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), 5)  # None becomes NaN
+    order = numpy.argsort(table[:, 3], kind="mergesort")  # NaN dates sort to the end
+    table = table[order]
+    self.image_ids = numpy.ascontiguousarray(table[:, 0], dtype=numpy.int64)
+    self.latitudes = numpy.ascontiguousarray(table[:, 1])
+    self.longitudes = numpy.ascontiguousarray(table[:, 2])
+    self.taken_dates = numpy.ascontiguousarray(table[:, 3])
+    self.geo_types = numpy.ascontiguousarray(table[:, 4])
+
+  def _mergePending(self):
+    "Fold any appended rows into the sorted arrays"
+    if len(self._pending_rows) == 0:
+      return
+    rows = zip(self.image_ids.tolist(), self.latitudes.tolist(), self.longitudes.tolist(), self.taken_dates.tolist(), self.geo_types.tolist())
+    rows.extend(self._pending_rows)
+    self._pending_rows = []
+    self._setRows(rows)
+
+  def __len__(self):
+    return len(self.image_ids) + len(self._pending_rows)
+
+  @_locked
+  def appendImage(self, image_id, latitude, longitude, taken_date, geo_type):
+    "Add a newly inserted image, taken_date in seconds. The arrays are rebuilt lazily on the next query"
+    self._pending_rows.append((image_id, latitude, longitude, taken_date, geo_type))
+
+  @_locked
+  def setPositionOnImages(self, id_ranges, longitude, latitude, geo_type):
+    """Patch the positions of images in place to match DBManager.setPositionOnImages.
+    id_ranges is a list of sorted, disjoint (start, end) image id ranges, end exclusive, see id_range_set.IDRangeSet"""
+    self._mergePending()
+    if len(id_ranges) == 0:
+      return
+    starts = numpy.asarray([r[0] for r in id_ranges], dtype=numpy.int64)
+    ends = numpy.asarray([r[1] for r in id_ranges], dtype=numpy.int64)
+    #find the range starting at or before each image and see if the image is before it ends
+    range_index = numpy.searchsorted(starts, self.image_ids, side="right") - 1
+    rows = (range_index >= 0) & (self.image_ids < ends[numpy.maximum(range_index, 0)])
+    self.latitudes[rows] = latitude
+    self.longitudes[rows] = longitude
+    self.geo_types[rows] = geo_type
+
+  def _timeSlice(self, start_seconds, end_seconds):
+    "Return the slice of rows with start_seconds <= taken_date <= end_seconds"
+    self._mergePending()
+    lo = numpy.searchsorted(self.taken_dates, start_seconds, side="left")
+    hi = numpy.searchsorted(self.taken_dates, end_seconds, side="right")
+    return slice(lo, hi)
+
+  def _areaMask(self, time_slice, min_lat, max_lat, min_lng, max_lng):
+    lats = self.latitudes[time_slice]
+    lngs = self.longitudes[time_slice]
+    with numpy.errstate(invalid="ignore"):  # images with no position are NaN and never match
+      return (lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng)
+
+  @_locked
+  def getImageCountInArea(self, start_seconds, end_seconds, min_lat, max_lat, min_lng, max_lng):
+    "Return the number of images in the rect taken between the given times"
+    time_slice = self._timeSlice(start_seconds, end_seconds)
+    return int(numpy.count_nonzero(self._areaMask(time_slice, min_lat, max_lat, min_lng, max_lng)))
+
+  @_locked
+  def getImagesIDsInArea(self, start_seconds, end_seconds, min_lat, max_lat, min_lng, max_lng, limit=None):
+    "return a list of [image id's] in the area"
+    time_slice = self._timeSlice(start_seconds, end_seconds)
+    ids = self.image_ids[time_slice][self._areaMask(time_slice, min_lat, max_lat, min_lng, max_lng)]
+    if limit is not None:
+      ids = ids[:limit]
+    return ids.tolist()
+
+  @_locked
+  def getImageGridInArea(self, start_seconds, end_seconds, min_lat, max_lat, min_lng, max_lng, cell_lat, cell_lng):
+    """Group the images in the area into a grid of cells of cell_lat by cell_lng degrees anchored at min_lat, min_lng.
+    Returns a list of (count, average latitude, average longitude, [image id's]) for each occupied cell in one pass"""
+    time_slice = self._timeSlice(start_seconds, end_seconds)
+    mask = self._areaMask(time_slice, min_lat, max_lat, min_lng, max_lng)
+    ids = self.image_ids[time_slice][mask]
+    if len(ids) == 0:
+      return []
+    lats = self.latitudes[time_slice][mask]
+    lngs = self.longitudes[time_slice][mask]
+    lat_index = ((lats - min_lat) / cell_lat).astype(numpy.int64)
+    lng_index = ((lngs - min_lng) / cell_lng).astype(numpy.int64)
+    cell_keys = lat_index * (lng_index.max() + 1) + lng_index
+    #sort by cell so each cell's ids are one contiguous run
+    order = numpy.argsort(cell_keys, kind="mergesort")
+    unique_keys, starts, counts = numpy.unique(cell_keys[order], return_index=True, return_counts=True)
+    lat_sums = numpy.add.reduceat(lats[order], starts)
+    lng_sums = numpy.add.reduceat(lngs[order], starts)
+    sorted_ids = ids[order]
+    return [(int(count), float(lat_sum / count), float(lng_sum / count), sorted_ids[start:start + count].tolist())
+            for start, count, lat_sum, lng_sum in zip(starts, counts, lat_sums, lng_sums)]
+
+  @_locked
+  def getImagesOutsideAreaBetween(self, start_seconds, end_seconds, min_lat, max_lat, min_lng, max_lng):
+    """Return a list of (taken_date, longitude, latitude, image_id) in taken_date order for every located image
+    outside the rect taken between the given times"""
+    time_slice = self._timeSlice(start_seconds, end_seconds)
+    lats = self.latitudes[time_slice]
+    lngs = self.longitudes[time_slice]
+    outside = ~numpy.isnan(lats) & ~numpy.isnan(lngs) & ~self._areaMask(time_slice, min_lat, max_lat, min_lng, max_lng)
+    return zip(self.taken_dates[time_slice][outside].tolist(), lngs[outside].tolist(), lats[outside].tolist(),
+               self.image_ids[time_slice][outside].tolist())
+
+  @_locked
+  def getLatLngRectContainingImagesBetween(self, start_seconds, end_seconds):
+    "Return (min lat, max lat, min lng, max lng) of images taken between the times, all None if there are none"
+    time_slice = self._timeSlice(start_seconds, end_seconds)
+    located = ~numpy.isnan(self.latitudes[time_slice]) & ~numpy.isnan(self.longitudes[time_slice])
+    if not located.any():
+      return (None, None, None, None)
+    lats = self.latitudes[time_slice][located]
+    lngs = self.longitudes[time_slice][located]
+    return (float(lats.min()), float(lats.max()), float(lngs.min()), float(lngs.max()))
+
+  @_locked
+  def getMinMaxTimesFromImagesInArea(self, min_lat, max_lat, min_lng, max_lng):
+    "Return the tuple of (min taken_date, max taken_date) in seconds for images in the area or None"
+    everything = self._timeSlice(-numpy.inf, numpy.inf)
+    dates = self.taken_dates[everything][self._areaMask(everything, min_lat, max_lat, min_lng, max_lng)]
+    dates = dates[~numpy.isnan(dates)]
+    if len(dates) == 0:
+      return None
+    #dates are sorted
+    return (float(dates[0]), float(dates[-1]))
+
+
+class TestImageSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    if numpy is None:
+      self.skipTest("numpy not installed")
+    # image_id, latitude, longitude, taken_date, geo_type
+    self.snapshot = ImageSnapshot([(1, 10.0, 20.0, 300, 0),
+                                   (2, 11.0, 21.0, 100, 1),
+                                   (3, None, None, 200, 1),
+                                   (4, 50.0, 60.0, 400, 0)])
+
+  def testQueries(self):
+    self.assertEqual(2, self.snapshot.getImageCountInArea(0, 1000, 0, 20, 0, 30))
+    self.assertEqual([2], self.snapshot.getImagesIDsInArea(0, 200, 0, 20, 0, 30))
+    self.assertEqual((10.0, 50.0, 20.0, 60.0), self.snapshot.getLatLngRectContainingImagesBetween(0, 1000))
+    self.assertEqual((100.0, 300.0), self.snapshot.getMinMaxTimesFromImagesInArea(0, 20, 0, 30))
+    self.assertEqual([(400.0, 60.0, 50.0, 4)], self.snapshot.getImagesOutsideAreaBetween(0, 1000, 0, 20, 0, 30))
+
+  def testGrid(self):
+    grid = sorted(self.snapshot.getImageGridInArea(0, 1000, 0, 60, 0, 70, 5, 5))
+    self.assertEqual([(1, 50.0, 60.0, [4]), (2, 10.5, 20.5, [2, 1])], grid)
+
+  def testPatching(self):
+    self.snapshot.appendImage(5, 10.5, 20.5, 250, 0)
+    self.snapshot.setPositionOnImages([(3, 5)], 20.0, 10.0, 1)
+    self.assertEqual([2, 3, 5, 1, 4], self.snapshot.getImagesIDsInArea(0, 1000, 0, 20, 0, 30))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,18 +1,19 @@
 var max_map_img_dimension = 75.0; //size of images displayed on map
 var popup_img_width = 150; //size of images displayed in popup dialogs on maps..
+var badge_img_dimension = 30; //natural width of the pin/compass badge drawn over marker thumbnails
 var popup_options = {"autoPan" : false};
 //map
 var map = null
-//list of all map markers present
-var map_marker_list = [];
-//cache images in here to ensure not garbage collected during asynchronous calls
-var loading_images = {};
+//map of marker id to each map marker present, null while the marker's image is loading
+var map_markers = {};
+//marker data of markers waiting for their image to load, by marker id
+var loading_markers = {};
 //width of arrows on lines in pixels
 var arrowWidthPx = 10;
 //width of arrows on lines in pixels
 var arrowLengthPx = 20;
-//list of all current arrow polylines
-var arrowLineList = [];
+//map of arrow id to the polyline and direction arrow drawn for it
+var arrow_layers = {};
 
 var layer_opacity = 0.6;
 var layer_colour = "orange";
@@ -105,22 +106,55 @@ function combineGeoRect( rect1, rect2 ){
 	return merge;
 }
 
-function createImageMarker(img_src,img_width,img_height){
+/**
+ * Icon showing the thumbnail with a badge image drawn over its top left corner.
+ * The shadow is still created by L.Icon so the picture border is kept
+ */
+var BadgedImageIcon = L.Icon.extend({
+	createIcon: function(){
+		var div = document.createElement("div");
+		
+		var img = document.createElement("img");
+		img.src = this.options.iconUrl;
+		img.className = "marker-thumbnail";
+		div.appendChild(img);
+		
+		var badge = document.createElement("img");
+		badge.src = this.options.badgeUrl;
+		badge.className = "marker-badge";
+		badge.style.width = this.options.badgeSize + "px";
+		div.appendChild(badge);
+		
+		this._setIconStyles(div, "icon");
+		return div;
+	}
+});
+
+/**Url of the badge showing whether a marker can be dragged, pin if it can or compass if the position came from the photo*/
+function markerBadgeUrl(draggable){
+	return resource_dir + (draggable ? 'images/pin.png' : 'images/compass.png');
+}
+
+function createImageMarker(img_src,img_width,img_height,draggable,badge_size){
 	//using shadow to frame the image...
-	return L.icon({
+	return new BadgedImageIcon({
 		iconUrl: img_src,
 	    iconSize: [img_width, img_height],
 	    shadowUrl: resource_dir + 'images/picture_border.png',
-	    shadowSize: [img_width + 2, img_height + 2]
+	    shadowSize: [img_width + 2, img_height + 2],
+	    badgeUrl: markerBadgeUrl(draggable),
+	    badgeSize: badge_size
 	});
 }
 
-function createMultipleImageMarker(img_src,img_width,img_height){
-	return L.icon({
+function createMultipleImageMarker(img_src,img_width,img_height,draggable,badge_size){
+	return new BadgedImageIcon({
 		iconUrl: img_src,
 	    iconSize: [img_width, img_height],
 	    shadowUrl: resource_dir + 'images/multiple_picture_border.png',
-	    shadowSize: [img_width + 15, img_height + 15]
+	    shadowSize: [img_width + 15, img_height + 15],
+	    badgeUrl: markerBadgeUrl(draggable),
+	    badgeSize: badge_size
 	});
 }
 
@@ -131,10 +165,10 @@ function createMap(){
   $("#mapcontainer").append("<div id='map'></div>");
   map = L.map('map').setView([51.505, -0.09], 13);
 
-  var mapquestUrl = 'http://{s}.mqcdn.com/tiles/1.0.0/osm/{z}/{x}/{y}.png';
-  var subDomains = ['otile1','otile2','otile3','otile4'];
+  //tiles come through the local tile cache, which downloads them from mapquest the first time
+  var tileUrl = 'tile://{z}/{x}/{y}.png';
   var mapquestAttrib = 'Data, imagery and map information provided by <a href="http://open.mapquest.co.uk" target="_blank">MapQuest</a>,<a href="http://www.openstreetmap.org/" target="_blank">OpenStreetMap</a> and contributors.';
-  var tiles = new L.TileLayer(mapquestUrl, {maxZoom: 18, attribution: mapquestAttrib, subdomains: subDomains});
+  var tiles = new L.TileLayer(tileUrl, {maxZoom: 18, attribution: mapquestAttrib});
   
   var london = new L.LatLng(51.505, -0.09); // geographical point (Longitude
                       // and Latitude)
@@ -186,7 +220,9 @@ function startMapNonTableMarkerUpdate(){
 function clearMap(){
 	$("#map").remove();
 	map = null;
-	map_marker_list = [];
+	map_markers = {};
+	loading_markers = {};
+	arrow_layers = {};
 }
 
 function setMapPosition(centre_lat, centre_lng, zoom){
@@ -197,10 +233,11 @@ function panMapTo(centre_lat, centre_lng){
 	map.panTo(new L.LatLng(centre_lat, centre_lng));
 }
 
+/**Draw an arrow on the map returning the list of layers making it up*/
 function plotArrow(start_lat_lng, end_lat_lng)
 {
 	var polyline = L.polyline([start_lat_lng, end_lat_lng], {color: layer_colour, opacity:layer_opacity}).addTo(map);
-	arrowLineList.push(polyline);
+	var layers = [polyline];
 	
 	//draw direction arrow on the line
 	//going to work in pixels as this is much more straightforward
@@ -211,7 +248,7 @@ function plotArrow(start_lat_lng, end_lat_lng)
     var vector_y = (end_px_pt.y - start_px_pt.y);
     
     if( vector_x == 0 && vector_y == 0 ){
-    	return; //abort, zero length line....
+    	return layers; //abort, zero length line....
     }
     
     //calculate normalised vector along the direction of the line
@@ -239,46 +276,72 @@ function plotArrow(start_lat_lng, end_lat_lng)
                         								backArrowPtY - ( arrowWidthPx * rghtanglLine_y / 2)))];
     
     var arrow_poly = L.polygon(triangle_pts, {color: layer_colour, fillColor : layer_colour, fill: true, fillOpacity:layer_opacity, opacity:layer_opacity}).addTo(map);
-    arrowLineList.push(arrow_poly);
+    layers.push(arrow_poly);
+    return layers;
 }
 
-function setMapMarkers(marker_data_list, arrow_list){
-	//plot arrows first
-	clearArrowList();
-	arrow_list = eval(arrow_list)
-	$.each(arrow_list, function(index, arrow){
-		//(start_lng, start_lat), (end_lng, end_lat)
+/**
+ * Called by the server with only what has changed since the last call, so markers and arrows that are still
+ * wanted are left alone rather than being removed and created again.
+ * removed_marker_ids list of marker ids to take off the map, a marker being replaced is removed then added
+ * added_marker_data_list list of marker data for new markers
+ * moved_marker_list list of {marker_id, lat, lng} for markers that only changed position
+ * removed_arrow_ids list of arrow ids to take off the map
+ * added_arrow_list list of [arrow_id, [[start_lng, start_lat], [end_lng, end_lat]]]
+ */
+function applyMapMarkerChanges(removed_marker_ids, added_marker_data_list, moved_marker_list, removed_arrow_ids, added_arrow_list){
+	$.each(removed_arrow_ids, function(index, arrow_id){
+		removeArrow(arrow_id);
+	});
+	
+	$.each(added_arrow_list, function(index, arrow_id_and_arrow){
+		var arrow = arrow_id_and_arrow[1];
 		var start = L.latLng(arrow[0][1], arrow[0][0]);
 		var end = L.latLng(arrow[1][1], arrow[1][0]);
-		plotArrow(start,end);
+		arrow_layers[arrow_id_and_arrow[0]] = plotArrow(start,end);
 	});
 	
+	$.each(removed_marker_ids, function(index, marker_id){
+		removeMapMarker(marker_id);
+	});
 	
-	marker_data_list = eval(marker_data_list);
-	
-	clearMapMarkers();
-	
-	$.each(marker_data_list, function(index, marker_data){
-		plotMapMarker(marker_data.image_id_list, marker_data.lat, marker_data.lng, marker_data.draggable, marker_data.thumbnail);
+	$.each(moved_marker_list, function(index, moved){
+		moveMapMarker(moved.marker_id, moved.lat, moved.lng);
 	});
 	
+	$.each(added_marker_data_list, function(index, marker_data){
+		plotMapMarker(marker_data.marker_id, marker_data.image_count, marker_data.lat, marker_data.lng, marker_data.draggable, thumbnail_src(marker_data));
+	});
 }
 
-function clearArrowList(){
-	$.each(arrowLineList, function(index, polyline){
-		map.removeLayer(polyline);
-	});
-	
-	arrowLineList = [];
+function removeArrow(arrow_id){
+	if(arrow_id in arrow_layers){
+		$.each(arrow_layers[arrow_id], function(index, layer){
+			map.removeLayer(layer);
+		});
+		delete arrow_layers[arrow_id];
+	}
 }
 
-function clearMapMarkers(){
-	
-	$.each(map_marker_list, function(index,marker){
-		map.removeLayer(marker);
-	});
-	
-	map_marker_list = [];
+function removeMapMarker(marker_id){
+	if(marker_id in map_markers){
+		if(map_markers[marker_id] !== null){
+			map.removeLayer(map_markers[marker_id]);
+		}
+		delete map_markers[marker_id];
+	}
+	delete loading_markers[marker_id];
+}
+
+function moveMapMarker(marker_id, lat, lng){
+	if(marker_id in loading_markers){
+		//not plotted yet so just change where it will go
+		loading_markers[marker_id].lat = lat;
+		loading_markers[marker_id].lng = lng;
+	}
+	else if(marker_id in map_markers && map_markers[marker_id] !== null){
+		map_markers[marker_id].setLatLng([lat,lng]);
+	}
 }
 
 function format_filename(fn){
@@ -345,7 +408,21 @@ function base64_img_src(base64){
 	return 'data:image/jpeg;base64,' + base64;
 }
 
-function base64_img(base64, opts){
+/*
+ * Return the src to show the thumbnail of marker or image data, loaded from its
+ * thumbnail_url if it has one so the browser can cache it, otherwise from its base64 data.
+ */
+function thumbnail_src(data){
+	if(data.thumbnail_url){
+		return data.thumbnail_url;
+	}
+	if(data.thumbnail){
+		return base64_img_src(data.thumbnail);
+	}
+	return "";
+}
+
+function thumbnail_img(data, opts){
 	var width;
 	
 	if( opts == null ){
@@ -355,28 +432,39 @@ function base64_img(base64, opts){
 		width = opts.width;
 	}
 	
-	if(base64 !== ""){
-		return "<img src='" + base64_img_src(base64) + "' width='" + width + "' alt='thumbnail'></img>";
+	var src = thumbnail_src(data);
+	if(src !== ""){
+		return "<img src='" + src + "' width='" + width + "' alt='thumbnail'></img>";
 	}else{
 		return "";
 	}
 }
 
 
-function plotMapMarker(image_id_list, lat, lng, draggable, icon_base64){
-	if( lng !== null && lat !== null && image_id_list.length > 0){
+/**
+ * The map only knows how many images a marker has, the id's are asked for when the marker is clicked or dragged.
+ * A single image marker's id is the image's id
+ */
+function plotMapMarker(marker_id, image_count, lat, lng, draggable, icon_src){
+	if( lng !== null && lat !== null && image_count > 0){
 		//first load the image so we can know it dimensions and most importantly
 		//it's aspect ratio
+		var marker_data = {"lat":lat, "lng":lng};
+		map_markers[marker_id] = null;
+		loading_markers[marker_id] = marker_data;
 		var img = new Image();
-		img.onload = function(){ plotMapMarkerWithKnownImage(image_id_list, lat, lng, icon_base64, draggable, this);};
-		img.src = base64_img_src(icon_base64);
-		loading_images[img] = true; //make sure not garbage collected
+		img.onload = function(){
+			//the marker may have been removed or replaced while loading
+			if(loading_markers[marker_id] === marker_data){
+				delete loading_markers[marker_id];
+				plotMapMarkerWithKnownImage(marker_id, image_count, marker_data.lat, marker_data.lng, icon_src, draggable, this);
+			}
+		};
+		img.src = icon_src;
 	}
 }
 
-function plotMapMarkerWithKnownImage(image_id_list, lat, lng, icon_base64, draggable, loaded_image){
-	delete loading_images[loaded_image];
-	
+function plotMapMarkerWithKnownImage(marker_id, image_count, lat, lng, icon_src, draggable, loaded_image){
 	var latlng = new L.LatLng(lat,lng);
 	var nat_height = loaded_image.naturalHeight;
 	var nat_width = loaded_image.naturalWidth;
@@ -392,51 +480,61 @@ function plotMapMarkerWithKnownImage(image_id_list, lat, lng, icon_base64, dragg
 	
 	var scaled_width = Math.round(nat_width * scaler);
 	var scaled_height = Math.round(nat_height * scaler);
+	//badge is scaled with the thumbnail so it looks as it would painted onto the full size thumbnail
+	var badge_size = Math.round(badge_img_dimension * scaler);
 	
 	var icon;
-	if(image_id_list.length == 1){
-		icon = createImageMarker(base64_img_src(icon_base64), scaled_width, scaled_height);
+	if(image_count == 1){
+		icon = createImageMarker(icon_src, scaled_width, scaled_height, draggable, badge_size);
 	}
 	else{
-		icon = createMultipleImageMarker(base64_img_src(icon_base64), scaled_width, scaled_height);
+		icon = createMultipleImageMarker(icon_src, scaled_width, scaled_height, draggable, badge_size);
 	}
 	
 	var marker = L.marker([lat,lng],{"icon":icon, "draggable":draggable});
 	
-	marker.image_id_list = image_id_list; //record the id list associated with the marker
-	map_marker_list.push(marker);
+	marker.image_count = image_count;
+	marker.image_id_list = image_count == 1 ? [marker_id] : []; //the id list associated with the marker, filled in when clicked
+	map_markers[marker_id] = marker;
 	
 	// is it a single marker here?
-	if(image_id_list.length == 1){
-		marker.on("click", function(e){onSingleMarkerClick(e.target, image_id_list[0]);});
+	if(image_count == 1){
+		marker.on("click", function(e){onSingleMarkerClick(marker_id, marker_id);});
 	}
 	else{
-		marker.on("click", function(e){onMultipleMarkerClick(e.target, image_id_list);});
+		marker.on("click", function(e){onMultipleMarkerClick(marker_id);});
 	}
 	
 	//connect to drag event
 	if(draggable){
-		marker.on("dragend", function(e){onMarkerDragged(e.target, image_id_list);});
+		marker.on("dragend", function(e){onMarkerDragged(marker_id, e.target);});
 	}
 	
 	marker.addTo(map);
 }
 
 function image_popup_html(image_data){
-	return "<div>" + base64_img_src(image_data.thumbnail) + "</div>" + 
+	return "<div>" + thumbnail_src(image_data) + "</div>" + 
 	        "<div>" + format_filename(image_data.filename) + "</div>" +
 	        "<div>" + format_taken_data(image_data.taken_date_type, image_data.taken_date) + "</div>";
 }
 
-function onSingleMarkerClick(marker, image_id){
-	var marker_index = map_marker_list.indexOf(marker);	
-	var params = {"callback": "onSingleMarkerClickInfo", "curried": marker_index, "image_id": image_id};
+/**Return the plotted marker with the given id or null if there isn't one*/
+function getMapMarker(marker_id){
+	if(marker_id in map_markers){
+		return map_markers[marker_id];
+	}
+	return null;
+}
+
+function onSingleMarkerClick(marker_id, image_id){
+	var params = {"callback": "onSingleMarkerClickInfo", "curried": marker_id, "image_id": image_id};
 	call_server("getImageData", params);
 }
 
-function onSingleMarkerClickInfo(marker_index, image_data){
-	if( marker_index >= 0 && marker_index < map_marker_list.length){
-		var marker = map_marker_list[marker_index];
+function onSingleMarkerClickInfo(marker_id, image_data){
+	var marker = getMapMarker(marker_id);
+	if( marker !== null ){
 		marker.unbindPopup();
 		var popup = image_popup_html(image_data);
 		marker.bindPopup(popup, popup_options).openPopup();
@@ -446,104 +544,115 @@ function onSingleMarkerClickInfo(marker_index, image_data){
 }
 
 function image_popup_html(image_data){
-	return "<div>" + base64_img(image_data.thumbnail, {"width":popup_img_width}) + "</div>" + 
+	return "<div>" + thumbnail_img(image_data, {"width":popup_img_width}) + "</div>" + 
 	        "<div>" + format_filename(image_data.filename) + "</div>" +
 	        "<div>" + format_taken_data(image_data.taken_date_type, image_data.taken_date) + "</div>";
 }
 
-function onMultipleMarkerClick(marker, image_id_list){
+function onMultipleMarkerClick(marker_id){
+	// the server looks up the marker's images
+	var params = {"callback": "onMultipleMarkerImageIds", "curried": marker_id, "marker_id": marker_id};
+	call_server("getMarkerImageIds", params);
+}
+
+function onMultipleMarkerImageIds(marker_id, image_id_list){
+	if( getMapMarker(marker_id) === null || image_id_list.length == 0 ){
+		return; //removed from the map since the ids were asked for
+	}
 	// lazy load one image at a time
-	var marker_index = map_marker_list.indexOf(marker);
 	var params = {"callback": "onMultipleMarkerClickInfo", 
-			      "curried": {"marker_index":marker_index,"image_id_list":image_id_list}, 
+			      "curried": {"marker_id":marker_id,"image_id_list":image_id_list}, 
 				  "image_id": image_id_list[0]};
 	call_server("getImageData", params);
 }
 
-function onMarkerDragged(marker, image_id_list){
+function onMarkerDragged(marker_id, marker){
 	//tell server the images have been used
-	var params = {"image_id_list": image_id_list,
+	var params = {"marker_id": marker_id,
 			      "latitude": marker.getLatLng().lat,
 			      "longitude": marker.getLatLng().lng};
 	call_server("imagesDragged", params);
 }
 
-function createPrevImageDiv(marker_index){
-	var marker = map_marker_list[marker_index];
+function createPrevImageDiv(marker_id){
+	var marker = map_markers[marker_id];
 	var isFirst = marker.current_image_index == 0;
 	
 	if( ! isFirst ){
-		return "<div class='prevImage'><a onclick='prevImage(" + marker_index + ");'><img src='images/media-seek-backward.png' alt='Prev Image'></img></a></div>";
+		return "<div class='prevImage'><a onclick='prevImage(" + marker_id + ");'><img src='images/media-seek-backward.png' alt='Prev Image'></img></a></div>";
 	}
 	else{
 		return "";
 	}
 }
 
-function createNextImageDiv(marker_index){
-	var marker = map_marker_list[marker_index];
+function createNextImageDiv(marker_id){
+	var marker = map_markers[marker_id];
 	var isLast = marker.current_image_index == marker.image_id_list.length - 1;
 	
 	if( !isLast ){
-		return "<div class='nextImage'><a onclick='nextImage(" + marker_index + ");'><img src='images/media-seek-forward.png' alt='Next Image'></img></a></div>";
+		return "<div class='nextImage'><a onclick='nextImage(" + marker_id + ");'><img src='images/media-seek-forward.png' alt='Next Image'></img></a></div>";
 	}
 	else{
 		return "";
 	}
 }
 
-function prevImage(marker_index){
-	var marker = map_marker_list[marker_index];
+function prevImage(marker_id){
+	var marker = map_markers[marker_id];
 	marker.current_image_index = marker.current_image_index - 1;
 	var params = {"callback": "onPopupImageImgData", 
-		      "curried": {"marker_index":marker_index}, 
+		      "curried": {"marker_id":marker_id}, 
 			  "image_id": marker.image_id_list[marker.current_image_index]};
 	call_server("getImageData", params);
 }
 
-function nextImage(marker_index){
-	var marker = map_marker_list[marker_index];
+function nextImage(marker_id){
+	var marker = map_markers[marker_id];
 	marker.current_image_index = marker.current_image_index+1;
 	var params = {"callback": "onPopupImageImgData", 
-		      "curried": {"marker_index":marker_index}, 
+		      "curried": {"marker_id":marker_id}, 
 			  "image_id": marker.image_id_list[marker.current_image_index]};
 	call_server("getImageData", params);
 }
 
 function onPopupImageImgData(curried, image_data){
-	var marker_index = curried.marker_index;
-	$("#marker_" + marker_index).html(createMultiplePopupContent(marker_index,image_data));
-	var marker = map_marker_list[marker_index];
+	var marker_id = curried.marker_id;
+	var marker = getMapMarker(marker_id);
+	if( marker === null ){
+		return; //removed from the map since the image was asked for
+	}
+	$("#marker_" + marker_id).html(createMultiplePopupContent(marker_id,image_data));
 	clearHighlightedImageRows();
 	highlightImageRow(marker.image_id_list[marker.current_image_index]);	
 }
 
-function createMultiplePopupContent(marker_index,image_data){	
-	var marker = map_marker_list[marker_index];
+function createMultiplePopupContent(marker_id,image_data){	
+	var marker = map_markers[marker_id];
 	
-	return  "<div>" + base64_img(image_data.thumbnail, {"width":popup_img_width}) + "</div>" + 
+	return  "<div>" + thumbnail_img(image_data, {"width":popup_img_width}) + "</div>" + 
 		    "<div>" + format_filename(image_data.filename) + "</div>" +
 		    "<div>" + format_taken_data(image_data.taken_date_type, image_data.taken_date) + "</div>" +
 		    "<div>" + "Camera: " + image_data.camera_make + "</div>" + 
-		    "<div>" + createPrevImageDiv(marker_index) + 
+		    "<div>" + createPrevImageDiv(marker_id) + 
 		    " " + (marker.current_image_index + 1) + " of " + marker.image_id_list.length + " " + 
-		    createNextImageDiv(marker_index) + "</div>";
+		    createNextImageDiv(marker_id) + "</div>";
 }
 
-function multiple_popup_html(marker_index,image_data){
-	return "<div id='marker_" + marker_index + "'>" + createMultiplePopupContent(marker_index,image_data) + "</div>";
+function multiple_popup_html(marker_id,image_data){
+	return "<div id='marker_" + marker_id + "'>" + createMultiplePopupContent(marker_id,image_data) + "</div>";
 }
 
 function onMultipleMarkerClickInfo(curried, image_data){
 	// do something sensible that allows us to iterage over the image list
-	var marker_index = curried.marker_index;
+	var marker_id = curried.marker_id;
 	var image_id_list = curried.image_id_list;
-	if( marker_index >= 0 && marker_index < map_marker_list.length){
-		var marker = map_marker_list[marker_index];
+	var marker = getMapMarker(marker_id);
+	if( marker !== null ){
 		marker.unbindPopup();
 		marker.image_id_list = image_id_list;
 		marker.current_image_index = 0;
-		var popup = multiple_popup_html(marker_index,image_data);
+		var popup = multiple_popup_html(marker_id,image_data);
 		marker.bindPopup(popup, popup_options).openPopup();
 		highlightImageRow(marker.image_id_list[0]);
 	}
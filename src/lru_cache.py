@@ -0,0 +1,129 @@
+"""Bounded least recently used cache, shared by the gui and worker threads"""
+import threading
+import unittest
+from collections import OrderedDict
+
+class LRUCache(object):
+  """Maps keys to values, evicting the least recently used entries once the total size of the values
+  goes over max_size. size_fn gives the size of a value, by default len so max_size is in bytes for str data"""
+
+  def __init__(self, max_size, size_fn=len):
+    self.max_size = max_size
+    self.size_fn = size_fn
+    self._entries = OrderedDict()  # key -> (value, size), most recently used last
+    self._lock = threading.Lock()
+    self.size = 0  # total size of the cached values
+    self.hits = 0
+    self.misses = 0
+    self.generation = 0  # incremented by clear so values worked out from older data can be refused by put
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    "Return the value for key marking it as most recently used, or default if it is not cached"
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return default
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, generation=None):
+    """Add or replace the value for key, evicting old entries to stay within max_size.
+    If generation is given the value is only added if the cache has not been cleared since it was read"""
+    size = self.size_fn(value)
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      if size > self.max_size:
+        return  # would evict everything else and still not fit
+      self._entries[key] = (value, size)
+      self.size += size
+      while self.size > self.max_size:
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self.size -= evicted_size
+
+  def setMaxSize(self, max_size):
+    "Change the budget, evicting the least recently used entries if the cache is now over it"
+    with self._lock:
+      self.max_size = max_size
+      while self.size > self.max_size:
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self.size -= evicted_size
+
+  def remove(self, key):
+    "Drop key from the cache if present"
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self.size -= entry[1]
+
+  def removeWhere(self, predicate):
+    "Drop every entry whose key predicate(key) returns True for"
+    with self._lock:
+      for key in [k for k in self._entries if predicate(k)]:
+        self.size -= self._entries.pop(key)[1]
+
+  def clear(self):
+    "Drop everything, the hit counts are kept"
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+      self.generation += 1
+
+  def getHitRate(self):
+    "Return the fraction of gets that were found in the cache, 0 if there have been none"
+    lookups = self.hits + self.misses
+    return float(self.hits) / lookups if lookups else 0.0
+
+  def __str__(self):
+    return "%d entries, size %d of %d, hit rate %.1f%%" % (len(self), self.size, self.max_size, 100 * self.getHitRate())
+
+
+class TestLRUCache(unittest.TestCase):
+
+  def testEviction(self):
+    cache = LRUCache(10)
+    cache.put(1, "aaaa")
+    cache.put(2, "bbbb")
+    self.assertEqual("aaaa", cache.get(1))
+    cache.put(3, "cccc")  # 2 is the least recently used
+    self.assertEqual(None, cache.get(2))
+    self.assertEqual(8, cache.size)
+    self.assertEqual(0.5, cache.getHitRate())
+    cache.put(4, "x" * 11)
+    self.assertFalse(4 in cache)
+    cache.setMaxSize(4)
+    self.assertEqual([3], [k for k in [1, 3] if k in cache])
+
+  def testRemove(self):
+    cache = LRUCache(100)
+    for key in [(1, True), (1, False), (2, True)]:
+      cache.put(key, "ab")
+    cache.removeWhere(lambda k: k[0] == 1)
+    self.assertEqual([(2, True)], [k for k in [(1, True), (1, False), (2, True)] if k in cache])
+    self.assertEqual(2, cache.size)
+    cache.remove((2, True))
+    self.assertEqual(0, len(cache))
+
+  def testGeneration(self):
+    cache = LRUCache(100)
+    generation = cache.generation
+    cache.clear()
+    cache.put(1, "stale", generation)
+    self.assertFalse(1 in cache)
+    cache.put(1, "fresh", cache.generation)
+    self.assertEqual("fresh", cache.get(1))
+
+
+if __name__ == "__main__":
+  unittest.main()
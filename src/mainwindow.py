@@ -14,6 +14,7 @@ import file_utils
 class RightSideWidget(QtGui.QWidget):
   
   main_html_file = os.path.join( file_utils.getApplicationPath(), 'index.xhtml' )
+  TIME_SLIDER_STEPS = 1000  # fine enough to pick out a day of a long library with the slider spread over the images
   
   def __init__(self, parent, start_page_url, js_to_server_call_fn, slider_time_to_date_str_fn):
     super(RightSideWidget, self).__init__(parent)
@@ -32,7 +33,7 @@ class RightSideWidget(QtGui.QWidget):
     
     self.time_slider = QSpanSlider(QtCore.Qt.Orientation.Horizontal, self)
     self.time_slider.setToolTip("Only show images on the map in the specified date range.")
-    self.time_slider.setMinMaxRange(0, 100)
+    self.time_slider.setMinMaxRange(0, self.TIME_SLIDER_STEPS)
     self.time_slider.setSingleStep(1)
     self.time_slider.setUpperPosition(self.time_slider.maximum())
     
@@ -162,8 +163,23 @@ class Ui_MainWindow(object):
 
     self.actionExit = QtGui.QAction("&Exit", MainWindow, shortcut=QtGui.QKeySequence.Quit, statusTip="Exit the program")
     
-    self.actionExport_To_CSV = QtGui.QAction("&Export to csv", MainWindow, statusTip="Export file information to csv file", triggered=MainWindow.onExportToCSV)
+    self.actionExport_To_CSV = QtGui.QAction("&Export to csv", MainWindow, statusTip="Export file information of the images in the time filter and map view to csv file", triggered=MainWindow.onExportToCSV)
     self.actionExport_To_CSV.setEnabled(False)
+    self.actionExport_To_GeoJSON = QtGui.QAction("Export to &GeoJSON", MainWindow, statusTip="Export the positions of the images in the time filter and map view to a GeoJSON file", triggered=MainWindow.onExportToGeoJSON)
+    self.actionExport_To_GeoJSON.setEnabled(False)
+    self.actionExport_To_GPX = QtGui.QAction("Export GPX &trail", MainWindow, statusTip="Export the positions of the images in the time filter and map view as a GPX track in the order they were taken", triggered=MainWindow.onExportToGPX)
+    self.actionExport_To_GPX.setEnabled(False)
+    self.actionCancel_Export = QtGui.QAction("&Cancel export", MainWindow, triggered=MainWindow.onCancelExport)
+    self.actionCancel_Export.setEnabled(False)
+    
+    self.actionSelect_All_In_Time_Filter = QtGui.QAction("Select all in &time filter", MainWindow, statusTip="Select all the images that can be placed taken between the times of the time filter", triggered=MainWindow.onSelectAllInTimeFilter)
+    self.actionSelect_All_Without_GPS = QtGui.QAction("Select all &without GPS", MainWindow, statusTip="Select all the images in the time filter that have no position", triggered=MainWindow.onSelectAllWithoutGPS)
+    self.actionClear_Selection = QtGui.QAction("&Clear selection", MainWindow, triggered=MainWindow.onClearSelection)
+    for action in (self.actionSelect_All_In_Time_Filter, self.actionSelect_All_Without_GPS, self.actionClear_Selection):
+      action.setEnabled(False)
+    
+    self.actionSave_Map_Offline = QtGui.QAction("Save &map area for offline use", MainWindow, statusTip="Download the map shown and closer zoom levels so they can be seen without an internet connection", triggered=MainWindow.onSaveMapOffline)
+    self.actionSave_Map_Offline.setEnabled(False)
     
     self.actionAbout = QtGui.QAction("&About", MainWindow, triggered=MainWindow.onAbout)
     
@@ -171,6 +187,8 @@ class Ui_MainWindow(object):
   
     self.fileMenu = self.menuBar().addMenu("&File")
     self.menuExport = self.menuBar().addMenu("&Export")
+    self.menuSelect = self.menuBar().addMenu("&Select")
+    self.menuMap = self.menuBar().addMenu("&Map")
     self.menuHelp = self.menuBar().addMenu("&Help")
     
     self.fileMenu.addAction(self.actionNew)
@@ -181,6 +199,15 @@ class Ui_MainWindow(object):
     self.fileMenu.addAction(self.actionExit)
     
     self.menuExport.addAction(self.actionExport_To_CSV)
+    self.menuExport.addAction(self.actionExport_To_GeoJSON)
+    self.menuExport.addAction(self.actionExport_To_GPX)
+    self.menuExport.addSeparator()
+    self.menuExport.addAction(self.actionCancel_Export)
+    self.menuSelect.addAction(self.actionSelect_All_In_Time_Filter)
+    self.menuSelect.addAction(self.actionSelect_All_Without_GPS)
+    self.menuSelect.addSeparator()
+    self.menuSelect.addAction(self.actionClear_Selection)
+    self.menuMap.addAction(self.actionSave_Map_Offline)
     self.menuHelp.addAction(self.actionAbout)
 
 class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
@@ -192,6 +219,12 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
   saveAsFileSignal = QtCore.Signal()
   exitSignal = QtCore.Signal()
   exportCSVSignal = QtCore.Signal()
+  exportGeoJSONSignal = QtCore.Signal()
+  exportGPXSignal = QtCore.Signal()
+  cancelExportSignal = QtCore.Signal()
+  saveMapOfflineSignal = QtCore.Signal()
+  selectAllInTimeFilterSignal = QtCore.Signal()
+  selectAllWithoutGPSSignal = QtCore.Signal()
   aboutSignal = QtCore.Signal()
   
   def __init__(self, parent=None, start_page_url="index.xhtml", js_to_server_call_fn=None, slider_time_to_formatted_date_fn=None):
@@ -214,6 +247,11 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
     self.actionSave.setEnabled(visible)
     self.actionSave_As.setEnabled(visible)
     self.actionExport_To_CSV.setEnabled(visible)
+    self.actionExport_To_GeoJSON.setEnabled(visible)
+    self.actionExport_To_GPX.setEnabled(visible)
+    self.actionSave_Map_Offline.setEnabled(visible)
+    for action in (self.actionSelect_All_In_Time_Filter, self.actionSelect_All_Without_GPS, self.actionClear_Selection):
+      action.setEnabled(visible)
     self.statusLabel.setVisible(visible)
     
   def _setTargetDirectoryWidgetsVisible(self, visible):
@@ -221,6 +259,9 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
     self.actionSave.setEnabled(not visible)
     self.actionSave_As.setEnabled(not visible)
     self.actionExport_To_CSV.setEnabled(not visible)
+    self.actionExport_To_GeoJSON.setEnabled(not visible)
+    self.actionExport_To_GPX.setEnabled(not visible)
+    self.actionSave_Map_Offline.setEnabled(not visible)
     self.statusLabel.setVisible(not visible)
     
   def showTargetDirectoryScreen(self):
@@ -267,6 +308,27 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
     
   def onExportToCSV(self):
     self.exportCSVSignal.emit()
+    
+  def onExportToGeoJSON(self):
+    self.exportGeoJSONSignal.emit()
+    
+  def onExportToGPX(self):
+    self.exportGPXSignal.emit()
+    
+  def onCancelExport(self):
+    self.cancelExportSignal.emit()
+      
+  def onSelectAllInTimeFilter(self):
+    self.selectAllInTimeFilterSignal.emit()
+    
+  def onSelectAllWithoutGPS(self):
+    self.selectAllWithoutGPSSignal.emit()
+    
+  def onClearSelection(self):
+    self.photo_table.clearSelection()
+      
+  def onSaveMapOffline(self):
+    self.saveMapOfflineSignal.emit()
       
   def onAbout(self):
     self.aboutSignal.emit()
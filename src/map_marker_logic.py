@@ -1,4 +1,7 @@
 import model
+import cluster_pyramid
+import math
+import bisect
 import unittest
 from PySide import QtGui, QtCore
 
@@ -29,13 +32,17 @@ def overlayImageDataWithIcon(img_data, draggable):
 class MarkerLogicData(object):
   "Data required to work out where map markers are to be displayed"
 
-  def __init__(self, db_connection, map_settings, map_marker_img_width, map_marker_img_height, calc_paths=False):
+  def __init__(self, db_connection, map_settings, map_marker_img_width, map_marker_img_height, calc_paths=False, snapshot=None, cluster_pyramid=None, abort_fn=None, marker_cache=None):
     """
     db_connection is a db_connection instance that is safe to use with a worker thread
     map_settings instance of MapSettings
     map_marker_img_width width of marker images in pixels
     map_marker_img_height height of marker images in pixels
     calc_paths compute paths between each photo group based on times
+    snapshot optional image_snapshot.ImageSnapshot used to answer area queries instead of the database
+    cluster_pyramid optional cluster_pyramid.ClusterPyramid to look up candidate markers from
+    abort_fn optional function returning True if the result is no longer wanted, so the work can stop early
+    marker_cache optional lru_cache.LRUCache of merged marker lists keyed by getMarkerCacheKey
 
     Want this to be immutable for thread safety
     """
@@ -43,17 +50,247 @@ class MarkerLogicData(object):
     self.map_settings = map_settings
     self.map_marker_img_width = map_marker_img_width
     self.map_marker_img_height = map_marker_img_height
-    self.max_images_per_marker = 10000
+    self.max_images_per_marker = model.Consts.MAX_IMAGES_PER_MARKER
     self.calc_paths = calc_paths
+    self.snapshot = snapshot
+    self.cluster_pyramid = cluster_pyramid
+    self.abort_fn = abort_fn
+    self.marker_cache = marker_cache
+    
+  def isAborted(self):
+    return self.abort_fn is not None and self.abort_fn()
+
+
+def getImageGridInArea(marker_logic_data, cursor, area_rect, cell_lat, cell_lng):
+  """Group the images in area_rect within the map time range into cells of cell_lat by cell_lng degrees, 
+  from the snapshot if there is one. Returns a list of (count, average lat, average lng, [image id's])"""
+  map_settings = marker_logic_data.map_settings
+  if marker_logic_data.snapshot is not None:
+    return marker_logic_data.snapshot.getImageGridInArea(model.dateToSeconds(map_settings.map_start_date), model.dateToSeconds(map_settings.map_end_date),
+                                                         area_rect.min_lat, area_rect.max_lat, area_rect.min_lng, area_rect.max_lng,
+                                                         cell_lat, cell_lng)
+  return model.getImageGridInArea(cursor, map_settings.map_start_date, map_settings.map_end_date, 
+                                  area_rect.min_lat, area_rect.max_lat, area_rect.min_lng, area_rect.max_lng,
+                                  cell_lat, cell_lng)
+
+def getMarkersFromImageGrid(marker_logic_data, cursor, area_rect, marker_lat_delta, marker_lng_delta):
+  "Return a list of model.MapMarkerData, one for each marker sized grid cell in area_rect containing images"
+  marker_data_list = []
+  for count, avg_lat, avg_lng, image_id_list in getImageGridInArea(marker_logic_data, cursor, area_rect, marker_lat_delta, marker_lng_delta):
+    marker_data = model.MapMarkerData()
+    marker_data.lat = avg_lat
+    marker_data.lng = avg_lng
+    marker_data.image_count = count
+    marker_data.image_id_list = model.makeImageIDArray(sorted(image_id_list)[:marker_logic_data.max_images_per_marker])
+    marker_data_list.append(marker_data)
+  return marker_data_list
+
+def getMarkersFromClusterPyramid(marker_logic_data, area_rect, marker_cell_degrees):
+  """Return a list of model.MapMarkerData, one for each occupied pyramid cell in area_rect, using the 
+  level whose cells are no bigger than marker_cell_degrees. The markers are already summarised, 
+  their image id's are only looked up if wanted, see model.getMarkerImageIds"""
+  map_settings = marker_logic_data.map_settings
+  level = cluster_pyramid.levelForCellDegrees(marker_cell_degrees)
+  time_window = (model.dateToSeconds(map_settings.map_start_date), model.dateToSeconds(map_settings.map_end_date))
+  cells = marker_logic_data.cluster_pyramid.getCellsInArea(level, time_window[0], time_window[1],
+                                                           area_rect.min_lat, area_rect.max_lat, area_rect.min_lng, area_rect.max_lng)
+  marker_data_list = []
+  for cell in cells:
+    marker_data = model.MapMarkerData()
+    marker_data.lat = cell.lat
+    marker_data.lng = cell.lng
+    marker_data.image_count = cell.count
+    marker_data.cells = [(cell.level, cell.lat_index, cell.lng_index)]
+    marker_data.time_window = time_window
+    marker_data.min_taken_date = model.secondsToDate(cell.min_taken_date)
+    marker_data.max_taken_date = model.secondsToDate(cell.max_taken_date)
+    marker_data.draggable = cell.all_user_placed
+    marker_data.thumbnail_id = cell.representative_id
+    marker_data.summarised = True
+    marker_data_list.append(marker_data)
+  return marker_data_list
+
+def mergeOverlappingMarkers(marker_data_list, overlap_lat, overlap_lng):
+  """Merge markers whose rects, the marker position +/- overlap_lat/overlap_lng, overlap until none do.
+  Each round hashes the markers into a grid of rect sized cells so only markers in neighbouring cells are
+  compared. Overlapping markers are joined with a union-find that keeps the weighted centroid of each group
+  at its root, and it is the group centroids that are tested, as if each merge had already been made.
+  Returns the new list of model.MapMarkerData"""
+  max_lat_delta, max_lng_delta = 2 * overlap_lat, 2 * overlap_lng
+  if max_lat_delta <= 0 or max_lng_delta <= 0:
+    return marker_data_list
+  
+  while len(marker_data_list) > 1:
+    parent = range(len(marker_data_list))
+    #weighted position sums and image count of each group, valid at the group's root
+    lat_sums = [marker.lat * marker.image_count for marker in marker_data_list]
+    lng_sums = [marker.lng * marker.image_count for marker in marker_data_list]
+    counts = [marker.image_count for marker in marker_data_list]
+    
+    def find(i):
+      while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+      return i
+    
+    grid = {}
+    for i, marker in enumerate(marker_data_list):
+      key = (int(math.floor(marker.lat / max_lat_delta)), int(math.floor(marker.lng / max_lng_delta)))
+      grid.setdefault(key, []).append(i)
+    
+    merged_any = False
+    for (lat_index, lng_index), cell_members in grid.iteritems():
+      for i in cell_members:
+        for neighbour_key in [(lat_index + d_lat, lng_index + d_lng) for d_lat in (-1, 0, 1) for d_lng in (-1, 0, 1)]:
+          for j in grid.get(neighbour_key, []):
+            if j <= i:
+              continue  # each pair only needs checking once
+            root_i, root_j = find(i), find(j)
+            if root_i == root_j:
+              continue
+            if abs(lat_sums[root_i] / counts[root_i] - lat_sums[root_j] / counts[root_j]) <= max_lat_delta and \
+               abs(lng_sums[root_i] / counts[root_i] - lng_sums[root_j] / counts[root_j]) <= max_lng_delta:
+              parent[root_j] = root_i
+              lat_sums[root_i] += lat_sums[root_j]
+              lng_sums[root_i] += lng_sums[root_j]
+              counts[root_i] += counts[root_j]
+              merged_any = True
+                
+    if not merged_any:
+      break
+    
+    groups = {}
+    for i in range(len(marker_data_list)):
+      groups.setdefault(find(i), []).append(marker_data_list[i])
+    #merged markers move to their new centroid so may now overlap others, go round again
+    marker_data_list = [group[0] if len(group) == 1 else model.mergeMapMarkerDataList(group) for group in groups.itervalues()]
+    
+  return marker_data_list
 
+def enrichMarkers(cursor, marker_data_list):
+  """Fill in draggable, thumbnail_id and min/max taken dates of each model.MapMarkerData not already summarised
+  with one grouped query. The thumbnail itself is not fetched, the map loads it from its url"""
+  unsummarised = [marker_data for marker_data in marker_data_list if not marker_data.summarised]
+  if len(unsummarised) != 0:
+    summaries = model.getMarkerImageSummaries(cursor, [marker_data.image_id_list for marker_data in unsummarised])
+    for marker_data, summary in zip(unsummarised, summaries):
+      if summary is not None:
+        #only draggable if all positions are set by the user
+        marker_data.draggable, marker_data.thumbnail_id, marker_data.min_taken_date, marker_data.max_taken_date = summary
+        marker_data.summarised = True
+
+class OutsideTrail(object):
+  """Time ordered photos outside the map area, materialized once per map update so the trail arrows can be
+  worked out with binary searches instead of a pair of queries for each gap between markers"""
+  
+  def __init__(self, points):
+    "points is a list of (taken seconds, longitude, latitude, image_id) in taken date order"
+    self.seconds = [point[0] for point in points]
+    self.points = points
+  
+  @classmethod
+  def load(cls, marker_logic_data, cursor, area_rect):
+    "Load the trail outside area_rect within the map time range, from the snapshot if there is one"
+    map_settings = marker_logic_data.map_settings
+    if marker_logic_data.snapshot is not None:
+      points = marker_logic_data.snapshot.getImagesOutsideAreaBetween(model.dateToSeconds(map_settings.map_start_date), model.dateToSeconds(map_settings.map_end_date),
+                                                                      area_rect.min_lat, area_rect.max_lat, area_rect.min_lng, area_rect.max_lng)
+    else:
+      points = model.getPhotosOutsideAreaBetween(cursor, area_rect.min_lat, area_rect.max_lat, area_rect.min_lng, area_rect.max_lng,
+                                                 map_settings.map_start_date, map_settings.map_end_date)
+    return cls(points)
+  
+  def getMinMaxTimesPhotosBetween(self, min_date, max_date):
+    """Return up to two ([lng,lat], datetime), the earliest photo taken at or after min_date but before max_date
+    and the latest taken after min_date up to max_date, as model.getMinMaxTimesPhotosOutsideArea does"""
+    match_list = []
+    min_seconds = model.dateToSeconds(min_date)
+    max_seconds = model.dateToSeconds(max_date)
+    
+    first = bisect.bisect_left(self.seconds, min_seconds)
+    min_id = None
+    if first < len(self.seconds) and self.seconds[first] < max_seconds:
+      taken, lng, lat, min_id = self.points[first]
+      match_list.append(([lng, lat], model.secondsToDate(taken)))
+    
+    last = bisect.bisect_right(self.seconds, max_seconds) - 1
+    if last >= 0 and self.seconds[last] > min_seconds and self.points[last][3] != min_id: # don't add the same photo twice for min/max
+      taken, lng, lat, _ = self.points[last]
+      match_list.append(([lng, lat], model.secondsToDate(taken)))
+    
+    return match_list
+
+def getMergedMarkers(marker_logic_data, cursor, search_rect, marker_lat_delta, marker_lng_delta):
+  """Return the list of model.MapMarkerData, all enriched, for the images in search_rect grouped into markers of 
+  marker_lat_delta by marker_lng_delta degrees with no two overlapping, or None if aborted"""
+  #list of markers each marker defines x,y pos and list of image id's
+  if marker_logic_data.cluster_pyramid is not None:
+    #cells already hold the groupings we want so this is just a look up
+    marker_data_list = getMarkersFromClusterPyramid(marker_logic_data, search_rect, min(marker_lat_delta, marker_lng_delta))
+  else:
+    #one pass grouping the images into marker sized cells
+    marker_data_list = getMarkersFromImageGrid(marker_logic_data, cursor, search_rect, marker_lat_delta, marker_lng_delta)
+  if marker_logic_data.isAborted():
+    return None
+  
+  #now go through the markers and see if any are close enough to be merged...
+  #markers closer than this are merged
+  overlap_lat, overlap_lng = marker_lat_delta / 3, marker_lng_delta / 3 
+  merged_marker_list = mergeOverlappingMarkers(marker_data_list, overlap_lat, overlap_lng)
+  if marker_logic_data.isAborted():
+    return None
+  
+  #now should have a list of separated groups of map markers in merged_marker_list
+  #fill in whether each is draggable, its thumbnail id and min/max times in one batch
+  enrichMarkers(cursor, merged_marker_list)
+  if marker_logic_data.isAborted():
+    return None
+  return merged_marker_list
 
-def imageIDInMarkerList( test_id, marker_data_list ):
-  "Return True if test_id is present in the marker_data_list"
-  for marker_data in marker_data_list:
-    if test_id in marker_data.image_id_list:
-      return True
-  # if we get here then it is not present
-  return False
+def getSearchRect(map_lat_lng_rect):
+  """Return the rect markers are grouped on for the view port, it completely covers map_lat_lng_rect and is
+  made of whole tiles of a grid anchored at 0,0 whose size only depends on the zoom, so small pans give the same rect.
+  Returns the rect and the tile size in degrees"""
+  tile_degrees = cluster_pyramid.cellDegreesForLevel(cluster_pyramid.levelForCellDegrees(max(map_lat_lng_rect.width, map_lat_lng_rect.height) * 0.25))
+  return model.quantiseRect(map_lat_lng_rect, tile_degrees), tile_degrees
+
+def getMarkerCacheKey(marker_logic_data, search_rect, tile_degrees, marker_cell_degrees):
+  "Return the key the merged markers for the search rect are cached under, the zoom, tiles and time range"
+  map_settings = marker_logic_data.map_settings
+  tile_index = lambda x: int(round(x / tile_degrees))
+  return (cluster_pyramid.levelForCellDegrees(marker_cell_degrees),
+          tile_index(search_rect.min_lat), tile_index(search_rect.max_lat), tile_index(search_rect.min_lng), tile_index(search_rect.max_lng),
+          model.dateToSeconds(map_settings.map_start_date), model.dateToSeconds(map_settings.map_end_date))
+
+def getMarkerChanges(shown_markers, marker_list):
+  """Compare the markers shown on the map, a dict of marker id -> model.MapMarkerData, with marker_list.
+  Markers are identified by their thumbnail_id, a marker whose images or draggability have changed
+  is removed and added again. The map only knows a marker's image count, it asks for the id's when it needs them. Returns the tuple of
+  (dict of the markers now shown, [removed marker ids], [added model.MapMarkerData], [moved model.MapMarkerData])"""
+  new_markers = dict((marker_data.thumbnail_id, marker_data) for marker_data in marker_list)
+  removed_ids = []
+  added = []
+  moved = []
+  for marker_id, shown in shown_markers.iteritems():
+    marker_data = new_markers.get(marker_id)
+    if marker_data is None or \
+       marker_data.image_count != shown.image_count or \
+       marker_data.draggable != shown.draggable:
+      removed_ids.append(marker_id)
+      if marker_data is not None:
+        added.append(marker_data)
+    elif marker_data.lat != shown.lat or marker_data.lng != shown.lng:
+      moved.append(marker_data)
+  added.extend(marker_data for marker_id, marker_data in new_markers.iteritems() if marker_id not in shown_markers)
+  return new_markers, removed_ids, added, moved
+
+def getArrowChanges(shown_arrow_ids, arrow_list, zoom):
+  """Compare the ids of the arrows shown on the map with arrow_list, as returned by updateMapMarkers.
+  The arrow heads are sized for the zoom so it is part of the id. Returns the tuple of
+  (set of arrow ids now shown, [removed arrow ids], [(arrow id, arrow)] to add)"""
+  arrows = dict(("%s:%.6f,%.6f,%.6f,%.6f" % (zoom, start[0], start[1], end[0], end[1]), (start, end)) for start, end in arrow_list)
+  new_arrow_ids = set(arrows)
+  return new_arrow_ids, list(shown_arrow_ids - new_arrow_ids), [(arrow_id, arrows[arrow_id]) for arrow_id in new_arrow_ids - shown_arrow_ids]
 
 def updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_height_pixels):
     """Workout the markers showing where images are...
@@ -62,6 +299,7 @@ def updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_
     map_width_pixels is the width of the map in pixels
     map_height_pixels is the height of the map in pixels
     Returns a list of model.MapMarkerData objects and an arrow_list  this is a list of tuples like ( (start_lng, start_lat), (end_lng, end_lat) )
+    Both lists are empty if marker_logic_data's abort_fn says to stop
 
     Want this to be able to run in worker thread safely
     """
@@ -71,146 +309,55 @@ def updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_
       #get smallest area of one marker on the map for which we will group pictures...
       marker_lat_delta = float(map_lat_lng_rect.width) / map_width_pixels * marker_logic_data.map_marker_img_width
       marker_lng_delta = float(map_lat_lng_rect.height) / map_height_pixels * marker_logic_data.map_marker_img_height
-      
-      marker_area = marker_lat_delta * marker_lng_delta
-      
-      #Given a marker return the lat/lng rect
-      overlap_lat, overlap_lng = marker_lat_delta / 3, marker_lng_delta / 3 
-      getMarkerRect = lambda marker: model.Rect(min_lat=marker.lat - overlap_lat, 
-                                                max_lat=marker.lat + overlap_lat,
-                                                min_lng=marker.lng - overlap_lng, 
-                                                max_lng=marker.lng + overlap_lng)
         
       map_settings = marker_logic_data.map_settings
       
       map_start_date = map_settings.map_start_date
       map_end_date = map_settings.map_end_date
        
-      #list of markers each marker defines x,y pos and list of image id's
-      marker_data_list = []
-      
-      #do a quartering search to avoid too many queries or too many results
-      #do quatering on a quantise completely covering rect to avoid to much variation
+      #group on a quantised completely covering rect to avoid to much variation
       #in grouping due to slight changes in start conditions
-      quanta = max( map_lat_lng_rect.width, map_lat_lng_rect.height ) * 0.25
-      search_list = model.quantiseRect(map_lat_lng_rect, quanta).generateQuarters()
+      search_rect, tile_degrees = getSearchRect(map_lat_lng_rect)
       
-      def processImagesInArea(map_start_date, map_end_date, test_rect, marker_data_list):
-        image_id_list = model.getImagesIDsInArea(cursor, map_start_date, map_end_date, test_rect.min_lat, test_rect.max_lat, test_rect.min_lng, test_rect.max_lng, marker_logic_data.max_images_per_marker)
-    
-        #remove any images already present in other markers
-        for image_id in image_id_list[:]:
-          if imageIDInMarkerList(image_id, marker_data_list):
-            image_id_list.remove(image_id)
-
-        if len(image_id_list) != 0:
-          #let's get an accurate average of position
-          avg_pos = model.getAveragePositionOfImages(cursor, image_id_list)
-          
-          marker_data = model.MapMarkerData()
-          marker_data.lat = avg_pos[0]
-          marker_data.lng = avg_pos[1]
-          marker_data.image_id_list = image_id_list
-          marker_data.image_id_list.sort()
-          marker_data_list.append(marker_data)
-          
-      while len(search_list) != 0:
-        test_rect = search_list.pop(0)
-        #if this is smaller than marker area then process it
-        #otherwise see if we should quarter it again
-        if test_rect.area > marker_area:
-          #are there any images in this area?
-          img_count = model.getImageCountInArea(cursor, map_start_date, map_end_date, test_rect.min_lat, test_rect.max_lat, test_rect.min_lng, test_rect.max_lng)
-
-          if img_count > 1:
-            search_list.extend(test_rect.generateQuarters())
-          elif img_count == 1:
-            processImagesInArea(map_start_date, map_end_date, test_rect, marker_data_list)
-        else:
-          processImagesInArea(map_start_date, map_end_date, test_rect, marker_data_list)
-          
-      #now go through the markers and see if any are close enough to be merged...
-      marker_rect_list = [ (marker, getMarkerRect(marker)) for marker in marker_data_list ]
+      #the same markers are found whenever the map comes back to the same tiles at the same zoom
+      cache_key = getMarkerCacheKey(marker_logic_data, search_rect, tile_degrees, min(marker_lat_delta, marker_lng_delta))
+      merged_marker_list = None
+      if marker_logic_data.marker_cache is not None:
+        cache_generation = marker_logic_data.marker_cache.generation  # before reading any data
+        merged_marker_list = marker_logic_data.marker_cache.get(cache_key)
       
-      # loop until we don't find any overlaps
-      #force the first iteration to take place
-      old_marker_count = len(marker_rect_list) + 1
-
-      while len(marker_rect_list) != old_marker_count:
-        old_marker_count = len(marker_rect_list)
-
-        break_out = False
-
-        for i in range(len(marker_rect_list) - 1):
-
-          if break_out:
-            break
-
-          for j in range(i + 1, len(marker_rect_list)):
-            marker_i, rect_i = marker_rect_list[i]
-            marker_j, rect_j = marker_rect_list[j]
-
-            if model.rectOverlap( rect_i, rect_j ):
-              del marker_rect_list[i]  # remove i from marker_rect_list list
-              if j < i:
-                del marker_rect_list[j]  # remove j from marker_rect_list list
-              else:
-                del marker_rect_list[j - 1]
-              merged_marker = model.mergeMapMarkerData(marker_i, marker_j)
-              marker_rect_list.append( (merged_marker, getMarkerRect(merged_marker) ))
-              break_out = True  # want to end this iteration and exit outside loop
-              break  # exit this loop then the next
-              
-      #now should have a list of separated groups of map markers decorated with their covering area in marker_rect_list
-      #go through and load up thumbnails we want to show
-      #also work out if the marker is draggable
-      for marker_data, _ in marker_rect_list:
-        #want to convert this to a QImage and add overlay of pin or compass depending on whether the marker is
-        #draggable or not
-        #then convert back to jpeg for base64 serialization
-         
-        #work out if this marker is draggable
-        #only draggable if all positions are set by the user
-        geo_type_list = model.getGeoTypesFromImageList(cursor, marker_data.image_id_list)
-        marker_data.draggable = False
-        for geo_type in geo_type_list:
-          marker_data.draggable = geo_type == model.ImageTable.GEO_FROM_USER
-          if not marker_data.draggable:
-            break
-        
-        #overlay img_data with correct icon
-        marker_data.thumbnail = overlayImageDataWithIcon(model.getImageById(cursor, marker_data.image_id_list[0]).thumbnail, marker_data.draggable)
-            
+      if merged_marker_list is None:
+        merged_marker_list = getMergedMarkers(marker_logic_data, cursor, search_rect, marker_lat_delta, marker_lng_delta)
+        if merged_marker_list is None:
+          return [], []  # aborted
+        if marker_logic_data.marker_cache is not None:
+          marker_logic_data.marker_cache.put(cache_key, merged_marker_list, cache_generation)
           
       #we can now look for min/max times in each group if we want
       arrow_list = [] # this is a list of tuples like ( (start_lng, start_lat), (end_lng, end_lat) ), of arrows to draw on the map
-      if marker_logic_data.calc_paths and len(marker_rect_list) != 0:
+      if marker_logic_data.calc_paths and len(merged_marker_list) != 0:
         point_date_list = []
-        #get min max times for each grouping
-        for map_marker_data, _ in marker_rect_list:
-          date_time_tuple = model.getMinMaxTimesFromImageList(cursor, map_marker_data.image_id_list)
-          if date_time_tuple is not None:
-            map_marker_data.min_taken_date, map_marker_data.max_taken_date = date_time_tuple
-        
-            #create lists of ([lng,lat], datetime), with one entry for min taken date and one for max taken date  
-            #if more than one image in a group then there are likely min/max times associated with group
-            #otherwise just the one time
-            if len(map_marker_data.image_id_list) > 1 and map_marker_data.min_taken_date != map_marker_data.max_taken_date:
-              point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.min_taken_date) )
-              point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.max_taken_date) )
-            elif len(map_marker_data.image_id_list) >= 1:
-              point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.min_taken_date) )
+        for map_marker_data in merged_marker_list:
+          #create lists of ([lng,lat], datetime), with one entry for min taken date and one for max taken date  
+          #if more than one image in a group then there are likely min/max times associated with group
+          #otherwise just the one time
+          if map_marker_data.image_count > 1 and map_marker_data.min_taken_date != map_marker_data.max_taken_date:
+            point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.min_taken_date) )
+            point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.max_taken_date) )
+          elif map_marker_data.image_count >= 1:
+            point_date_list.append(([map_marker_data.lng, map_marker_data.lat], map_marker_data.min_taken_date) )
               
         #sort into date order.
         #iterate through choosing the earliest of each set for an arrow if [lng,lat]'s are different
-        #also check for arrows travelling to or from outside this map area by running restricted searches on the db
+        #also check for arrows travelling to or from outside this map area by searching the trail of photos outside it
         extract_seconds = lambda x: model.dateToSeconds(x[1])
         point_date_list.sort(key=extract_seconds) # sort into date order
+        outside_trail = OutsideTrail.load(marker_logic_data, cursor, map_lat_lng_rect)
         
         #go through an construct arrow list
         #look for photos earlier than the ones in the visible set to draw lines coming into this set
         if len(point_date_list) != 0:
-          outside_point_date_list = model.getMinMaxTimesPhotosOutsideArea(cursor, map_lat_lng_rect.min_lat, map_lat_lng_rect.max_lat, map_lat_lng_rect.min_lng, map_lat_lng_rect.max_lng, map_start_date, point_date_list[0][1])
+          outside_point_date_list = outside_trail.getMinMaxTimesPhotosBetween(map_start_date, point_date_list[0][1])
           if len(outside_point_date_list) != 0:
             arrow_list.append((outside_point_date_list[-1][0], point_date_list[0][0]))
         
@@ -219,7 +366,7 @@ def updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_
           #there may be an arrow between these 2 points going to the outside of the mapped zoom
           #need to find up to 2 photos outside this map area with min(date) or max(date) between these two times outside
           #this area 
-          outside_point_date_list = model.getMinMaxTimesPhotosOutsideArea(cursor, map_lat_lng_rect.min_lat, map_lat_lng_rect.max_lat, map_lat_lng_rect.min_lng, map_lat_lng_rect.max_lng, last_point_date[1], point_date[1])
+          outside_point_date_list = outside_trail.getMinMaxTimesPhotosBetween(last_point_date[1], point_date[1])
           
           if len(outside_point_date_list) == 0:
             if last_point_date[0] != point_date[0]:
@@ -242,12 +389,10 @@ def updateMapMarkers(marker_logic_data, map_lat_lng_rect, map_width_pixels, map_
           
         #look for photos later than the ones in the visible set to draw lines coming into this set
         if len(point_date_list) != 0:
-          outside_point_date_list = model.getMinMaxTimesPhotosOutsideArea(cursor, map_lat_lng_rect.min_lat, map_lat_lng_rect.max_lat, map_lat_lng_rect.min_lng, map_lat_lng_rect.max_lng, point_date_list[-1][1], map_end_date)
+          outside_point_date_list = outside_trail.getMinMaxTimesPhotosBetween(point_date_list[-1][1], map_end_date)
           if len(outside_point_date_list) != 0:
             arrow_list.append((point_date_list[-1][0], outside_point_date_list[0][0]))
             
-      #serialize to python primitives so we can convert to json
-      merged_marker_list = [ x[0] for x in marker_rect_list ]
       #pass to gui
       return merged_marker_list, arrow_list
     finally:
@@ -273,5 +418,39 @@ class TestMarkerPositions(unittest.TestCase):
     self.assertTrue( len(marker_list) <= image_count )
 
 
+class TestOutsideTrail(unittest.TestCase):
+
+  def testMinMax(self):
+    trail = OutsideTrail([(100, 1.0, 2.0, 1), (200, 3.0, 4.0, 2), (300, 5.0, 6.0, 3)])
+    d = model.secondsToDate
+    self.assertEqual([([1.0, 2.0], d(100)), ([3.0, 4.0], d(200))], trail.getMinMaxTimesPhotosBetween(d(100), d(200)))
+    self.assertEqual([([3.0, 4.0], d(200))], trail.getMinMaxTimesPhotosBetween(d(150), d(250)))
+    self.assertEqual([], trail.getMinMaxTimesPhotosBetween(d(300), d(300)))
+
+
+class TestMarkerChanges(unittest.TestCase):
+
+  def _marker(self, thumbnail_id, image_id_list, lat=1.0):
+    marker_data = model.MapMarkerData()
+    marker_data.thumbnail_id = thumbnail_id
+    marker_data.image_id_list = model.makeImageIDArray(image_id_list)
+    marker_data.image_count = len(image_id_list)
+    marker_data.lat = lat
+    return marker_data
+
+  def testChanges(self):
+    shown, _, _, _ = getMarkerChanges({}, [self._marker(1, [1, 2]), self._marker(3, [3]), self._marker(4, [4])])
+    shown, removed, added, moved = getMarkerChanges(shown, [self._marker(1, [1, 2]), self._marker(3, [3, 5]), self._marker(4, [4], 2.0), self._marker(6, [6])])
+    self.assertEqual([3], removed)
+    self.assertEqual([3, 6], sorted(m.thumbnail_id for m in added))
+    self.assertEqual([4], [m.thumbnail_id for m in moved])
+    self.assertEqual([1, 3, 4, 6], sorted(shown))
+
+    arrow_ids, removed, added = getArrowChanges(set(), [([0, 0], [1, 1])], 5)
+    self.assertEqual(1, len(added))
+    arrow_ids, removed, added = getArrowChanges(arrow_ids, [([0, 0], [1, 1])], 6)
+    self.assertEqual((1, 1), (len(removed), len(added)))
+
+
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,133 @@
+"""Works out the map markers on a worker thread so moving the map doesn't block the gui"""
+import threading
+import traceback
+from PySide import QtCore
+import map_marker_logic
+import model
+
+class MarkerRequest(object):
+  "Everything needed to work out the markers for one view of the map"
+
+  def __init__(self, db_file, map_settings, map_lat_lng_rect, map_width_pixels, map_height_pixels,
+               map_marker_img_width, map_marker_img_height, calc_paths=False, snapshot=None, cluster_pyramid=None, marker_cache=None):
+    """db_file is the database the worker opens its own connection to,
+    map_settings should be a copy as the gui carries on changing its own,
+    the rest are as for map_marker_logic.MarkerLogicData and map_marker_logic.updateMapMarkers"""
+    self.sequence = None  # given by MarkerWorkerThread.requestMarkers, later requests have higher numbers
+    self.db_file = db_file
+    self.map_settings = map_settings
+    self.map_lat_lng_rect = map_lat_lng_rect
+    self.map_width_pixels = map_width_pixels
+    self.map_height_pixels = map_height_pixels
+    self.map_marker_img_width = map_marker_img_width
+    self.map_marker_img_height = map_marker_img_height
+    self.calc_paths = calc_paths
+    self.snapshot = snapshot
+    self.cluster_pyramid = cluster_pyramid
+    self.marker_cache = marker_cache
+
+
+class MarkerWorkerThread(QtCore.QThread):
+  """Worker thread that works out map markers for the latest MarkerRequest.
+  Requests made while one is being worked on replace any still waiting and make the one in progress stop early,
+  so a burst of map moves only costs one update. Results of requests that have been superseded are never sent"""
+
+  #fired with the request's sequence number, the list of model.MapMarkerData and the arrow list
+  markersReadySignal = QtCore.Signal(int, object, object)
+
+  _WAIT_SECONDS = 1.0
+
+  def __init__(self):
+    super(MarkerWorkerThread, self).__init__()
+    self._condition = threading.Condition()
+    self._pending_request = None  # latest request not yet started
+    self._latest_sequence = 0
+    self._running = True
+    self._release_requested = False  # close the connection before the gui changes database file
+    #only used on the worker thread
+    self._db_file = None
+    self._dbcon = None
+
+  def requestMarkers(self, request):
+    "Queue a request replacing any not yet started, returns its sequence number"
+    with self._condition:
+      self._latest_sequence += 1
+      request.sequence = self._latest_sequence
+      self._pending_request = request
+      self._condition.notify_all()
+      return request.sequence
+
+  def isCurrent(self, sequence):
+    "Return True if sequence is the latest request, so its result is still wanted"
+    return sequence == self._latest_sequence
+
+  def releaseDatabase(self):
+    """Drop any outstanding work and wait until the worker has closed its connection.
+    Call before the database file is closed or replaced"""
+    with self._condition:
+      self._pending_request = None
+      self._latest_sequence += 1  # anything in progress is now stale
+      if not self.isRunning():
+        return
+      self._release_requested = True
+      self._condition.notify_all()
+      while self._release_requested and self.isRunning():
+        self._condition.wait(self._WAIT_SECONDS)
+
+  def stop(self, wait_ms):
+    "Ask the thread to finish and wait up to wait_ms for it to do so"
+    with self._condition:
+      self._running = False
+      self._pending_request = None
+      self._latest_sequence += 1
+      self._condition.notify_all()
+    self.wait(wait_ms)
+
+  def _getConnection(self, db_file):
+    if self._dbcon is not None and self._db_file != db_file:
+      self._closeConnection()
+    if self._dbcon is None:
+      #autocommit so reads never hold a lock open that would block the gui thread's commits
+      self._dbcon = model.connectToDatabase(db_file, isolation_level=None)
+      self._db_file = db_file
+    return self._dbcon
+
+  def _closeConnection(self):
+    if self._dbcon is not None:
+      self._dbcon.close()
+      self._dbcon = None
+      self._db_file = None
+
+  def run(self):
+    while True:
+      with self._condition:
+        while self._running and self._pending_request is None and not self._release_requested:
+          self._condition.wait(self._WAIT_SECONDS)
+        if self._release_requested:
+          self._closeConnection()
+          self._release_requested = False
+          self._condition.notify_all()
+          continue
+        if not self._running:
+          break
+        request = self._pending_request
+        self._pending_request = None
+
+      try:
+        marker_logic_data = map_marker_logic.MarkerLogicData(self._getConnection(request.db_file),
+                                                             request.map_settings,
+                                                             request.map_marker_img_width,
+                                                             request.map_marker_img_height,
+                                                             request.calc_paths,
+                                                             request.snapshot,
+                                                             request.cluster_pyramid,
+                                                             lambda: not self.isCurrent(request.sequence),
+                                                             request.marker_cache)
+        marker_list, arrow_list = map_marker_logic.updateMapMarkers(marker_logic_data, request.map_lat_lng_rect,
+                                                                    request.map_width_pixels, request.map_height_pixels)
+        if self.isCurrent(request.sequence):
+          self.markersReadySignal.emit(request.sequence, marker_list, arrow_list)
+      except Exception:
+        traceback.print_exc()
+
+    self._closeConnection()
@@ -6,7 +6,14 @@ import unittest
 from datetime import datetime, timedelta
 import copy
 import math
+import array
 import base64
+import image_snapshot
+import cluster_pyramid
+import lru_cache
+import id_range_set
+import db_backup
+import time_histogram
 from PySide import QtCore, QtGui
 
 epoch_start = datetime(1970, 1, 1)
@@ -14,11 +21,13 @@ month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'O
 
 COMPASS_FILE = "images/compass.png"
 PIN_FILE = "images/pin.png"
+UNLOADED_PICTURE_FILE = "images/unloaded_picture.png"
 
 OVERLAY_ICON_OPACITY = 0.7
 
 _compass_image = None
 _pin_image = None
+_unloaded_picture_image = None
 
 def getCompassImage():
   "Lazy load the compass image"
@@ -35,6 +44,14 @@ def getPinImage():
     _pin_image = QtGui.QImage()
     _pin_image.load(PIN_FILE)
   return _pin_image
+
+def getUnloadedPictureImage():
+  "Lazy load the image shown in place of a thumbnail that is still being loaded"
+  global _unloaded_picture_image
+  if _unloaded_picture_image is None:
+    _unloaded_picture_image = QtGui.QImage()
+    _unloaded_picture_image.load(UNLOADED_PICTURE_FILE)
+  return _unloaded_picture_image
   
 class Consts(object):
   longitude_delta = 0.0001
@@ -43,9 +60,17 @@ class Consts(object):
   
   VERSION_MAJOR = 0
   VERSION_MINOR = 1
+  
+  THUMBNAIL_CACHE_BYTES = 16 * 1024 * 1024  # budget for popup thumbnails with the pin/compass overlay already painted on
+  MARKER_CACHE_ENTRIES = 64  # number of map views whose markers are remembered
+  THUMBNAIL_URL_SCHEME = "thumb"  # map thumbnails are loaded from thumb://<generation>/<image_id>
+  IMAGE_ID_ARRAY_TYPE = "l"  # array.array type code of image id's held in bulk, see makeImageIDArray
+  MAX_IMAGES_PER_MARKER = 10000  # longest image id list a map marker gives
 
   
 class Rect(object):
+  
+  __slots__ = ("min_lat", "max_lat", "min_lng", "max_lng")
 
   def __init__(self, min_lat=0, max_lat=0, min_lng=0, max_lng=0):
     assert(min_lat <= max_lat)
@@ -169,6 +194,8 @@ def dateToSeconds(_date):
 class ScannedImageSet(object):
   "Represents Overall details of a set of scanned images..."
   
+  __slots__ = ("top_folder", "start_scan_date", "end_scan_date", "number_of_images", "min_date", "max_date", "db_file")
+  
   def __init__(self):
     self.top_folder = ""
     self.start_scan_date = datetime.now()
@@ -182,6 +209,9 @@ class ScannedImageSet(object):
 class ImageData(object):
   "Complete data for one image"
   
+  __slots__ = ("image_id", "latitude", "longitude", "geo_type", "camera_make", "_full_path", "filename",
+               "taken_date", "taken_date_type", "thumbnail")
+  
   def __init__(self):
     self.image_id = None
     self.latitude = None #may not have geographic data
@@ -203,19 +233,25 @@ class ImageData(object):
   
   full_path = property(getFullPath,setFullPath)
   
-  def serializeToDict(self):
-    "This is the first step to transferring this to web view"
+  def serializeToDict(self, thumbnail_url=None):
+    """This is the first step to transferring this to web view.
+    If thumbnail_url is given it is sent instead of the thumbnail data"""
     d = {}
     seriliaze_attrs = ["image_id", "latitude", "longitude", "camera_make", "filename", "full_path",
                        "taken_date_type", "geo_type"]
     for attr in seriliaze_attrs:
       d[attr] = getattr(self, attr)
     d["taken_date"] = dateToSeconds(self.taken_date)
-    d["thumbnail"] = base64.b64encode(self.thumbnail)
+    if thumbnail_url is not None:
+      d["thumbnail_url"] = thumbnail_url
+    else:
+      d["thumbnail"] = base64.b64encode(self.thumbnail)
     return d
       
 class LatLng(object):
   
+  __slots__ = ("lat", "lng")
+  
   def __init__(self, lat=0, lng=0):
     self.lat = lat
     self.lng = lng
@@ -255,43 +291,77 @@ class ViewData(object):
     self.current_image_set_info = ScannedImageSet()
     self.map_settings = MapSettings([0,0], 8)
       
+def makeImageIDArray(image_ids=()):
+  """Return image id's as an array.array, a machine int each rather than an int object and a list slot.
+  It compares, iterates and slices as a list does, but convert it with list() for json"""
+  return array.array(Consts.IMAGE_ID_ARRAY_TYPE, image_ids)
+      
 class MapMarkerData(object):
-  "Represents the data under one map marker"
+  """Represents the data under one map marker.
+  image_id_list is sorted, as an array from makeImageIDArray as markers are made and cached in their thousands.
+  Markers from the cluster pyramid leave it None and give the cells their images are in instead,
+  getMarkerImageIds looks the id's up when they are wanted"""
+  
+  __slots__ = ("lat", "lng", "image_count", "image_id_list", "cells", "time_window", "thumbnail",
+               "min_taken_date", "max_taken_date", "draggable", "thumbnail_id", "summarised")
   
   def __init__(self):
     self.lat = 0
     self.lng = 0
-    self.image_id_list = []
+    self.image_count = 0
+    self.image_id_list = None
+    self.cells = []  # (level, lat index, lng index) of the cluster_pyramid cells the images are in
+    self.time_window = None  # (start seconds, end seconds) of the images in the cells
     self.thumbnail = "" #if this is a merged marker it is the first thumbnail in the list
     self.min_taken_date = datetime.now()
     self.max_taken_date = datetime.now()
     self.draggable = False  # is this marker draggable
+    self.thumbnail_id = None  # image id of the thumbnail to show, None if not yet known
+    self.summarised = False  # True if draggable, thumbnail_id and the min/max taken dates are already filled in
     
-  def serializeToDict(self):
-    "Starting point of transferring this over to the javascript map"
+  def serializeToDict(self, thumbnail_url=None):
+    """Starting point of transferring this over to the javascript map.
+    If thumbnail_url is given it is sent instead of the thumbnail data"""
     d = {}
-    seriliaze_attrs = ["lat", "lng", "image_id_list", "draggable"]
+    seriliaze_attrs = ["lat", "lng", "image_count", "draggable"]
     for attr in seriliaze_attrs:
       d[attr] = getattr(self, attr)
       
     d["min_taken_date"] = dateToSeconds(self.min_taken_date)
     d["max_taken_date"] = dateToSeconds(self.max_taken_date)
+    d["marker_id"] = self.thumbnail_id  # stays the same while the marker shows the same thumbnail, the image of a single image marker
     
-    #now sort out the thumbnail as base_64 encoding
-    d["thumbnail"] = base64.b64encode( self.thumbnail )
+    #the map loads the thumbnail from its url if it has one, otherwise sort it out as base_64 encoding
+    if thumbnail_url is not None:
+      d["thumbnail_url"] = thumbnail_url
+    else:
+      d["thumbnail"] = base64.b64encode( self.thumbnail )
     return d
     
-def mergeMapMarkerData(marker1, marker2):
-  "Combine 2 markers into 1 marker"
+def mergeMapMarkerDataList(marker_list):
+  "Combine a list of markers into 1 marker"
   combined = MapMarkerData()
-  combined.lat = ( marker1.lat * len(marker1.image_id_list) + marker2.lat * len(marker2.image_id_list) ) / (len(marker1.image_id_list) + len(marker2.image_id_list))
-  combined.lng = ( marker1.lng * len(marker1.image_id_list) + marker2.lng * len(marker2.image_id_list) ) / (len(marker1.image_id_list) + len(marker2.image_id_list))
-  combined.image_id_list.extend(marker1.image_id_list)
-  combined.image_id_list.extend(marker2.image_id_list)
-  combined.image_id_list.sort()
-  combined.thumbnail = marker1.thumbnail
+  combined.image_count = sum(marker.image_count for marker in marker_list)
+  combined.lat = sum(marker.lat * marker.image_count for marker in marker_list) / combined.image_count
+  combined.lng = sum(marker.lng * marker.image_count for marker in marker_list) / combined.image_count
+  if all(marker.image_id_list is not None for marker in marker_list):
+    image_ids = sorted(image_id for marker in marker_list for image_id in marker.image_id_list)
+    combined.image_id_list = makeImageIDArray(image_ids[:Consts.MAX_IMAGES_PER_MARKER])
+  combined.cells = [cell for marker in marker_list for cell in marker.cells]
+  combined.time_window = marker_list[0].time_window
+  combined.thumbnail = marker_list[0].thumbnail
+  combined.summarised = all(marker.summarised for marker in marker_list)
+  if combined.summarised:
+    combined.min_taken_date = min(marker.min_taken_date for marker in marker_list)
+    combined.max_taken_date = max(marker.max_taken_date for marker in marker_list)
+    combined.draggable = all(marker.draggable for marker in marker_list)
+    combined.thumbnail_id = min(marker.thumbnail_id for marker in marker_list)
   return combined
 
+def mergeMapMarkerData(marker1, marker2):
+  "Combine 2 markers into 1 marker"
+  return mergeMapMarkerDataList([marker1, marker2])
+
 def distanceBetweenMarkers(marker1, marker2):
   "Return approx distance between markers"
   lat_delta = marker1.lat - marker2.lat
@@ -338,31 +408,186 @@ def getImagesIDsInArea(cursor, map_start_date, map_end_date, min_lat, max_lat, m
     return [row[0] for row in cursor.fetchall() if row[1] >= min_lng and row[1] <= max_lng and
                                                    row[2] >= min_lat and row[2] <= max_lat ]
 
+def getImageGridInArea(cursor, map_start_date, map_end_date, min_lat, max_lat, min_lng, max_lng, cell_lat, cell_lng):
+  """Group the images in the area into a grid of cells of cell_lat by cell_lng degrees anchored at min_lat, min_lng.
+  Returns a list of (count, average latitude, average longitude, [image id's]) for each occupied cell, using one query"""
+  map_start_date = dateToSeconds(map_start_date)
+  map_end_date = dateToSeconds(map_end_date)
+  
+  sql = """SELECT COUNT(Image.image_id), AVG(latitude), AVG(longitude), GROUP_CONCAT(Image.image_id) from Image,ImageLocation
+  WHERE Image.image_id == ImageLocation.image_id AND
+  taken_date >= ? AND
+  taken_date <= ? AND
+  max_longitude >= ? AND
+  min_longitude <= ? AND
+  max_latitude >= ? AND
+  min_latitude <= ? AND
+  Image.latitude >= ? AND
+  Image.latitude <= ? AND
+  Image.longitude >= ? AND
+  Image.longitude <= ?
+  GROUP BY CAST((Image.latitude - ?) / ? AS INTEGER), CAST((Image.longitude - ?) / ? AS INTEGER);"""
+  cursor.execute(sql, (map_start_date, map_end_date, min_lng, max_lng, min_lat, max_lat, 
+                       min_lat, max_lat, min_lng, max_lng, min_lat, cell_lat, min_lng, cell_lng))
+  return [(row[0], row[1], row[2], [int(x) for x in row[3].split(",")]) for row in cursor.fetchall()]
+
+class TempImageIDSet(object):
+  """Image id's loaded into the connection's temp table ImageIDSet so queries can join against it,
+  rather than binding a parameter per id, so the sql never changes and the statement cache can reuse it.
+  Each id has a group number so several lists can be queried together with GROUP BY. Use in a with block,
+  which empties the table on exit. Temp tables belong to the connection so only one set per connection at a time"""
+  
+  def __init__(self, cursor, image_id_list=None):
+    self.cursor = cursor
+    self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS ImageIDSet (grp INTEGER, image_id INTEGER);")
+    self.clear()  # anything left by an earlier error
+    if image_id_list is not None:
+      self.addGroups([image_id_list])
+    
+  def addGroups(self, image_id_lists):
+    "Add each list of id's, numbering their groups from 0 in order"
+    self.cursor.executemany("INSERT INTO ImageIDSet (grp, image_id) VALUES (?, ?);",
+                            ((grp, image_id) for grp, image_id_list in enumerate(image_id_lists) for image_id in image_id_list))
+    
+  def clear(self):
+    self.cursor.execute("DELETE FROM ImageIDSet;")
+    
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    self.clear()
+    return False
+
 def getAveragePositionOfImages(cursor, image_id_list):
   "Return the average lat,lng of images in the image_id_list"
-  sql="SELECT AVG(latitude), AVG(longitude) FROM Image WHERE image_id IN ({seq})".format(seq=','.join(['?'] * len(image_id_list)))
-  cursor.execute(sql, image_id_list)
-  return cursor.fetchone()
+  with TempImageIDSet(cursor, image_id_list):
+    cursor.execute("SELECT AVG(latitude), AVG(longitude) FROM Image WHERE image_id IN (SELECT image_id FROM ImageIDSet);")
+    return cursor.fetchone()
 
 def getGeoTypesFromImageList(cursor, image_id_list):
   "Return the of geo types for the given image_id list"
-  sql = "SELECT geo_type FROM Image WHERE image_id IN({seq})".format(seq=','.join(['?'] * len(image_id_list )))
-  cursor.execute(sql, image_id_list)
-  return [x[0] for x in cursor.fetchall()]
+  with TempImageIDSet(cursor, image_id_list):
+    cursor.execute("SELECT geo_type FROM Image WHERE image_id IN (SELECT image_id FROM ImageIDSet);")
+    return [x[0] for x in cursor.fetchall()]
 
 def getMinMaxTimesFromImageList(cursor, image_id_list):
   "Return the tuple of (min date_taken, max date_taken) for photos in the given area or None if no photos exist"
   if len(image_id_list) == 0:
     return None
   else:
-    sql = "SELECT MIN(taken_date), MAX(taken_date) from Image WHERE image_id in ({seq})".format(seq=','.join(['?'] * len(image_id_list)))
-    cursor.execute(sql, image_id_list)
-    row = cursor.fetchone()
+    with TempImageIDSet(cursor, image_id_list):
+      cursor.execute("SELECT MIN(taken_date), MAX(taken_date) from Image WHERE image_id IN (SELECT image_id FROM ImageIDSet);")
+      row = cursor.fetchone()
     if row is not None and len(row) == 2:
       return (secondsToDate(row[0]), secondsToDate(row[1]))
     else:
       return None
-  
+
+#images with a position from their exif data can't be placed by the user
+_USER_PLACEABLE_SQL = "NOT (geo_type == %d AND latitude IS NOT NULL AND longitude IS NOT NULL)" % ImageTable.GEO_FROM_EXIF
+
+def getPlaceableImageIdsBetweenIndices(cursor, first_index, last_index):
+  """Iterate in ascending order over the id's of the images the user can place from the image index first_index
+  to last_index inclusive, where the image index is the position in the taken date order used by getImageSetAt"""
+  sql = """SELECT image_id FROM (SELECT image_id, latitude, longitude, geo_type FROM Image ORDER BY taken_date, image_id LIMIT ? OFFSET ?)
+  WHERE %s ORDER BY image_id;""" % _USER_PLACEABLE_SQL
+  cursor.execute(sql, (last_index - first_index + 1, first_index))
+  return (row[0] for row in cursor)
+
+def getPlaceableImageIdsBetweenTimes(cursor, start_seconds, end_seconds, without_position_only=False):
+  """Iterate in ascending order over the id's of the images the user can place taken from start_seconds up to end_seconds,
+  only those with no position at all if without_position_only"""
+  sql = "SELECT image_id FROM Image WHERE taken_date >= ? AND taken_date < ? AND %s" % _USER_PLACEABLE_SQL
+  if without_position_only:
+    sql += " AND (latitude IS NULL OR longitude IS NULL)"
+  cursor.execute(sql + " ORDER BY image_id;", (start_seconds, end_seconds))
+  return (row[0] for row in cursor)
+
+def _stagePlaceImageTable(cursor, id_ranges):
+  """Fill the connection's temp table of images to place with the existing images in the sorted (start, end) id ranges,
+  numbered from 1 by seq so they can be worked through in chunks. Returns the number of images staged"""
+  cursor.execute("CREATE TEMP TABLE IF NOT EXISTS PlaceImage (seq INTEGER PRIMARY KEY, image_id INTEGER);")
+  cursor.execute("DELETE FROM PlaceImage;")
+  sql = "INSERT INTO PlaceImage (seq, image_id) SELECT NULL, image_id FROM Image WHERE image_id >= ? AND image_id < ? ORDER BY image_id;"
+  for id_range in id_ranges:
+    cursor.execute(sql, id_range)
+  cursor.execute("SELECT COUNT(*) FROM PlaceImage;")
+  return cursor.fetchone()[0]
+
+def getMarkerImageSummaries(cursor, marker_image_id_lists):
+  """For each list of image id's in marker_image_id_lists return the tuple of
+  (all geo types set by the user, lowest image id, min date_taken, max date_taken), or None for an empty list.
+  All the lists are done together in one query with a group of a TempImageIDSet for each marker"""
+  sql = """SELECT ImageIDSet.grp, MIN(Image.geo_type == ?), MIN(Image.image_id), MIN(Image.taken_date), MAX(Image.taken_date)
+  FROM ImageIDSet, Image
+  WHERE ImageIDSet.image_id == Image.image_id
+  GROUP BY ImageIDSet.grp;"""
+  summaries = [None] * len(marker_image_id_lists)
+  with TempImageIDSet(cursor) as id_set:
+    id_set.addGroups(marker_image_id_lists)
+    cursor.execute(sql, (ImageTable.GEO_FROM_USER,))
+    for marker, all_user, first_id, min_date, max_date in cursor.fetchall():
+      summaries[marker] = (bool(all_user), first_id, secondsToDate(min_date), secondsToDate(max_date))
+  return summaries
+
+def getImageIdsInCells(cursor, cells, start_seconds, end_seconds, limit=None):
+  """Return the sorted id's of the images in the cluster_pyramid cells, a list of (level, lat index, lng index),
+  taken from start_seconds to end_seconds, at most limit of them. Found with the r-tree, a query for each cell"""
+  sql = """SELECT Image.image_id, latitude, longitude FROM Image, ImageLocation WHERE Image.image_id == ImageLocation.image_id AND
+  max_longitude >= ? AND min_longitude <= ? AND max_latitude >= ? AND min_latitude <= ? AND
+  longitude >= ? AND longitude <= ? AND latitude >= ? AND latitude <= ? AND
+  taken_date >= ? AND taken_date <= ? ORDER BY Image.image_id"""
+  if limit is not None:
+    sql += " LIMIT %d" % limit
+  image_ids = []
+  for level, lat_index, lng_index in cells:
+    cell_degrees = cluster_pyramid.cellDegreesForLevel(level)
+    bounds = (lng_index * cell_degrees, (lng_index + 1) * cell_degrees, lat_index * cell_degrees, (lat_index + 1) * cell_degrees)
+    cursor.execute(sql, bounds + bounds + (start_seconds, end_seconds))
+    #the pyramid decides which cell a position on an edge is in
+    image_ids.extend(image_id for image_id, latitude, longitude in cursor
+                     if cluster_pyramid.isInCell(level, lat_index, lng_index, latitude, longitude))
+  image_ids.sort()
+  return image_ids[:limit] if limit is not None else image_ids
+
+def getMarkerImageIds(cursor, marker_data):
+  "Return the image id's of a MapMarkerData, looking them up and keeping them if it only has its cells"
+  if marker_data.image_id_list is None:
+    image_ids = getImageIdsInCells(cursor, marker_data.cells, marker_data.time_window[0], marker_data.time_window[1],
+                                   Consts.MAX_IMAGES_PER_MARKER)
+    marker_data.image_id_list = makeImageIDArray(image_ids)
+  return marker_data.image_id_list
+
+def getThumbnail(cursor, image_id):
+  "Return the jpeg thumbnail data of an image, None if there is no such image or it has no thumbnail"
+  cursor.execute("SELECT thumbnail FROM Image WHERE image_id=?;", (image_id,))
+  row = cursor.fetchone()
+  if row is None or row[0] is None:
+    return None
+  return str(row[0])
+
+def getThumbnailUrl(generation, image_id, draggable=None):
+  """Return the url the map loads a thumbnail from, see BrowserWidget.registerUrlScheme.
+  generation changes whenever the database is reconnected so the browser never reuses a thumbnail for a different image,
+  draggable is None for the plain thumbnail or True/False for the pin/compass overlaid version"""
+  url = "%s://%d/%d" % (Consts.THUMBNAIL_URL_SCHEME, generation, image_id)
+  if draggable is not None:
+    url += "/pin" if draggable else "/compass"
+  return url
+
+def parseThumbnailUrl(path):
+  """Split the path of a thumbnail url, with the generation host, into (generation, image_id, draggable)
+  as passed to getThumbnailUrl. Returns None if it is not one"""
+  parts = path.strip("/").split("/")
+  if len(parts) not in (2, 3) or (len(parts) == 3 and parts[2] not in ("pin", "compass")):
+    return None
+  try:
+    generation, image_id = int(parts[0]), int(parts[1])
+  except ValueError:
+    return None
+  return (generation, image_id, None if len(parts) == 2 else parts[2] == "pin")
+
 def getMinMaxTimesFromImagesInArea(cursor, min_lat, max_lat, min_lng, max_lng):
   "Return the tuple of (min date_taken, max date_taken) for photos in the given area or None if no photos exist"
   sql = """SELECT MIN(taken_date), MAX(taken_date) from Image,ImageLocation
@@ -424,6 +649,20 @@ def getMinMaxTimesPhotosOutsideArea(cursor, min_lat, max_lat, min_lng, max_lng,
   
   return match_list
   
+def getPhotosOutsideAreaBetween(cursor, min_lat, max_lat, min_lng, max_lng, min_date, max_date):
+  """Return a list of (taken seconds, longitude, latitude, image_id) in taken_date order for every photo
+  outside the area described by min/max lat/lngs taken between min_date and max_date inclusive"""
+  sql = """SELECT taken_date, Image.longitude, Image.latitude, Image.image_id from Image,ImageLocation
+  WHERE Image.image_id == ImageLocation.image_id AND
+  ( Image.longitude < ? OR
+    Image.longitude > ? OR
+    (Image.longitude >= ? AND Image.longitude <= ? AND Image.latitude < ? ) OR
+    (Image.longitude >= ? AND Image.longitude <= ? AND Image.latitude > ? ) ) AND
+  taken_date >= ? AND taken_date <= ?
+  ORDER BY taken_date ASC;"""
+  cursor.execute(sql, (min_lng, max_lng, min_lng, max_lng, min_lat, min_lng, max_lng, max_lat, dateToSeconds(min_date), dateToSeconds(max_date)))
+  return cursor.fetchall()
+
 def getLatLngRectContainingAllImages(cursor):
   "Return (min lat, max lat, min lng, max lng) rectangle that contains all the images"
   sql = "SELECT MIN(latitude), MAX(latitude), MIN(longitude), MAX(longitude) FROM Image;"
@@ -499,58 +738,55 @@ def setMapSettings(cursor, map_settings):
                        dateToSeconds(map_settings.map_end_date)))
   cursor.connection.commit()
   
-class CSVColumn(object):
-  def __init__(self, header_name, row_index, to_str=str):
-    self.header_name = header_name
-    self.row_index = row_index
-    self.to_str = to_str
-    
-def exportImageDataToCSV(cursor, target_file):
-  "Export the image data to a csv file, may throw a runtime error if fails"
-  # ("file", "TEXT"),("camera_make", "TEXT"), ("taken_date", "INTEGER"), ("taken_date_type", "INTEGER"),
-  # "longitude", "REAL"), ("latitude", "REAL"),("thumbnail", "BLOB")]
-  
-  def quote_str(x):
-    return '"%s"' % x
-  
-  def date_type_to_str(x):
-    if x == ImageTable.TAKEN_DATE_FROM_EXIF:
-      return quote_str("Date Taken By Camera")
-    else:
-      return quote_str("File Creation Date")    
+#views that make an overlay database look like a whole one, see DBManager.openFile
+#they are temp so can refer to the attached saved file, and have to be made on every connection
+_overlay_views = ["""CREATE TEMP VIEW Image AS
+  SELECT i.image_id AS image_id, i.file AS file, i.camera_make AS camera_make, i.taken_date AS taken_date, i.taken_date_type AS taken_date_type,
+  CASE WHEN e.image_id IS NULL THEN i.longitude ELSE e.longitude END AS longitude,
+  CASE WHEN e.image_id IS NULL THEN i.latitude ELSE e.latitude END AS latitude,
+  CASE WHEN e.image_id IS NULL THEN i.geo_type ELSE e.geo_type END AS geo_type,
+  i.thumbnail AS thumbnail
+  FROM saved.Image AS i LEFT JOIN main.ImageEdit AS e ON e.image_id == i.image_id;""",
+  """CREATE TEMP VIEW ImageLocation AS
+  SELECT * FROM saved.ImageLocation WHERE image_id NOT IN (SELECT image_id FROM main.ImageLocationEdit)
+  UNION ALL SELECT * FROM main.ImageLocationEdit;""",
+  """CREATE TEMP TRIGGER ImageUpdate INSTEAD OF UPDATE ON Image BEGIN
+  SELECT RAISE(ABORT, 'Only the positions of images in a file opened in place can change')
+  WHERE NEW.image_id IS NOT OLD.image_id OR NEW.file IS NOT OLD.file OR NEW.taken_date IS NOT OLD.taken_date;
+  INSERT OR REPLACE INTO ImageEdit (image_id, longitude, latitude, geo_type) VALUES (NEW.image_id, NEW.longitude, NEW.latitude, NEW.geo_type);
+  END;""",
+  """CREATE TEMP TRIGGER ImageLocationInsert INSTEAD OF INSERT ON ImageLocation BEGIN
+  INSERT OR REPLACE INTO ImageLocationEdit (image_id, min_longitude, max_longitude, min_latitude, max_latitude)
+  VALUES (NEW.image_id, NEW.min_longitude, NEW.max_longitude, NEW.min_latitude, NEW.max_latitude);
+  END;"""]
 
-  def geo_type_to_str(x):
-    if x == ImageTable.GEO_FROM_EXIF:
-      return quote_str("GPS from EXIF data in photo")
-    else:
-      return quote_str("Position supplied by user")
-    
-  csv_column_list = [CSVColumn("File", 0, quote_str), 
-                     CSVColumn("Camera Make", 1, quote_str), 
-                     CSVColumn("Date", 2, lambda x: quote_str(secondsToDateTimeString(x))),
-                     CSVColumn("Date Type", 3, date_type_to_str),
-                     CSVColumn("Latitude", 5),
-                     CSVColumn("Longitude", 6),
-                     CSVColumn("Position Data Source", 4, geo_type_to_str)]
-  
-  sql = "SELECT file, camera_make, taken_date, taken_date_type, geo_type, latitude, longitude from Image;"
-  f = open(target_file, 'w')
+def connectToDatabase(db_file, **kwargs):
+  """Return a sqlite3 connection to db_file, kwargs are as for sqlite3.connect.
+  If db_file is an overlay from DBManager.openFile the file it is over is attached and the views over both made"""
+  dbcon = sqlite3.connect(db_file, **kwargs)
   try:
-    #write out header row
-    f.write(",".join([quote_str(x.header_name) for x in csv_column_list]) + "\n")
-    cursor.execute(sql)
-    row = cursor.fetchone()
-    while row is not None and len(row) != 0:
-      csv_row = []
-      for cvs_col in csv_column_list:
-        csv_row.append( cvs_col.to_str( row[ cvs_col.row_index ] ) )
-      f.write( ",".join(csv_row) + "\n")
-      row = cursor.fetchone()
-  
-  finally:
-    f.close()
-    
-  
+    cursor = dbcon.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name == 'OverlayInfo';")
+    if cursor.fetchone() is not None:
+      cursor.execute("SELECT saved_file FROM OverlayInfo;")
+      saved_file = cursor.fetchone()[0]
+      if not os.path.exists(saved_file):
+        raise RuntimeError("File does not exist! %s" % saved_file)
+      cursor.execute("ATTACH DATABASE ? AS saved;", (saved_file,))
+      cursor.executescript("".join(_overlay_views))
+  except:
+    dbcon.close()
+    raise
+  return dbcon
+
+def getOverlaySavedFile(cursor):
+  "Return the file an overlay database is over, or None if it is not an overlay"
+  cursor.execute("PRAGMA database_list;")
+  for _, name, file_name in cursor.fetchall():
+    if name == "saved":
+      return file_name
+  return None
+
 class DBManager(object):
   "Class that looks after our working database..."
 
@@ -562,10 +798,20 @@ class DBManager(object):
             "CREATE VIRTUAL TABLE ImageLocation USING rtree(image_id, min_longitude, max_longitude, min_latitude, max_latitude);",
             "CREATE TABLE MapSettings(centre_latitude REAL, centre_longitude REAL, zoom INT, map_start_date INT, map_end_date INT);"]
   
+  #an overlay holds copies of the small tables, and the position edits of images in the file it is over
+  overlay_copied_tables = ["AppInfo", "ScanInfo", "MapSettings"]
+  overlay_schema = [sql for sql in schema if sql.split()[2].split("(")[0] in overlay_copied_tables] + [
+    "CREATE TABLE OverlayInfo (saved_file TEXT);",
+    "CREATE TABLE ImageEdit (image_id INTEGER PRIMARY KEY, longitude REAL, latitude REAL, geo_type INTEGER);",
+    "CREATE TABLE ImageLocationEdit (image_id INTEGER PRIMARY KEY, min_longitude REAL, max_longitude REAL, min_latitude REAL, max_latitude REAL);"]
+  
   version_updates_map = {}  # map of version updates, key is version to go to, value is script to run
    
   current_db_version = 1
   
+  PLACE_CHUNK_SIZE = 5000  # images updated per statement when placing, between progress reports
+  OPEN_IN_PLACE_MIN_BYTES = 64 * 1024 * 1024  # files at least this big are opened in place rather than copied, see openFile
+  
   def __init__(self, app_version):
     self.db_file = ""
     self.saved_to_file = ""  # file that this data was loaded from or last saved to
@@ -574,16 +820,54 @@ class DBManager(object):
     self.dbcon = None
     self.cursor = None
     self._dirty = False # is there date that is not save permently
+    self._overlay_saved_file = None # file the database is over if it was opened in place, see openFile
+    self._change_count = 0 # increases with every change, so a save made in the background knows if it is still up to date
     self.db_version = DBManager.current_db_version
+    self.use_snapshot = image_snapshot.isSnapshotAvailable() # answer viewport queries from memory if we can
+    self._snapshot = None # lazily built image_snapshot.ImageSnapshot
+    self.use_cluster_pyramid = True # generate map markers from pre computed grid aggregates
+    self._cluster_pyramid = None # lazily built cluster_pyramid.ClusterPyramid
+    self._time_histogram = None # lazily built time_histogram.TimeHistogram
+    self.thumbnail_cache = lru_cache.LRUCache(Consts.THUMBNAIL_CACHE_BYTES) # (image_id, draggable) -> overlaid jpeg data
+    self.marker_cache = lru_cache.LRUCache(Consts.MARKER_CACHE_ENTRIES, size_fn=lambda markers: 1) # see map_marker_logic.getMarkerCacheKey
     
   def getDirty(self):
     return self._dirty
   
   def setDirty(self, x):
     self._dirty = x
+    if x:
+      self._change_count += 1
     
   dirty = property(getDirty, setDirty)
   
+  def getSnapshot(self):
+    """Return the in memory image_snapshot.ImageSnapshot of the current database, building it if required.
+    Returns None if it is not available (numpy not installed or not connected)"""
+    if not self.use_snapshot or not self.isConnected():
+      return None
+    if self._snapshot is None:
+      self._snapshot = image_snapshot.ImageSnapshot.loadFromCursor(self.cursor)
+    return self._snapshot
+  
+  def getClusterPyramid(self):
+    """Return the cluster_pyramid.ClusterPyramid of the current database, building it if required.
+    Returns None if not in use or not connected"""
+    if not self.use_cluster_pyramid or not self.isConnected():
+      return None
+    if self._cluster_pyramid is None:
+      self._cluster_pyramid = cluster_pyramid.ClusterPyramid.loadFromCursor(self.cursor, ImageTable.GEO_FROM_USER)
+    return self._cluster_pyramid
+  
+  def getTimeHistogram(self):
+    """Return the time_histogram.TimeHistogram of the current database, building it if required.
+    Returns None if not connected"""
+    if not self.isConnected():
+      return None
+    if self._time_histogram is None:
+      self._time_histogram = time_histogram.TimeHistogram.loadFromCursor(self.cursor)
+    return self._time_histogram
+  
   def _setAppInfo(self, dbversion=None):
     if dbversion == None:
       dbversion = self.db_version
@@ -617,16 +901,23 @@ class DBManager(object):
     self.db_file = db_file
     exists = os.path.exists(db_file)
     #_connect, which creates it if it doesn't
-    self.dbcon = sqlite3.connect(db_file)
+    self.dbcon = connectToDatabase(db_file)
     self.cursor = self.dbcon.cursor()
     if not exists:
       #this is clean so lets create some tables etc
       self._runschema()
     else:
       self._checkUpgrade()
+    self._overlay_saved_file = getOverlaySavedFile(self.cursor)
 
   def _disconnect(self):
     "Disconnect from a given database"
+    self._snapshot = None
+    self._cluster_pyramid = None
+    self._time_histogram = None
+    self.thumbnail_cache.clear()
+    self.marker_cache.clear()
+    self._overlay_saved_file = None
     if self.dbcon != None:
       self.dbcon.close()
       self.cursor  = None
@@ -656,27 +947,35 @@ class DBManager(object):
   def loadFile(self, load_file_name):
     """Load a saved file. This will copy the database to a temporary file then _connect to that.
     Raises an exception on failure"""
+    load_task = self.createLoadTask(load_file_name)
+    try:
+      if db_backup.isOnlineBackupAvailable():
+        db_backup.backupDatabase(load_file_name, load_task.dest_file)
+      else:
+        shutil.copyfile(load_file_name, load_task.dest_file)
+    except:
+      os.remove(load_task.dest_file)
+      raise
+    self.onLoadTaskComplete(load_task)
+    
+  def createLoadTask(self, load_file_name):
+    """Disconnect and return a db_backup.BackupTask that copies load_file_name to a new temporary file.
+    Start it and call onLoadTaskComplete when it succeeds, or discardLoadTask if it fails.
+    Raises an exception if the file does not exist"""
     if not os.path.exists(load_file_name):
       raise RuntimeError("File does not exist! %s" % load_file_name)
     
     self._disconnectAndClean()
-    
     #create a new temp...
     tmp_file = self._createTempDBFile()
+    tmp_file.close()
+    return db_backup.BackupTask(load_file_name, tmp_file.name)
+    
+  def onLoadTaskComplete(self, load_task):
+    "Connect to the database copied by a task from createLoadTask, raises an exception on failure"
     try:
-      #now stream in chunks of up to 1Mb
-      chunk_size = 1024 * 1024
-      #open load file read only
-      with open(load_file_name,'rb') as load_file:
-        while True:
-          chunk_block = load_file.read(chunk_size)
-          if chunk_block == None or chunk_block == "":
-            break
-          tmp_file.write( chunk_block )
-      #once copied close and _connect
-      tmp_file.close()
-      self._connect(tmp_file.name)
-      self.saved_to_file = load_file_name
+      self._connect(load_task.dest_file)
+      self.saved_to_file = load_task.src_file
       self.dirty = False
     except:
       #try and untangle our state from the failure!
@@ -684,20 +983,108 @@ class DBManager(object):
         self._disconnect()
       except:
         pass
+      self.discardLoadTask(load_task)
+      raise  # pass error up
+    
+  def discardLoadTask(self, load_task):
+    "Remove the temporary file of a task from createLoadTask that failed"
+    if os.path.exists(load_task.dest_file):
+      os.remove(load_task.dest_file)
+         
+  def shouldOpenInPlace(self, load_file_name):
+    "Return True if the file is big enough that openFile is quicker than loading a copy"
+    return os.path.getsize(load_file_name) >= self.OPEN_IN_PLACE_MIN_BYTES
+    
+  def openFile(self, load_file_name):
+    """Open a saved file in place, so it is ready however big it is. The file is attached to a new temporary
+    overlay database that keeps the position edits and the small tables, views join the two (see connectToDatabase)
+    and the edits are merged into a file when it is saved. Raises an exception on failure"""
+    if not os.path.exists(load_file_name):
+      raise RuntimeError("File does not exist! %s" % load_file_name)
+    
+    self._disconnectAndClean()
+    tmp_file = self._createTempDBFile()
+    tmp_file.close()
+    try:
+      overlay_con = sqlite3.connect(tmp_file.name)
       try:
-        if not tmp_file.closed():
-          tmp_file.close()
+        overlay_con.executescript("".join(self.overlay_schema))
+        overlay_con.execute("INSERT INTO OverlayInfo (saved_file) VALUES (?);", (os.path.abspath(load_file_name),))
+        overlay_con.commit()
+        overlay_con.execute("ATTACH DATABASE ? AS saved;", (load_file_name,))
+        for table in self.overlay_copied_tables:
+          overlay_con.execute("INSERT INTO main.%s SELECT * FROM saved.%s;" % (table, table))
+        overlay_con.commit()
+      finally:
+        overlay_con.close()
+      self._connect(tmp_file.name)
+      self.saved_to_file = load_file_name
+      self.dirty = False
+    except:
+      #try and untangle our state from the failure!
+      try:
+        self._disconnect()
       except:
         pass
-      #make sure temp file removed on error
       os.remove(tmp_file.name)
       raise  # pass error up
-         
+    
+  def isOpenInPlace(self):
+    return self._overlay_saved_file is not None
+  
+  def _mergeOverlayInto(self, save_file):
+    """Save a database opened in place by merging its edits into save_file. Saving anywhere but the file opened
+    first copies that file to save_file, which the overlay is then moved over"""
+    self.dbcon.commit()
+    if os.path.normcase(os.path.abspath(save_file)) != os.path.normcase(os.path.abspath(self._overlay_saved_file)):
+      if db_backup.isOnlineBackupAvailable():
+        db_backup.saveDatabase(self._overlay_saved_file, save_file)
+      else:
+        shutil.copyfile(self._overlay_saved_file, save_file)
+      self.cursor.execute("DETACH DATABASE saved;")
+      self.cursor.execute("UPDATE OverlayInfo SET saved_file = ?;", (os.path.abspath(save_file),))
+      self.dbcon.commit()
+      self.cursor.execute("ATTACH DATABASE ? AS saved;", (save_file,))
+      self._overlay_saved_file = getOverlaySavedFile(self.cursor)
+    
+    try:
+      sql = """UPDATE saved.Image SET
+      longitude = (SELECT longitude FROM ImageEdit WHERE ImageEdit.image_id == Image.image_id),
+      latitude = (SELECT latitude FROM ImageEdit WHERE ImageEdit.image_id == Image.image_id),
+      geo_type = (SELECT geo_type FROM ImageEdit WHERE ImageEdit.image_id == Image.image_id)
+      WHERE image_id IN (SELECT image_id FROM ImageEdit);"""
+      self.cursor.execute(sql)
+      self.cursor.execute("INSERT OR REPLACE INTO saved.ImageLocation SELECT * FROM ImageLocationEdit;")
+      for table in self.overlay_copied_tables:
+        self.cursor.execute("DELETE FROM saved.%s;" % table)
+        self.cursor.execute("INSERT INTO saved.%s SELECT * FROM main.%s;" % (table, table))
+      #merged so the views show the same through the saved file alone
+      self.cursor.execute("DELETE FROM ImageEdit;")
+      self.cursor.execute("DELETE FROM ImageLocationEdit;")
+      self.dbcon.commit()
+    except:
+      self.dbcon.rollback()
+      raise
+    
+  def canSaveInBackground(self):
+    "Return True if createSaveTask can be used, otherwise saveFile must"
+    return db_backup.isOnlineBackupAvailable() and not self.isOpenInPlace()
+    
   def saveFile(self, save_file):
     """Save the current temporary database to the specified file overwriting as required.
     Raises an exception on failure"""
     if self.db_file == "":
       raise RuntimeError("No database to save!")
+    if self.isOpenInPlace():
+      self._mergeOverlayInto(save_file)
+      self.saved_to_file = save_file
+      self.dirty = False
+      return
+    if db_backup.isOnlineBackupAvailable():
+      save_task = self.createSaveTask(save_file)
+      db_backup.saveDatabase(self.db_file, save_file)
+      self.onSaveTaskComplete(save_task)
+      return
     #rem the file name
     cur_file = self.db_file
     self.dbcon.commit()
@@ -710,6 +1097,22 @@ class DBManager(object):
       #reconnect
       self._connect(cur_file)
       
+  def createSaveTask(self, save_file):
+    """Commit and return a db_backup.BackupTask that saves the database to save_file while it stays connected.
+    Start it and call onSaveTaskComplete when it succeeds. Only when canSaveInBackground"""
+    if self.db_file == "" or self.isOpenInPlace():
+      raise RuntimeError("No database to save in the background!")
+    self.dbcon.commit()
+    save_task = db_backup.BackupTask(self.db_file, save_file, to_save_file=True)
+    save_task.change_count = self._change_count
+    return save_task
+    
+  def onSaveTaskComplete(self, save_task):
+    "Note a task from createSaveTask has saved, still dirty if there have been changes since it was created"
+    self.saved_to_file = save_task.dest_file
+    if self._change_count == save_task.change_count:
+      self.dirty = False
+      
   def newFile(self):
     """Create a new file for our purposes
     May raise an exception if it fails..."""
@@ -802,6 +1205,14 @@ class DBManager(object):
     "Return an ImageData object from a given image_id or None if it does not exist"
     return getImageById(self.cursor, image_id)
     
+  def getThumbnail(self, image_id):
+    "Return the jpeg thumbnail data of an image or None"
+    return getThumbnail(self.cursor, image_id)
+    
+  def getThumbnailUrl(self, image_id, draggable=None):
+    "Return the url of an image's thumbnail for the current database, see getThumbnailUrl"
+    return getThumbnailUrl(self.thumbnail_cache.generation, image_id, draggable)
+    
   def insertImage(self, image_data):
     """Insert an image into the database, return the same object with image_id filled in
     It does not call commit though!
@@ -827,29 +1238,74 @@ class DBManager(object):
       sql = "INSERT INTO ImageLocation(image_id,min_longitude,max_longitude,min_latitude,max_latitude) VALUES(?,?,?,?,?);"
       self.cursor.execute(sql,(image_data.image_id,min_longitude,max_longitude,min_latitude,max_latitude))
     
+    if self._snapshot is not None:
+      self._snapshot.appendImage(image_data.image_id, image_data.latitude, image_data.longitude,
+                                 dateToSeconds(image_data.taken_date), image_data.geo_type)
+    if self._cluster_pyramid is not None:
+      self._cluster_pyramid.addImage(image_data.image_id, image_data.latitude, image_data.longitude,
+                                     dateToSeconds(image_data.taken_date), image_data.geo_type)
+    if self._time_histogram is not None:
+      self._time_histogram.addTime(dateToSeconds(image_data.taken_date))
+    self.marker_cache.clear()
+    
     self.dirty = True
     
     return image_data
         
-  def setPositionOnImages(self, image_id_list, longitude, latitude):
-    "Set user specified position on the give images"
-    sql = "UPDATE Image SET longitude=?, latitude=?, geo_type=? WHERE image_id IN ({seq});".format(seq=','.join(['?'] * len(image_id_list)))
-    sql_args = [longitude, latitude, ImageTable.GEO_FROM_USER]
-    sql_args.extend(image_id_list)
-    
-    self.cursor.execute(sql, sql_args)
-
-    #now update r-tree table  
+  def setPositionOnImages(self, image_ids, longitude, latitude, progress_fn=None):
+    """Set user specified position on the given images.
+    image_ids is an id_range_set.IDRangeSet or any iterable of image id's. The id's are staged in a temp table
+    and both tables are updated from it PLACE_CHUNK_SIZE images at a time, calling progress_fn(done, total) after each chunk"""
+    if not isinstance(image_ids, id_range_set.IDRangeSet):
+      image_ids = id_range_set.IDRangeSet.fromIds(image_ids)
+    id_ranges = list(image_ids.iterRanges())
     min_longitude,max_longitude,min_latitude,max_latitude = generateLatLongRect(longitude, latitude)
     
-    sql = "INSERT OR REPLACE INTO ImageLocation(image_id,min_longitude,max_longitude,min_latitude,max_latitude) VALUES(?,?,?,?,?);"
-    for image_id in image_id_list:
-      self.cursor.execute(sql,(image_id, min_longitude ,max_longitude, min_latitude, max_latitude))
-
+    total = _stagePlaceImageTable(self.cursor, id_ranges)
+    old_rows = []
+    for chunk_start in xrange(0, total, self.PLACE_CHUNK_SIZE):
+      chunk = (chunk_start, chunk_start + self.PLACE_CHUNK_SIZE)
+      if self._cluster_pyramid is not None:
+        #need the old positions to take the images out of the pyramid
+        sql = """SELECT image_id, latitude, longitude, taken_date, geo_type FROM Image
+        WHERE image_id IN (SELECT image_id FROM PlaceImage WHERE seq > ? AND seq <= ?);"""
+        self.cursor.execute(sql, chunk)
+        old_rows.extend(self.cursor.fetchall())
+      
+      sql = """UPDATE Image SET longitude=?, latitude=?, geo_type=?
+      WHERE image_id IN (SELECT image_id FROM PlaceImage WHERE seq > ? AND seq <= ?);"""
+      self.cursor.execute(sql, (longitude, latitude, ImageTable.GEO_FROM_USER) + chunk)
+      
+      #now update r-tree table  
+      sql = """INSERT OR REPLACE INTO ImageLocation(image_id,min_longitude,max_longitude,min_latitude,max_latitude)
+      SELECT image_id, ?, ?, ?, ? FROM PlaceImage WHERE seq > ? AND seq <= ?;"""
+      self.cursor.execute(sql, (min_longitude, max_longitude, min_latitude, max_latitude) + chunk)
+      if progress_fn is not None:
+        progress_fn(min(chunk[1], total), total)
+    
+    self.cursor.execute("DELETE FROM PlaceImage;")
     self.dbcon.commit()
     
+    if self._snapshot is not None:
+      self._snapshot.setPositionOnImages(id_ranges, longitude, latitude, ImageTable.GEO_FROM_USER)
+    if self._cluster_pyramid is not None:
+      for row in old_rows:
+        self._cluster_pyramid.removeImage(*row)
+        self._cluster_pyramid.addImage(row[0], latitude, longitude, row[3], ImageTable.GEO_FROM_USER)
+    #the overlay changes to a pin now the user has placed them
+    self.thumbnail_cache.removeWhere(lambda key: key[0] in image_ids)
+    self.marker_cache.clear()
+    
     self.dirty = True
     
+  def getPlaceableImageIdsBetweenIndices(self, first_index, last_index):
+    "See getPlaceableImageIdsBetweenIndices, uses its own cursor so the id's can be streamed"
+    return getPlaceableImageIdsBetweenIndices(self.dbcon.cursor(), first_index, last_index)
+    
+  def getPlaceableImageIdsBetweenTimes(self, start_seconds, end_seconds, without_position_only=False):
+    "See getPlaceableImageIdsBetweenTimes, uses its own cursor so the id's can be streamed"
+    return getPlaceableImageIdsBetweenTimes(self.dbcon.cursor(), start_seconds, end_seconds, without_position_only)
+    
   def getMapSettings(self):
     "Get the map view port if any"
     return getMapSettings(self.cursor)
@@ -879,6 +1335,10 @@ class DBManager(object):
     """Image Index is the position in the date ordered array of images (not the image id)
     This is a little unpleasant May need to review this for speed
     Returns None if there is None"""
+    histogram = self.getTimeHistogram()
+    if histogram is not None and time_histogram.isBucketStart(time_taken_seconds):
+      #exact without a query, as the time slider's times are
+      return histogram.getCountBefore(time_taken_seconds)
     sql_cmd = """SELECT COUNT(image_id) from Image WHERE taken_date < ? ORDER BY taken_date;"""
     self.cursor.execute(sql_cmd, (time_taken_seconds,))
     row = self.cursor.fetchone()
@@ -900,18 +1360,27 @@ class DBManager(object):
     else:
       asc_desc = "DESC"
   
-    sort_by_sql = "ORDER BY taken_date %s" % (asc_desc)
+    #image_id breaks ties so separately fetched ranges join up exactly
+    sort_by_sql = "ORDER BY taken_date %s, image_id %s" % (asc_desc, asc_desc)
     args = (number_of_images, start_index)
     sql_cmd = """SELECT image_id, file, camera_make, taken_date, taken_date_type, longitude, latitude, geo_type, thumbnail from Image %s LIMIT ? OFFSET ?;""" % (sort_by_sql)
     self.cursor.execute(sql_cmd, args)
     return self.cursor.fetchall()
     
+def getAttributeNames(o):
+  "Return the names of an object's attributes, from the __slots__ of its classes as well as its __dict__"
+  names = []
+  for cls in type(o).__mro__:
+    names.extend(x for x in getattr(cls, "__slots__", ()) if hasattr(o, x))
+  names.extend(getattr(o, "__dict__", {}).keys())
+  return names
+
 def createObjectFromVanillaDict(class_type, vanilla_dict):
   """Simple json creates a {} dictionary object containing fields 
   we want to fill in on a new object of class class_type,
   assumes a default constructor is available"""
   o = class_type()
-  for k in [x for x in o.__dict__.keys() if x[0] != "_"]:
+  for k in [x for x in getAttributeNames(o) if x[0] != "_"]:
     setattr(o, k, vanilla_dict[k])
   return o
 
@@ -952,7 +1421,172 @@ class testModel(unittest.TestCase):
   def testDateConversion(self):
     d = datetime.now()
     self.assertEqual(d, secondsToDate( dateToSeconds(d) ))
-    
+
+  def testMarkerImageSummaries(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    for seconds, geo_type in [(100, ImageTable.GEO_FROM_USER), (300, ImageTable.GEO_FROM_USER), (200, ImageTable.GEO_FROM_EXIF)]:
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      image_data.geo_type = geo_type
+      image_data.thumbnail = str(seconds)
+      dm.insertImage(image_data)
+    summaries = getMarkerImageSummaries(dm.cursor, [[1, 2], [2, 3], []])
+    self.assertEqual((True, 1, secondsToDate(100), secondsToDate(300)), summaries[0])
+    self.assertEqual((False, 2, secondsToDate(200), secondsToDate(300)), summaries[1])
+    self.assertEqual(None, summaries[2])
+    self.assertEqual("200", getThumbnail(dm.cursor, 3))
+    self.assertEqual(None, getThumbnail(dm.cursor, 4))
+
+  def testMarkerImageIds(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    #two images on either side of a cell edge at level 11, one outside the time window
+    for seconds, lat, lng in [(100, 10.0, 20.0), (200, 10.1, 20.1), (300, 10.0, 20.0), (5000, 10.0, 20.0)]:
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      image_data.latitude, image_data.longitude = lat, lng
+      image_data.geo_type = ImageTable.GEO_FROM_EXIF
+      dm.insertImage(image_data)
+    pyramid = dm.getClusterPyramid()
+    cells = pyramid.getCellsInArea(11, 0, 1000, 0, 50, 0, 50)
+    markers = []
+    for cell in cells:
+      marker_data = MapMarkerData()
+      marker_data.image_count = cell.count
+      marker_data.cells = [(cell.level, cell.lat_index, cell.lng_index)]
+      marker_data.time_window = (0, 1000)
+      markers.append(marker_data)
+    self.assertEqual([[1, 3], [2]], sorted(list(getMarkerImageIds(dm.cursor, m)) for m in markers))
+    self.assertEqual([1, 2, 3], list(getMarkerImageIds(dm.cursor, mergeMapMarkerDataList(markers))))
+
+  def testSetPositionOnImages(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    dm.PLACE_CHUNK_SIZE = 2
+    for seconds in range(100, 600, 100):
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      dm.insertImage(image_data)
+    progress = []
+    dm.setPositionOnImages([1, 2, 4, 5, 9], 20.0, 10.0, lambda done, total: progress.append((done, total)))
+    self.assertEqual([(2, 4), (4, 4)], progress)
+    dm.cursor.execute("SELECT image_id FROM Image WHERE latitude == 10.0 AND longitude == 20.0 AND geo_type == ?;", (ImageTable.GEO_FROM_USER,))
+    self.assertEqual([1, 2, 4, 5], [row[0] for row in dm.cursor.fetchall()])
+    dm.cursor.execute("SELECT image_id FROM ImageLocation ORDER BY image_id;")
+    self.assertEqual([1, 2, 4, 5], [row[0] for row in dm.cursor.fetchall()])
+
+  def testImageListQueries(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    for seconds in range(100, 600, 100):
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      image_data.geo_type = ImageTable.GEO_FROM_EXIF
+      image_data.latitude = seconds / 100.0
+      image_data.longitude = 10.0
+      dm.insertImage(image_data)
+    #more id's than sqlite allows parameters
+    image_id_list = [2, 4] + range(1000, 41000)
+    self.assertEqual((3.0, 10.0), dm.getAveragePositionOfImages(image_id_list))
+    self.assertEqual([ImageTable.GEO_FROM_EXIF] * 2, getGeoTypesFromImageList(dm.cursor, image_id_list))
+    self.assertEqual((secondsToDate(200), secondsToDate(400)), getMinMaxTimesFromImageList(dm.cursor, image_id_list))
+    dm.cursor.execute("SELECT COUNT(*) FROM ImageIDSet;")
+    self.assertEqual(0, dm.cursor.fetchone()[0])
+
+  def testTimeHistogram(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    day = 24 * 60 * 60
+    for seconds in [-day + 1, 5, day * 3]:
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      dm.insertImage(image_data)
+    histogram = dm.getTimeHistogram()
+    self.assertEqual(3, histogram.getTotal())
+    self.assertEqual(1, histogram.getCountBetween(-day, 0))
+    image_data = ImageData()
+    image_data.taken_date = secondsToDate(day * 3 + 10)
+    dm.insertImage(image_data)
+    #kept up to date rather than loaded again
+    self.assertTrue(dm.getTimeHistogram() is histogram)
+    self.assertEqual(2, histogram.getCountBetween(day, day * 4))
+
+  def testSaveAndLoad(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    dm.insertImage(ImageData())
+    dm.dirty = True
+    tmp_file = DBManager._createTempDBFile()
+    tmp_file.close()
+    try:
+      dm.saveFile(tmp_file.name)
+      self.assertFalse(dm.dirty)
+      self.assertTrue(dm.isConnected())
+      dm.newFile()
+      dm.loadFile(tmp_file.name)
+      self.assertEqual(1, dm.getNumberOfImages())
+      self.assertEqual(tmp_file.name, dm.saved_to_file)
+      dm.close()
+    finally:
+      os.remove(tmp_file.name)
+
+  def testOpenInPlace(self):
+    dm = DBManager(0.1)
+    dm.newFile()
+    for seconds in (100, 200):
+      image_data = ImageData()
+      image_data.taken_date = secondsToDate(seconds)
+      dm.insertImage(image_data)
+    saved_files = []
+    for _ in range(2):
+      tmp_file = DBManager._createTempDBFile()
+      tmp_file.close()
+      saved_files.append(tmp_file.name)
+    try:
+      dm.saveFile(saved_files[0])
+      dm.openFile(saved_files[0])
+      self.assertTrue(dm.isOpenInPlace())
+      self.assertEqual(2, dm.getNumberOfImages())
+      dm.setPositionOnImages([2], 20.0, 10.0)
+      self.assertEqual((10.0, 20.0), dm.getImageLocationById(2))
+      self.assertEqual([2], dm.getImagesIDsInArea(secondsToDate(0), secondsToDate(1000), 0, 20, 0, 30))
+      #the edit only reaches a file when saved, and saving elsewhere leaves the file opened alone
+      dm.saveFile(saved_files[1])
+      self.assertEqual((10.0, 20.0), dm.getImageLocationById(2))
+      for saved_file, expected in zip(saved_files, [(None, None), (10.0, 20.0)]):
+        saved = sqlite3.connect(saved_file)
+        self.assertEqual(expected, saved.execute("SELECT latitude, longitude FROM Image WHERE image_id == 2;").fetchone())
+        saved.close()
+      dm.close()
+    finally:
+      for saved_file in saved_files:
+        os.remove(saved_file)
+
+  def testThumbnailUrl(self):
+    url = getThumbnailUrl(3, 12, True)
+    self.assertEqual("thumb://3/12/pin", url)
+    self.assertEqual((3, 12, True), parseThumbnailUrl(url[len("thumb://"):]))
+    self.assertEqual((3, 12, None), parseThumbnailUrl("3/12"))
+    self.assertEqual(None, parseThumbnailUrl("3/x"))
+
+  def testSlottedObjects(self):
+    import json
+    marker1 = MapMarkerData()
+    marker1.image_id_list = makeImageIDArray([5, 9])
+    marker1.image_count = 2
+    marker2 = MapMarkerData()
+    marker2.image_id_list = makeImageIDArray([7])
+    marker2.image_count = 1
+    merged = mergeMapMarkerDataList([marker1, marker2])
+    self.assertEqual(makeImageIDArray([5, 7, 9]), merged.image_id_list)
+    self.assertEqual(3, json.loads(json.dumps(merged.serializeToDict("x")))["image_count"])
+    latlng = createObjectFromVanillaDict(LatLng, {"lat": 1.5, "lng": 2.5})
+    self.assertEqual((1.5, 2.5), (latlng.lat, latlng.lng))
+    image_set = createObjectFromVanillaDict(ScannedImageSet, json.loads(json.dumps(dict((x, 1) for x in ScannedImageSet.__slots__))))
+    self.assertEqual(1, image_set.number_of_images)
+    self.assertFalse(hasattr(Rect(), "__dict__"))
+
 if __name__=="__main__":
   unittest.main()
 
@@ -2,11 +2,17 @@
 from PySide import QtGui, QtCore
 import math
 import sys
+import unittest
 import model
+import thumbnail_decoder
+import lru_cache
+import id_range_set
 
 class ImgDetails(object):
   "Basic data about an image"
   
+  __slots__ = ("image_id", "filename", "camera_make", "taken_date", "taken_data_type", "longitude", "latitude", "geo_type")
+  
   def __init__(self, image_id, filename, camera_make, taken_date, taken_date_type, longitude, latitude, geo_type):
     self.image_id = image_id
     self.filename = filename
@@ -45,6 +51,7 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
   requestNewImageSetSignal = QtCore.Signal(int,int) #fires when the user has scrolled far enough we want to load more images up
   imageClicked = QtCore.Signal(int) #fires the image index when an image is clicked on by the user
   selectionChanged= QtCore.Signal() #fires when the selected images change
+  rangeSelectRequested = QtCore.Signal(int, int) #fires the first and last image index of a shift click, the images may not be loaded
   
   IMG_WIDTH  = 150 #we need fixed sizes of images in order to make this work, pixels
   IMG_HEIGHT = 150
@@ -54,6 +61,10 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
   #A really high res screen of 2560 x 1440 might have 144 images on screen at any one time
   #Ideally we would like at least one view size on either side of the current visible range
   BUFFER_IMG_NUMBER = 200 
+  
+  #decoded thumbnails are kept across buffer changes up to this many bytes, see setImageCacheBudget
+  IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+  PIXMAP_CACHE_BYTES = 48 * 1024 * 1024  # enough for the pixmaps of several screens full of images on a 4K display
 
   IMG_FORMAT = "JPG"
 
@@ -66,6 +77,15 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     
     self.compass_image = model.getCompassImage()
     self.pin_image = model.getPinImage()
+    # shown until a thumbnail has been decoded
+    self.unloaded_image = thumbnail_decoder.scaledToFit(model.getUnloadedPictureImage(), self.IMG_WIDTH, self.IMG_HEIGHT)
+    
+    #thumbnails are decoded and scaled to fit their cells off the gui thread and filled in as they arrive
+    self.decoder = thumbnail_decoder.ThumbnailDecoder(self.IMG_FORMAT, self.IMG_WIDTH, self.IMG_HEIGHT, self)
+    self.decoder.imageDecodedSignal.connect(self._onImageDecoded, QtCore.Qt.QueuedConnection)
+    self.image_cache = lru_cache.LRUCache(self.IMAGE_CACHE_BYTES, size_fn=lambda image: image.byteCount()) # image_id -> decoded QImage
+    #(image_id or None for the placeholder, geo_type of the icon or None, selected) -> QPixmap ready to paint
+    self.pixmap_cache = lru_cache.LRUCache(self.PIXMAP_CACHE_BYTES, size_fn=lambda pixmap: pixmap.width() * pixmap.height() * 4)
     
     #min sizes
     self.setMinimumWidth(self.IMG_WIDTH + self.IMG_MARGIN * 2)
@@ -90,11 +110,14 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     self.last_index_after_date_filter = None
     
     self._total_number_images = 0 #this is the total images to scroll through not the total images loaded
-    self.loaded_image_list = [] #list of lazily loaded qimages
+    self.loaded_image_list = [] #list of lazily loaded qimages, None until decoded
+    self._undecoded_thumbnails = {} #image_id -> thumbnail data of loaded images not yet decoded
+    self._loaded_list_index = {} #image_id -> index in loaded_image_list
     self.img_detail_list = [] #list of ImgDetail objects...
     self.background_dim_colour = QtGui.QColor(0xee, 0xee, 0xee)
     self.img_on_mouse_press = None
-    self.selected_image_id_list = []
+    self.selection = id_range_set.IDRangeSet() #image id's of the selected images
+    self._selection_anchor_index = None #image index of the last image clicked, a shift click selects from here
     self.updateTableSize()
     
     #some cached graphics objects
@@ -106,8 +129,15 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     
     
   def clear(self):
+    "Forget all the images, call when the image set changes as image ids are reused"
+    self.decoder.cancelAll()
+    self.image_cache.clear()
+    self.pixmap_cache.clear()
     self.loaded_image_list = []
-    self.selected_image_id_list = []
+    self._undecoded_thumbnails = {}
+    self._loaded_list_index = {}
+    self.selection.clear()
+    self._selection_anchor_index = None
     self.first_loaded_index = 0
     self.last_loaded_index = 0
     self.first_index_after_date_filter = None  
@@ -187,7 +217,6 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     
     painter = QtGui.QPainter(self.viewport())
     top_view_pos = self.verticalScrollBar().value()
-    bottom_view_pos = top_view_pos + self._getCurrentHeightOfViewPort()
     
     # do any background painting
     #self.dimBackground(painter)
@@ -197,102 +226,65 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
       if list_index < 0 or list_index >= len(self.loaded_image_list):
         break
       
-      disp_image = self.loaded_image_list[list_index]
-      src_width = disp_image.width()
-      src_height = disp_image.height()
+      pixmap = self._getPaintPixmap(list_index)
       
-      #work out if any scaling needs to performed
-      if src_width > self.IMG_WIDTH or src_height > self.IMG_HEIGHT:
-        if src_width >= src_height:
-          dest_width = self.IMG_WIDTH
-          dest_height = src_height * self.IMG_HEIGHT / src_width
-        else:
-          dest_width = src_width * self.IMG_WIDTH / src_height
-          dest_height = self.IMG_HEIGHT
-      else:
-        dest_width = src_width
-        dest_height = src_height
-        
-          
-      #centre image in the display rectangle with some offsets
-      left_offset = 0
-      if dest_width < self.IMG_WIDTH:
-        left_offset = (self.IMG_WIDTH - dest_width) // 2
-        
-      top_offset = 0
-      if dest_height < self.IMG_HEIGHT:
-        top_offset = (self.IMG_HEIGHT - dest_height) // 2
-        
-      #calculate top left point of paint
+      #centre image in its cell correcting for the current scroll position in y, the painter clips what is off screen
       img_left, img_top = self._calcIndexPos(img_index)
-      #correct for centering the image
-      img_left += left_offset
-      img_top += top_offset
-      
-      img_bottom = img_top + dest_height
-      
-      if img_top < top_view_pos:
-        dest_clip_top = top_view_pos - img_top
-        src_clip_top = dest_clip_top * src_height / dest_height
-      else:
-        dest_clip_top = 0
-        src_clip_top = 0
-          
-      if img_bottom > bottom_view_pos:
-        dest_clip_bottom = img_bottom - bottom_view_pos
-        src_clip_bottom = dest_clip_bottom * src_height / dest_height
-      else:
-        dest_clip_bottom = 0
-        src_clip_bottom = 0
-        
-      if dest_clip_bottom > dest_height:
-        continue
-      
-      #draw qimage into correct place on view port correcting for the current scroll position in y
-      draw_y = min( bottom_view_pos, max(0, img_top - top_view_pos))
-      
-      #calculate the rectangle of the qimage we want to draw on the screen
-      source_rect = QtCore.QRect(0, src_clip_top, src_width, src_height - src_clip_bottom) #x,y,width,height
-      dest_rect = QtCore.QRect(img_left, draw_y, dest_width, dest_height - dest_clip_bottom)
+      img_left += (self.IMG_WIDTH - pixmap.width()) // 2
+      img_top += (self.IMG_HEIGHT - pixmap.height()) // 2 - top_view_pos
       
       dimmed = self._isImageIndexDimmed(img_index)
         
       if dimmed:
         painter.setOpacity(self.DIM_OPACITY)
         
-      painter.drawImage(dest_rect, disp_image, source_rect )
+      painter.drawPixmap(img_left, img_top, pixmap)
       
       if dimmed:
         painter.setOpacity(1)
-      
-      #draw selection
-      if self.isListIndexSelected(img_index):
-        old_brush, old_pen = painter.brush(), painter.pen()
-        painter.setBrush(self._no_brush)
-        painter.setPen(self._blue_pen)
-        painter.drawRect(dest_rect)
-        painter.setBrush(old_brush)
-        painter.setPen(old_pen)
         
-      #draw compass
-      if self.doesImgIndexHaveGeoInfo(img_index):
-        #choose image
-        if self.img_detail_list[img_index - self.first_loaded_index].geo_type == model.ImageTable.GEO_FROM_EXIF:
-          icon_image = self.compass_image
-        else:
-          icon_image = self.pin_image
-          
-        icon_src_rect = QtCore.QRect(0, 0, icon_image.width(), icon_image.height())
-        icon_dest_rect = QtCore.QRect(img_left, img_top - top_view_pos, icon_image.width(), icon_image.height())
-        painter.setOpacity(0.7)
-        painter.drawImage(icon_dest_rect, icon_image, icon_src_rect)
-        painter.setOpacity(1.0)
+  def _getPaintPixmap(self, list_index):
+    """Return the QPixmap of a loaded image ready to be drawn, with the compass/pin and the selection drawn on.
+    These are made once and cached so painting is just copying pixmaps"""
+    img_details = self.img_detail_list[list_index]
+    image = self.loaded_image_list[list_index]
+    icon_geo_type = img_details.geo_type if img_details.longitude is not None and img_details.latitude is not None else None
+    selected = img_details.image_id in self.selection
+    #images still being decoded all share the placeholder's pixmaps
+    key = (img_details.image_id if image is not None else None, icon_geo_type, selected)
+    pixmap = self.pixmap_cache.get(key)
+    if pixmap is None:
+      pixmap = self._composePixmap(image if image is not None else self.unloaded_image, icon_geo_type, selected)
+      self.pixmap_cache.put(key, pixmap)
+    return pixmap
+    
+  def _composePixmap(self, image, icon_geo_type, selected):
+    "Make the pixmap of image with the compass or pin for icon_geo_type, None for neither, and the selection drawn on"
+    pixmap = QtGui.QPixmap.fromImage(image)
+    if icon_geo_type is None and not selected:
+      return pixmap
+    painter = QtGui.QPainter(pixmap)
+    if icon_geo_type is not None:
+      if icon_geo_type == model.ImageTable.GEO_FROM_EXIF:
+        icon_image = self.compass_image
+      else:
+        icon_image = self.pin_image
+      painter.setOpacity(model.OVERLAY_ICON_OPACITY)
+      painter.drawImage(0, 0, icon_image)
+      painter.setOpacity(1.0)
+    if selected:
+      painter.setBrush(self._no_brush)
+      painter.setPen(self._blue_pen)
+      #keep the 2 pixel pen inside the pixmap
+      painter.drawRect(1, 1, pixmap.width() - 2, pixmap.height() - 2)
+    painter.end()
+    return pixmap
 
   def isListIndexSelected(self, img_index):
     "Check if the image at a given list index is selected"
     list_index = img_index - self.first_loaded_index
     if list_index >= 0 and list_index < len(self.img_detail_list):
-      return self.img_detail_list[list_index].image_id in self.selected_image_id_list
+      return self.img_detail_list[list_index].image_id in self.selection
     else:
       return False
     
@@ -339,6 +331,7 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     "Override to lazy load when required..."
     super(PhotoTableWidget, self).scrollContentsBy(dx,dy)
     self._updateVisibleIndices()
+    self._prioritiseVisibleDecoding()
     #check if we need to get images
     ideal_start_index, ideal_end_index = self.getDesiredBufferedImageRange()
     
@@ -353,12 +346,100 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     of the images in updated_img_list
     Each row of updated_img_list should be (image_id, file, camera_make, taken_date, taken_date_type, longitude, latitude, geo_type, thumbnail)
     """
-    self.loaded_image_list = [img_row_to_qimage(x, self.IMG_FORMAT) for x in updated_img_list ]
-    self.img_detail_list = [ImgDetails(x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7]) for x in updated_img_list]
+    #use the cached images where there are any, the rest are decoded in the background
+    images = [self.image_cache.get(x[0]) for x in updated_img_list]
+    self._setLoadedImages(img_list_offset,
+                          [ImgDetails(x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7]) for x in updated_img_list],
+                          images,
+                          dict((x[0], x[8]) for x, image in zip(updated_img_list, images) if image is None))
+    
+  def getMissingImageRanges(self, start_index, end_index):
+    "Return the list of (start, end) index ranges of start_index..end_index that are not already loaded"
+    return missingRanges((self.first_loaded_index, self.last_loaded_index), (start_index, end_index))
+    
+  def slidePhotos(self, start_index, end_index, fetched_ranges):
+    """Move the loaded images to start_index..end_index keeping those already loaded and dropping the rest.
+    fetched_ranges is a list of (offset, rows) for each range given by getMissingImageRanges, rows as for updatePhotos"""
+    keep_start = max(start_index, self.first_loaded_index)
+    keep_end = min(end_index, self.last_loaded_index)
+    pieces = list(fetched_ranges)
+    if keep_start < keep_end:
+      pieces.append((keep_start, None))
+    
+    details = []
+    images = []
+    undecoded = {}
+    for _, rows in sorted(pieces):
+      if rows is None:
+        lo = keep_start - self.first_loaded_index
+        hi = keep_end - self.first_loaded_index
+        details.extend(self.img_detail_list[lo:hi])
+        images.extend(self.loaded_image_list[lo:hi])
+        undecoded.update((x.image_id, self._undecoded_thumbnails[x.image_id]) for x in self.img_detail_list[lo:hi] if x.image_id in self._undecoded_thumbnails)
+      else:
+        details.extend(ImgDetails(x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7]) for x in rows)
+        for x in rows:
+          image = self.image_cache.get(x[0])
+          images.append(image)
+          if image is None:
+            undecoded[x[0]] = x[8]
+    self._setLoadedImages(start_index, details, images, undecoded)
+    
+  def _setLoadedImages(self, img_list_offset, img_detail_list, loaded_image_list, undecoded_thumbnails):
+    "Replace the loaded images, undecoded_thumbnails is the image_id -> thumbnail data of those still to be decoded"
+    self.img_detail_list = img_detail_list
+    self.loaded_image_list = loaded_image_list
+    self._loaded_list_index = dict((x.image_id, i) for i, x in enumerate(img_detail_list))
+    self._undecoded_thumbnails = undecoded_thumbnails
+    self.decoder.keepOnly(self._undecoded_thumbnails)
     self.first_loaded_index = img_list_offset
-    self.last_loaded_index = img_list_offset + len( updated_img_list )
+    self.last_loaded_index = img_list_offset + len( img_detail_list )
     self._updateVisibleIndices(force_emit=True)
     self._updateViewPortSize()
+    #visible rows first then the rest of the buffer
+    self._prioritiseVisibleDecoding()
+    for image_id, thumbnail in self._undecoded_thumbnails.iteritems():
+      self.decoder.decode(image_id, thumbnail, thumbnail_decoder.DecodePriority.BUFFERED)
+    
+  def invalidateImages(self, image_ids):
+    """Drop the cached images of images that have been edited, they are redone when next loaded.
+    image_ids is an id_range_set.IDRangeSet or any other iterable of image id's"""
+    if not isinstance(image_ids, id_range_set.IDRangeSet):
+      image_ids = id_range_set.IDRangeSet.fromIds(image_ids)
+    self.image_cache.removeWhere(lambda image_id: image_id in image_ids)
+    self.pixmap_cache.removeWhere(lambda key: key[0] in image_ids)
+      
+  def setImageCacheBudget(self, max_bytes):
+    "Set how many bytes of decoded images are kept"
+    self.image_cache.setMaxSize(max_bytes)
+    
+  def getImageCacheUsage(self):
+    "Return a description of how full the decoded image cache is and how well it is doing"
+    return str(self.image_cache)
+    
+  def _prioritiseVisibleDecoding(self):
+    "Move the visible images that are still to be decoded to the front of the decoding queue"
+    if len(self._undecoded_thumbnails) == 0:
+      return
+    for img_index in range(self.first_visible_index, self.last_visible_index + 1):
+      list_index = img_index - self.first_loaded_index
+      if list_index >= 0 and list_index < len(self.img_detail_list):
+        image_id = self.img_detail_list[list_index].image_id
+        if image_id in self._undecoded_thumbnails:
+          self.decoder.decode(image_id, self._undecoded_thumbnails[image_id], thumbnail_decoder.DecodePriority.VISIBLE)
+          
+  @QtCore.Slot(int, object)
+  def _onImageDecoded(self, image_id, image):
+    "A thumbnail has been decoded, show it if it is still loaded"
+    list_index = self._loaded_list_index.get(image_id)
+    if list_index is None or self._undecoded_thumbnails.pop(image_id, None) is None:
+      return
+    self.loaded_image_list[list_index] = image
+    self.image_cache.put(image_id, image)
+    img_index = list_index + self.first_loaded_index
+    if img_index >= self.first_visible_index and img_index <= self.last_visible_index:
+      img_left, img_top = self._calcIndexPos(img_index)
+      self.viewport().update(img_left, img_top - self.verticalScrollBar().value(), self.IMG_WIDTH, self.IMG_HEIGHT)
 
   def updateTableSize(self):
     "update the size of the tables and recalculate visible images..."
@@ -553,30 +634,48 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
       #, allow user to select it to
       # set the geo location     
       if not self._isImageIndexDimmed(img_on_mouse_release) and not self.doesImgHaveExifGeoInfo(img_on_mouse_release):
-        ctrl_key = QtCore.Qt.KeyboardModifier.ControlModifier == QtGui.QApplication.keyboardModifiers()
-        if ctrl_key:
-          if image_id in self.selected_image_id_list:
-            #unselect
-            self.selected_image_id_list.remove(image_id)
-          else:
-            #select
-            self.selected_image_id_list.append(image_id)
+        modifiers = QtGui.QApplication.keyboardModifiers()
+        if modifiers == QtCore.Qt.KeyboardModifier.ShiftModifier and self._selection_anchor_index is not None:
+          #the range may go beyond the loaded images so whoever owns the data selects it, see selectImageIds
+          self.rangeSelectRequested.emit(min(self._selection_anchor_index, img_on_mouse_release),
+                                         max(self._selection_anchor_index, img_on_mouse_release))
         else:
-          if image_id in self.selected_image_id_list:
-            self.selected_image_id_list = []
+          if modifiers == QtCore.Qt.KeyboardModifier.ControlModifier:
+            self.selection.toggle(image_id)
+          elif image_id in self.selection:
+            self.selection.clear()
           else:
-            self.selected_image_id_list = [image_id]
-        #fire selection changed
-        self.selectionChanged.emit()
-    elif len(self.selected_image_id_list) != 0:
-      self.selected_image_id_list = []
-      self.selectionChanged.emit()
+            self.selection.clear()
+            self.selection.add(image_id)
+          self._selection_anchor_index = img_on_mouse_release
+          #fire selection changed
+          self.selectionChanged.emit()
+    elif len(self.selection) != 0:
+      self.clearSelection()
       
     #refresh
     self.repaintTable()  
     #reset
     self.img_on_mouse_press = None
     
+  def selectImageIds(self, sorted_image_ids):
+    "Add image id's, in ascending order from any iterable such as a database cursor, to the selection"
+    self.selection.addSortedIds(sorted_image_ids)
+    self.selectionChanged.emit()
+    self.repaintTable()
+    
+  def clearSelection(self):
+    self.selection.clear()
+    self._selection_anchor_index = None
+    self.selectionChanged.emit()
+    self.repaintTable()
+    
+  def getSelectableIndexRange(self):
+    "Return the (first, last) image index the user can select from, those outside the date filter are dimmed and can't be"
+    first = self.first_index_after_date_filter if self.first_index_after_date_filter is not None else 0
+    last = self.last_index_after_date_filter if self.last_index_after_date_filter is not None else self.total_number_of_images
+    return (first, min(last, self.total_number_of_images) - 1)
+    
   def _generateToolTip(self, img_index):
     list_index = img_index - self.first_loaded_index
     if list_index >= 0 and list_index < len(self.img_detail_list):
@@ -584,10 +683,31 @@ class PhotoTableWidget(QtGui.QAbstractScrollArea):
     else:
       return ""
 
-def img_row_to_qimage(img_row, _format):
-  "Construct a qimage from an image row of data"
-  return model.imgdata_to_qimage(img_row[8], _format)
+def missingRanges(loaded_range, desired_range):
+  "Return the list of (start, end) parts of desired_range that are not in loaded_range, ranges include start but not end"
+  loaded_start, loaded_end = loaded_range
+  start, end = desired_range
+  if start >= end:
+    return []
+  if loaded_start >= loaded_end or loaded_end <= start or loaded_start >= end:
+    return [(start, end)]
+  missing = []
+  if start < loaded_start:
+    missing.append((start, loaded_start))
+  if loaded_end < end:
+    missing.append((loaded_end, end))
+  return missing
+
+class TestPhotoTable(unittest.TestCase):
   
+  def testMissingRanges(self):
+    self.assertEqual([(0, 200)], missingRanges((0, 0), (0, 200)))
+    self.assertEqual([(400, 600)], missingRanges((0, 400), (200, 600)))
+    self.assertEqual([(0, 200)], missingRanges((200, 600), (0, 400)))
+    self.assertEqual([(0, 100), (300, 400)], missingRanges((100, 300), (0, 400)))
+    self.assertEqual([], missingRanges((0, 400), (100, 300)))
+    self.assertEqual([(800, 1000)], missingRanges((0, 400), (800, 1000)))
+    
 if __name__=="__main__":
   app = QtGui.QApplication(sys.argv)
   choose = PhotoTableWidget()
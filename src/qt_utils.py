@@ -53,6 +53,12 @@ def create_bxf_file_filter():
 def create_csv_file_filter():
   return "CSV File (*.csv)"
 
+def create_geojson_file_filter():
+  return "GeoJSON File (*.geojson)"
+
+def create_gpx_file_filter():
+  return "GPX File (*.gpx)"
+
 def choose_save_file(parent, current_file, save_filter = None, file_ext = None):
   """Called to show save dialog in QT thread from javascript connection, returns None if cancelled
   current_file can be None
@@ -36,6 +36,7 @@ class QSpanSlider(QtGui.QSlider):
     self.movement = QSpanSlider.FREE_MOVEMENT
     self.firstMovement = False
     self.blockTracking = False
+    self.densities = [] # 0 to 1 for equal parts of the slider, drawn behind the span, see setDensities
     
     #setup
     self.rangeChanged.connect( self.updateRange )
@@ -166,6 +167,43 @@ class QSpanSlider(QtGui.QSlider):
     #draw groove
     painter.drawRect(rect.intersected(groove))
 
+  def setDensities(self, densities):
+    "Show how busy equal parts of the slider are as bars behind the span, densities are from 0 to 1, empty for none"
+    self.densities = list(densities)
+    self.update()
+
+  def drawDensities(self, painter, opt):
+    "Draw the densities as bars from the groove, opt is set up as for the groove"
+    #the handle centres at the ends of the range are where the values start and end
+    opt.sliderPosition = self.minimum()
+    start_rect = self.style().subControlRect(QtGui.QStyle.CC_Slider, opt, QtGui.QStyle.SC_SliderHandle, self)
+    opt.sliderPosition = self.maximum()
+    end_rect = self.style().subControlRect(QtGui.QStyle.CC_Slider, opt, QtGui.QStyle.SC_SliderHandle, self)
+    start = self.pick(start_rect.center())
+    length = self.pick(end_rect.center()) - start
+    if self.orientation() == QtCore.Qt.Orientation.Horizontal:
+      base = start_rect.center().y()
+      max_bar = self.rect().height() // 2
+    else:
+      base = start_rect.center().x()
+      max_bar = self.rect().width() // 2
+    
+    color = self.palette().color(QtGui.QPalette.Highlight)
+    color.setAlpha(70)
+    painter.setPen(QtCore.Qt.NoPen)
+    painter.setBrush(color)
+    count = len(self.densities)
+    for i, density in enumerate(self.densities):
+      bar = int(round(density * max_bar))
+      if bar <= 0:
+        continue
+      x1 = start + length * i // count
+      x2 = start + length * (i + 1) // count
+      if self.orientation() == QtCore.Qt.Orientation.Horizontal:
+        painter.drawRect(QtCore.QRect(x1, base - bar, max(1, x2 - x1), bar))
+      else:
+        painter.drawRect(QtCore.QRect(base - bar, x1, bar, max(1, x2 - x1)))
+
   def drawHandle(self, painter, handle):
     opt = QtGui.QStyleOptionSlider()
     self.initStyleOption(opt, handle)
@@ -538,6 +576,9 @@ class QSpanSlider(QtGui.QSlider):
     opt.sliderPosition = 0
     opt.subControls = QtGui.QStyle.SC_SliderGroove | QtGui.QStyle.SC_SliderTickmarks
     painter.drawComplexControl(QtGui.QStyle.CC_Slider, opt)
+    
+    if len(self.densities) > 0:
+      self.drawDensities(painter, opt)
 
     #handle rects
     opt.sliderPosition = self.lowerPos
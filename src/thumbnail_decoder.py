@@ -0,0 +1,99 @@
+"""Decodes the photo table's thumbnails on a pool of worker threads so scrolling never waits on jpeg decoding"""
+import threading
+from PySide import QtCore
+import model
+
+def scaledToFit(image, max_width, max_height):
+  "Return the QImage scaled down, keeping its aspect ratio, to fit in max_width by max_height, smaller images are unchanged"
+  if image.width() <= max_width and image.height() <= max_height:
+    return image
+  return image.scaled(max_width, max_height, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+
+class DecodePriority(object):
+  BUFFERED = 0  # off screen rows kept ready for scrolling
+  VISIBLE = 1  # rows on screen, decoded first
+
+
+class _DecodeTask(QtCore.QRunnable):
+  "Decode one thumbnail, skipped if it is no longer wanted by the time a worker gets to it"
+
+  def __init__(self, decoder, image_id, thumbnail_data):
+    super(_DecodeTask, self).__init__()
+    self.decoder = decoder
+    self.image_id = image_id
+    self.thumbnail_data = thumbnail_data
+
+  def run(self):
+    try:
+      if self.decoder.isWanted(self.image_id):
+        #QImage, unlike QPixmap, can be used off the gui thread
+        image = model.imgdata_to_qimage(self.thumbnail_data, self.decoder.img_format)
+        #scale once here rather than every time it is painted
+        image = scaledToFit(image, self.decoder.max_width, self.decoder.max_height)
+        self.decoder._onTaskDecoded(self.image_id, image)
+    finally:
+      self.decoder._onTaskDone(self)
+
+
+class ThumbnailDecoder(QtCore.QObject):
+  """Queues thumbnails to be decoded into QImages by a thread pool, higher priorities first.
+  Images are scaled down to fit max_width by max_height and sent back to the gui thread with imageDecodedSignal"""
+
+  imageDecodedSignal = QtCore.Signal(int, object) # image_id, QImage
+
+  def __init__(self, img_format, max_width, max_height, parent=None):
+    super(ThumbnailDecoder, self).__init__(parent)
+    self.img_format = img_format
+    self.max_width = max_width
+    self.max_height = max_height
+    self._pool = QtCore.QThreadPool(self)
+    #leave a core for the gui thread
+    self._pool.setMaxThreadCount(max(1, QtCore.QThread.idealThreadCount() - 1))
+    self._lock = threading.Lock()
+    self._wanted = {}  # image_id -> highest priority asked for, until it is decoded or cancelled
+    self._tasks = set()  # keep queued tasks referenced so python does not collect them
+
+  def decode(self, image_id, thumbnail_data, priority=DecodePriority.BUFFERED):
+    """Queue a thumbnail to be decoded. Asking again with a higher priority moves it forward,
+    any other repeat is ignored"""
+    with self._lock:
+      queued_priority = self._wanted.get(image_id)
+      if queued_priority is not None and queued_priority >= priority:
+        return
+      #tasks can't be re-prioritised in the pool so queue another, whichever runs first does the work
+      self._wanted[image_id] = priority
+      task = _DecodeTask(self, image_id, thumbnail_data)
+      task.setAutoDelete(False)
+      self._tasks.add(task)
+    self._pool.start(task, priority)
+
+  def isWanted(self, image_id):
+    "Return True if the image is still waiting to be decoded"
+    with self._lock:
+      return image_id in self._wanted
+
+  def keepOnly(self, image_ids):
+    "Cancel the decoding of every queued image not in image_ids"
+    image_ids = set(image_ids)
+    with self._lock:
+      for image_id in [x for x in self._wanted if x not in image_ids]:
+        del self._wanted[image_id]
+
+  def cancelAll(self):
+    with self._lock:
+      self._wanted.clear()
+
+  def waitForDone(self, wait_ms):
+    "Cancel everything queued and wait up to wait_ms for the workers to finish what they are doing"
+    self.cancelAll()
+    return self._pool.waitForDone(wait_ms)
+
+  def _onTaskDecoded(self, image_id, image):
+    with self._lock:
+      if self._wanted.pop(image_id, None) is None:
+        return  # cancelled, or decoded by a higher priority task while this one ran
+    self.imageDecodedSignal.emit(image_id, image)
+
+  def _onTaskDone(self, task):
+    with self._lock:
+      self._tasks.discard(task)
@@ -0,0 +1,271 @@
+"""Local cache of map tiles so places already visited load without the network and the map works offline.
+Tiles are kept in an MBTiles style sqlite file and served to the map through the tile:// url scheme"""
+import math
+import sqlite3
+import threading
+import unittest
+import urllib2
+from PySide import QtCore, QtNetwork
+from browser_widget import PendingContent
+import lru_cache
+
+class TileConsts(object):
+  URL_SCHEME = "tile"  # the map loads tiles from tile://<zoom>/<x>/<y>.png
+  UPSTREAM_URL = "http://%s.mqcdn.com/tiles/1.0.0/osm/%d/%d/%d.png"  # subdomain, zoom, x, y
+  UPSTREAM_SUBDOMAINS = ["otile1", "otile2", "otile3", "otile4"]
+  CONTENT_TYPE = "image/png"
+  MAX_ZOOM = 18
+  DISK_CACHE_BYTES = 256 * 1024 * 1024  # least recently used tiles are dropped from the file beyond this
+  MEMORY_CACHE_BYTES = 8 * 1024 * 1024  # recently shown tiles are also held in memory
+  MAX_SEED_TILES = 10000  # largest number of tiles a single seed may download
+  DOWNLOAD_TIMEOUT_SECONDS = 10
+
+
+def tileForLatLng(lat, lng, zoom):
+  "Return the (x, y) of the web mercator tile containing the position at the zoom level"
+  n = 2 ** zoom
+  lat = max(-85.0511, min(85.0511, lat))
+  x = int((lng + 180.0) / 360.0 * n)
+  lat_rad = math.radians(lat)
+  y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+  return (min(n - 1, max(0, x)), min(n - 1, max(0, y)))
+
+def tilesInArea(min_lat, max_lat, min_lng, max_lng, min_zoom, max_zoom):
+  "Return a list of the (zoom, x, y) of every tile covering the area at each zoom level from min_zoom to max_zoom"
+  tiles = []
+  for zoom in range(min_zoom, max_zoom + 1):
+    min_x, min_y = tileForLatLng(max_lat, min_lng, zoom)  # tile y increases southwards
+    max_x, max_y = tileForLatLng(min_lat, max_lng, zoom)
+    tiles.extend((zoom, x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+  return tiles
+
+def upstreamTileUrl(zoom, x, y):
+  "Return the url a tile is downloaded from"
+  subdomain = TileConsts.UPSTREAM_SUBDOMAINS[(x + y) % len(TileConsts.UPSTREAM_SUBDOMAINS)]
+  return TileConsts.UPSTREAM_URL % (subdomain, zoom, x, y)
+
+def parseTileUrl(url_host, url_path):
+  "Return the (zoom, x, y) of a tile:// url split into its host and path, None if it is not one"
+  parts = (url_host + url_path).strip("/").split("/")
+  if len(parts) != 3 or not parts[2].endswith(".png"):
+    return None
+  try:
+    return (int(parts[0]), int(parts[1]), int(parts[2][:-len(".png")]))
+  except ValueError:
+    return None
+
+
+class TileStore(object):
+  """MBTiles style sqlite file of tiles, with the least recently used tiles dropped once the file goes over max_bytes.
+  As in MBTiles rows are numbered from the south (TMS) while the map numbers them from the north.
+  Safe to use from the gui thread and a seeding thread at the same time"""
+
+  schema = ["CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);",
+            """CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+            tile_data BLOB, last_used INTEGER);""",
+            "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);",
+            "CREATE INDEX IF NOT EXISTS tile_last_used ON tiles (last_used);"]
+
+  _TOUCH_BATCH = 64  # number of tile uses remembered before they are written to the file
+
+  def __init__(self, db_file, max_bytes=TileConsts.DISK_CACHE_BYTES, memory_bytes=TileConsts.MEMORY_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._dbcon = sqlite3.connect(db_file, check_same_thread=False)
+    for sql in self.schema:
+      self._dbcon.execute(sql)
+    if self._dbcon.execute("SELECT COUNT(*) FROM metadata;").fetchone()[0] == 0:
+      self._dbcon.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);",
+                              [("name", "PhotoTrailMapper tile cache"), ("format", "png"), ("type", "baselayer")])
+    self._dbcon.commit()
+    self.size, self._use_counter = self._dbcon.execute("SELECT IFNULL(SUM(LENGTH(tile_data)), 0), IFNULL(MAX(last_used), 0) FROM tiles;").fetchone()
+    self._touched = {}  # (zoom, x, y) -> use count not yet written to the file
+    self._memory_cache = lru_cache.LRUCache(memory_bytes)
+
+  def _tmsKey(self, zoom, x, y):
+    return (zoom, x, (2 ** zoom) - 1 - y)
+
+  def _nextUse(self):
+    self._use_counter += 1
+    return self._use_counter
+
+  def getTile(self, zoom, x, y):
+    "Return the png data of a tile or None if it is not in the cache"
+    key = (zoom, x, y)
+    data = self._memory_cache.get(key)
+    with self._lock:
+      if data is None:
+        row = self._dbcon.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;",
+                                  self._tmsKey(zoom, x, y)).fetchone()
+        if row is None:
+          return None
+        data = str(row[0])
+        self._memory_cache.put(key, data)
+      self._touched[key] = self._nextUse()
+      if len(self._touched) >= self._TOUCH_BATCH:
+        self._flushTouched()
+    return data
+
+  def hasTile(self, zoom, x, y):
+    if (zoom, x, y) in self._memory_cache:
+      return True
+    with self._lock:
+      return self._dbcon.execute("SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;",
+                                 self._tmsKey(zoom, x, y)).fetchone() is not None
+
+  def putTile(self, zoom, x, y, data):
+    "Add or replace a tile, dropping the least recently used tiles if the file is now too big"
+    with self._lock:
+      key = self._tmsKey(zoom, x, y)
+      old = self._dbcon.execute("SELECT LENGTH(tile_data) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;", key).fetchone()
+      if old is not None:
+        self.size -= old[0]
+      self._dbcon.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, last_used) VALUES (?, ?, ?, ?, ?);",
+                          key + (buffer(data), self._nextUse()))
+      self.size += len(data)
+      self._memory_cache.put((zoom, x, y), data)
+      self._flushTouched()
+      if self.size > self.max_bytes:
+        self._evict()
+      self._dbcon.commit()
+
+  def _flushTouched(self):
+    "Write the last use of recently shown tiles to the file, call with the lock held"
+    self._dbcon.executemany("UPDATE tiles SET last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?;",
+                            [(use,) + self._tmsKey(*key) for key, use in self._touched.iteritems()])
+    self._touched = {}
+    self._dbcon.commit()
+
+  def _evict(self):
+    "Drop least recently used tiles until the file is comfortably under max_bytes, call with the lock held"
+    target = self.max_bytes * 0.9
+    while self.size > target:
+      rows = self._dbcon.execute("SELECT rowid, zoom_level, tile_column, tile_row, LENGTH(tile_data) FROM tiles ORDER BY last_used LIMIT 100;").fetchall()
+      if len(rows) == 0:
+        break
+      for rowid, zoom, column, row, size in rows:
+        self._dbcon.execute("DELETE FROM tiles WHERE rowid=?;", (rowid,))
+        self._memory_cache.remove((zoom, column, (2 ** zoom) - 1 - row))
+        self.size -= size
+        if self.size <= target:
+          break
+
+  def getTileCount(self):
+    with self._lock:
+      return self._dbcon.execute("SELECT COUNT(*) FROM tiles;").fetchone()[0]
+
+  def close(self):
+    with self._lock:
+      if self._dbcon is not None:
+        self._flushTouched()
+        self._dbcon.close()
+        self._dbcon = None
+
+
+class TileProvider(QtCore.QObject):
+  """Serves tile:// urls for the map from a TileStore, tiles not yet in the store are downloaded and added to it.
+  Lives on the gui thread"""
+
+  def __init__(self, tile_store, parent=None):
+    super(TileProvider, self).__init__(parent)
+    self.tile_store = tile_store
+    self._network = QtNetwork.QNetworkAccessManager(self)
+    self._downloads = {}  # QNetworkReply -> ((zoom, x, y), [PendingContent])
+    self._downloading = {}  # (zoom, x, y) -> QNetworkReply
+    self._network.finished.connect(self._onDownloadFinished)
+
+  def serveTile(self, url):
+    "Url scheme handler, see BrowserWidget.registerUrlScheme"
+    tile = parseTileUrl(url.host(), url.path())
+    if tile is None:
+      return None
+    data = self.tile_store.getTile(*tile)
+    if data is not None:
+      return (data, TileConsts.CONTENT_TYPE)
+    #several views may ask for the same tile while it downloads
+    pending = PendingContent(self)
+    reply = self._downloading.get(tile)
+    if reply is None:
+      reply = self._network.get(QtNetwork.QNetworkRequest(QtCore.QUrl(upstreamTileUrl(*tile))))
+      self._downloading[tile] = reply
+      self._downloads[reply] = (tile, [])
+    self._downloads[reply][1].append(pending)
+    return pending
+
+  @QtCore.Slot(object)
+  def _onDownloadFinished(self, reply):
+    tile, waiting = self._downloads.pop(reply, (None, []))
+    self._downloading.pop(tile, None)
+    data = None
+    if reply.error() == QtNetwork.QNetworkReply.NoError:
+      data = str(reply.readAll())
+      if len(data) != 0:
+        self.tile_store.putTile(tile[0], tile[1], tile[2], data)
+      else:
+        data = None
+    for pending in waiting:
+      pending.setContent(data, TileConsts.CONTENT_TYPE)
+      pending.deleteLater()
+    reply.deleteLater()
+
+
+class TileSeedTask(QtCore.QThread):
+  "Download every tile of an area over a range of zoom levels into a TileStore so the area can be viewed offline"
+
+  progressSignal = QtCore.Signal(int, int) # tiles done, total tiles
+  seedCompleteSignal = QtCore.Signal(int, int) # tiles downloaded, tiles that failed
+
+  def __init__(self, tile_store, tiles):
+    """tiles is a list of (zoom, x, y), see tilesInArea"""
+    super(TileSeedTask, self).__init__()
+    self.tile_store = tile_store
+    self.tiles = tiles
+    self._stop_requested = False
+
+  def stop(self):
+    self._stop_requested = True
+
+  def run(self):
+    downloaded = 0
+    failed = 0
+    for i, (zoom, x, y) in enumerate(self.tiles):
+      if self._stop_requested:
+        break
+      if not self.tile_store.hasTile(zoom, x, y):
+        try:
+          data = urllib2.urlopen(upstreamTileUrl(zoom, x, y), timeout=TileConsts.DOWNLOAD_TIMEOUT_SECONDS).read()
+          self.tile_store.putTile(zoom, x, y, data)
+          downloaded += 1
+        except (urllib2.URLError, IOError):
+          failed += 1
+      self.progressSignal.emit(i + 1, len(self.tiles))
+    self.seedCompleteSignal.emit(downloaded, failed)
+
+
+class TestTileCache(unittest.TestCase):
+
+  def testTileMaths(self):
+    self.assertEqual((0, 0), tileForLatLng(51.5, -0.1, 0))
+    self.assertEqual((1, 0), tileForLatLng(51.5, 0.1, 1))
+    self.assertEqual((0, 1), tileForLatLng(-10, -0.1, 1))
+    self.assertEqual([(0, 0, 0), (1, 0, 0), (1, 1, 0)], tilesInArea(51.0, 52.0, -1.0, 1.0, 0, 1))
+    self.assertEqual((3, 4, 5), parseTileUrl("3", "/4/5.png"))
+    self.assertEqual(None, parseTileUrl("3", "/4/x.png"))
+
+  def testStore(self):
+    store = TileStore(":memory:", max_bytes=10, memory_bytes=4)
+    store.putTile(1, 0, 0, "aaaa")
+    store.putTile(1, 1, 0, "bbbb")
+    self.assertEqual("aaaa", store.getTile(1, 0, 0))
+    self.assertEqual(None, store.getTile(2, 0, 0))
+    #over budget so the least recently used tile goes
+    store.putTile(1, 0, 1, "cccc")
+    self.assertFalse(store.hasTile(1, 1, 0))
+    self.assertTrue(store.hasTile(1, 0, 0))
+    self.assertEqual(8, store.size)
+    self.assertEqual(2, store.getTileCount())
+    store.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,146 @@
+"""Count of images taken each day, kept up to date as images are added, so the time slider can be spread over
+the images rather than linearly over time and filter counts can be answered without the database"""
+import bisect
+import unittest
+
+class TimeHistogramConsts(object):
+  BUCKET_SECONDS = 24 * 60 * 60
+
+def _bucketOf(seconds):
+  return int(seconds) // TimeHistogramConsts.BUCKET_SECONDS
+
+def isBucketStart(seconds):
+  "True if seconds is the start of a day, where counts from the histogram are exact"
+  return int(seconds) % TimeHistogramConsts.BUCKET_SECONDS == 0
+
+
+class TimeHistogram(object):
+  """Number of images in each day with any, days are counted from 1st Jan 1970 as the dates are.
+  Slider positions map to times by quantile: moving the slider a tenth of the way along always passes about
+  a tenth of the images, snapped to the start of a day so counts between slider times are exact"""
+
+  def __init__(self):
+    self._counts = {}  # bucket -> number of images
+    self._buckets = None  # sorted buckets and cumulative counts up to and including each, built when needed
+    self._cumulative = None
+
+  @classmethod
+  def loadFromCursor(cls, cursor):
+    "Build the histogram of the Image table in one grouped query"
+    histogram = cls()
+    #floor rather than truncate so dates before 1970 fall in the right day
+    sql = """SELECT (taken_date - ((taken_date %% %(b)d) + %(b)d) %% %(b)d) / %(b)d, COUNT(*) FROM Image
+    WHERE taken_date IS NOT NULL GROUP BY 1;""" % {"b": TimeHistogramConsts.BUCKET_SECONDS}
+    cursor.execute(sql)
+    histogram._counts = dict((int(bucket), count) for bucket, count in cursor.fetchall())
+    return histogram
+
+  def addTime(self, seconds):
+    "Count an image taken at seconds"
+    if seconds is None:
+      return
+    bucket = _bucketOf(seconds)
+    self._counts[bucket] = self._counts.get(bucket, 0) + 1
+    self._buckets = None
+
+  def _build(self):
+    if self._buckets is None:
+      self._buckets = sorted(self._counts)
+      self._cumulative = []
+      total = 0
+      for bucket in self._buckets:
+        total += self._counts[bucket]
+        self._cumulative.append(total)
+
+  def getTotal(self):
+    self._build()
+    return self._cumulative[-1] if self._cumulative else 0
+
+  def getCountBefore(self, seconds):
+    "Number of images in the days before the day of seconds"
+    self._build()
+    i = bisect.bisect_left(self._buckets, _bucketOf(seconds))
+    return self._cumulative[i - 1] if i > 0 else 0
+
+  def getCountBetween(self, start_seconds, end_seconds):
+    "Number of images from the day of start_seconds up to but not including the day of end_seconds"
+    return max(0, self.getCountBefore(end_seconds) - self.getCountBefore(start_seconds))
+
+  def sliderValueToSeconds(self, value, max_value):
+    """Return the start of the day that about value / max_value of the images were taken before.
+    max_value gives the end of the last day, so every image is between 0 and max_value"""
+    self._build()
+    if not self._buckets:
+      return 0
+    if value >= max_value:
+      return (self._buckets[-1] + 1) * TimeHistogramConsts.BUCKET_SECONDS
+    if value <= 0:
+      return self._buckets[0] * TimeHistogramConsts.BUCKET_SECONDS
+    #the first day whose images take the count past the wanted fraction
+    target = self._cumulative[-1] * float(value) / max_value
+    i = min(bisect.bisect_left(self._cumulative, target), len(self._buckets) - 1)
+    return self._buckets[i] * TimeHistogramConsts.BUCKET_SECONDS
+
+  def secondsToSliderValue(self, seconds, max_value):
+    "The slider value nearest to seconds, the inverse of sliderValueToSeconds"
+    total = self.getTotal()
+    if total == 0:
+      return 0
+    return int(round(max_value * float(self.getCountBefore(seconds)) / total))
+
+  def getSliderDensities(self, bins):
+    """Split the slider into bins and return the images per day in each relative to the busiest, 0 to 1.
+    With the quantile mapping each bin holds about as many images, so busy periods show as narrow spans in time"""
+    densities = []
+    for i in range(bins):
+      start_seconds = self.sliderValueToSeconds(i, bins)
+      #a bin within one busy day is that day
+      end_seconds = max(self.sliderValueToSeconds(i + 1, bins), start_seconds + TimeHistogramConsts.BUCKET_SECONDS)
+      days = (end_seconds - start_seconds) // TimeHistogramConsts.BUCKET_SECONDS
+      densities.append(float(self.getCountBetween(start_seconds, end_seconds)) / days)
+    busiest = max(densities) if densities else 0
+    if busiest == 0:
+      return densities
+    return [x / busiest for x in densities]
+
+
+class TestTimeHistogram(unittest.TestCase):
+
+  def setUp(self):
+    day = TimeHistogramConsts.BUCKET_SECONDS
+    self.day = day
+    self.histogram = TimeHistogram()
+    #a burst of 8 images on day 10, then 1 each on days 100 and 1000
+    for seconds in [10 * day + x for x in range(8)] + [100 * day + 5, 1000 * day + 7]:
+      self.histogram.addTime(seconds)
+
+  def testCounts(self):
+    self.assertEqual(10, self.histogram.getTotal())
+    self.assertEqual(8, self.histogram.getCountBetween(0, 11 * self.day))
+    self.assertEqual(8, self.histogram.getCountBetween(10 * self.day + 5, 100 * self.day + 1))
+    self.assertEqual(9, self.histogram.getCountBetween(10 * self.day + 5, 101 * self.day))
+    self.assertEqual(1, self.histogram.getCountBetween(500 * self.day, 2000 * self.day))
+
+  def testQuantileMapping(self):
+    self.assertEqual(10 * self.day, self.histogram.sliderValueToSeconds(0, 100))
+    #most of the slider is the burst
+    self.assertEqual(10 * self.day, self.histogram.sliderValueToSeconds(50, 100))
+    self.assertEqual(100 * self.day, self.histogram.sliderValueToSeconds(85, 100))
+    self.assertEqual(1001 * self.day, self.histogram.sliderValueToSeconds(100, 100))
+    self.assertEqual(80, self.histogram.secondsToSliderValue(100 * self.day, 100))
+    self.assertEqual(100, self.histogram.secondsToSliderValue(1001 * self.day, 100))
+
+  def testDensities(self):
+    densities = self.histogram.getSliderDensities(10)
+    self.assertEqual(1.0, densities[0])
+    self.assertTrue(densities[-1] < 0.01)
+
+  def testEmpty(self):
+    histogram = TimeHistogram()
+    self.assertEqual(0, histogram.sliderValueToSeconds(50, 100))
+    self.assertEqual(0, histogram.secondsToSliderValue(50, 100))
+    self.assertEqual([0.0, 0.0], histogram.getSliderDensities(2))
+
+
+if __name__ == "__main__":
+  unittest.main()